@@ -0,0 +1,86 @@
+"""
+Compare the inference presets of NnUnetApi.predict on a local validation folder.
+
+Every preset predicts the same folder (Decathlon format) into its own sub folder of the output path.
+The report holds the time per case of each preset and its Dice against the 'accurate' preset.
+
+e.g.
+    python -m benchmarks.preset_benchmark -i VALIDATION_FOLDER -o OUTPUT_FOLDER -d Dataset770_BraTSGLIPreCropRegion \
+        -p nnUNetResEncUNetPlans -c 3d_fullres
+"""
+import os
+import time
+import argparse
+import numpy as np
+import torch
+from nnunet_api import NnUnetApi
+from tools.sitk_stuff import read_nifti
+from tools.evaluation import label_agreement
+from tools.json_pickle_stuff import write_json
+from tools.paths_dirs_stuff import path_contents_pattern, create_path
+
+
+def compare_folders(pred_folder, ref_folder):
+    """
+    per case Dice between the predictions of two presets
+    """
+    dice = {}
+    for case in path_contents_pattern(ref_folder, '.nii.gz'):
+        ref = read_nifti(os.path.join(ref_folder, case))[0]
+        # keep the itk image alive as long as its array view is used
+        pred, pred_itk = read_nifti(os.path.join(pred_folder, case), as_view=True)[:2]
+        dice[case] = label_agreement(pred, ref)
+    return dice
+
+
+def benchmark_presets(input_folder, output_root, dataset_name_or_id, configuration, presets=('accurate', 'balanced', 'fast'),
+                      folds=(0,), checkpoint_name='checkpoint_final.pth', plans_identifier='nnUNetPlans',
+                      device=torch.device('cuda', 0), api=None):
+    """
+    run every preset on input_folder and write a report to output_root/preset_benchmark.json
+    :return: dict preset -> {'seconds_per_case', 'mean_dice', 'dice'}
+    """
+    api = NnUnetApi() if api is None else api
+    presets = ['accurate'] + [p for p in presets if p != 'accurate']
+    # load the weights before timing anything
+    api.get_session(dataset_name_or_id, configuration, folds, checkpoint_name, plans_identifier, device)
+
+    report = {}
+    for preset in presets:
+        preset_folder = os.path.join(output_root, preset)
+        create_path(preset_folder)
+        if path_contents_pattern(preset_folder, '.nii.gz'):
+            raise FileExistsError(f"{preset_folder} already holds predictions, use an empty output folder")
+        start = time.perf_counter()
+        api.predict(input_folder, preset_folder, dataset_name_or_id, configuration, folds, checkpoint_name,
+                    plans_identifier, device=device, preset=preset)
+        elapsed = time.perf_counter() - start
+        n_cases = len(path_contents_pattern(preset_folder, '.nii.gz'))
+        report[preset] = {'seconds_per_case': elapsed / max(n_cases, 1)}
+        print(f"{preset}: {report[preset]['seconds_per_case']:.2f} s per case")
+
+    reference = os.path.join(output_root, 'accurate')
+    for preset in presets:
+        dice = compare_folders(os.path.join(output_root, preset), reference)
+        report[preset]['dice'] = dice
+        report[preset]['mean_dice'] = float(np.mean(list(dice.values()))) if dice else None
+        print(f"{preset}: mean Dice against 'accurate' {report[preset]['mean_dice']}")
+
+    write_json(os.path.join(output_root, 'preset_benchmark.json'), report)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time per case and Dice of the inference presets')
+    parser.add_argument('-i', '--input_folder', required=True)
+    parser.add_argument('-o', '--output_root', required=True)
+    parser.add_argument('-d', '--dataset', required=True)
+    parser.add_argument('-c', '--configuration', default='3d_fullres')
+    parser.add_argument('-p', '--plans_identifier', default='nnUNetPlans')
+    parser.add_argument('-f', '--folds', nargs='+', type=int, default=[0])
+    parser.add_argument('-chk', '--checkpoint_name', default='checkpoint_final.pth')
+    parser.add_argument('--presets', nargs='+', default=['accurate', 'balanced', 'fast'])
+    parser.add_argument('--device', default='cuda')
+    args = parser.parse_args()
+    benchmark_presets(args.input_folder, args.output_root, args.dataset, args.configuration, args.presets,
+                      args.folds, args.checkpoint_name, args.plans_identifier, torch.device(args.device))
@@ -0,0 +1,391 @@
+"""
+Offline benchmark suite on synthetic BraTS-like data.
+
+Generates synthetic cases, runs the pipeline helpers on them and records throughput and memory per
+benchmark in a JSON file. Passing a previous result file as --baseline prints the time and memory ratio
+of every benchmark against it and exits with an error if one got slower or needs more memory than the
+tolerances allow.
+
+e.g.
+    python -m benchmarks.run_benchmarks -o /tmp/gli_bench --cases 8 --size 96 --save results_new.json \
+        --baseline results_old.json
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import platform
+import threading
+import tracemalloc
+import subprocess
+import multiprocessing
+from tools.data_reformat import data_prepare, remove_additional_label
+from tools.json_pickle_stuff import copy_plans_json, read_json, write_json
+from tools.sitk_stuff import read_nifti, read_nifti_header
+from tools.writer import write_nifti_from_vol
+from tools.paths_dirs_stuff import path_contents_pattern, create_path
+from tools.dicom_ingest import ingest_dicom
+from tools.evaluation import evaluate_folders
+from tools.probability_store import compare_with_npz
+from benchmarks.synthetic_cases import synthetic_case, synthetic_probabilities, write_raw_dataset, write_dicom_dataset, write_tiny_model
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FOLDS_SMOKE_DATASET = 'Dataset998_SyntheticFolds'
+NNUNET_PATH_VARIABLES = ('nnUNet_raw', 'nnUNet_preprocessed', 'nnUNet_results')
+
+
+def _current_rss_bytes():
+    try:
+        with open('/proc/self/statm') as handle:
+            return int(handle.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _memory_run(function, sample_seconds=0.005):
+    """
+    run function once under tracemalloc while a thread samples the resident memory of the process,
+    which also sees the buffers of itk, torch and numpy that tracemalloc misses.
+    """
+    baseline = _current_rss_bytes()
+    peak = [baseline]
+    finished = threading.Event()
+
+    def sample():
+        while not finished.wait(sample_seconds):
+            peak[0] = max(peak[0], _current_rss_bytes())
+
+    sampler = threading.Thread(target=sample, daemon=True) if baseline is not None else None
+    if sampler is not None:
+        sampler.start()
+    tracemalloc.start()
+    try:
+        function()
+        _, traced_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        finished.set()
+        if sampler is not None:
+            sampler.join()
+    rss_peak = None if baseline is None else max(peak[0], _current_rss_bytes()) - baseline
+    return traced_peak, rss_peak
+
+
+def measure(function, n_items, n_bytes=None, reset=None):
+    """
+    return the wall time, throughput and peak memory of function. memory is measured in a first run
+    (peak traced Python memory and peak increase of the resident memory), time in a second run without
+    instrumentation. reset is called between the runs to remove the outputs of the first one, for
+    functions that skip work already done.
+    """
+    traced_peak, rss_peak = _memory_run(function)
+    if reset is not None:
+        reset()
+    start = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start
+    result = {'seconds': seconds,
+              'items_per_second': n_items / seconds if seconds > 0 else None,
+              'peak_traced_memory_bytes': traced_peak,
+              'peak_rss_increase_bytes': rss_peak}
+    if n_bytes is not None:
+        result['megabytes_per_second'] = n_bytes / 1e6 / seconds if seconds > 0 else None
+    return result
+
+
+def _removing(path):
+    return lambda: shutil.rmtree(path, ignore_errors=True)
+
+
+def folder_bytes(folder):
+    return sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+
+
+def run_suite(work_dir, n_cases=4, size=64, with_inference=True, with_training=True):
+    """
+    run all benchmarks in work_dir (it is emptied first) and return the results.
+    """
+    if os.path.exists(work_dir):
+        shutil.rmtree(work_dir)
+    raw_path = os.path.join(work_dir, 'raw')
+    dataset_path = os.path.join(work_dir, 'Dataset999_Synthetic')
+    shape = (size, size, size)
+    results = {}
+
+    results['generate_cases'] = measure(lambda: write_raw_dataset(raw_path, n_cases, shape), n_cases,
+                                        reset=_removing(raw_path))
+    raw_bytes = sum(folder_bytes(os.path.join(raw_path, c)) for c in os.listdir(raw_path))
+
+    results['data_prepare_copy'] = measure(lambda: data_prepare(raw_path, dataset_path), n_cases, raw_bytes,
+                                           reset=_removing(dataset_path))
+    linked_path = dataset_path + '_linked'
+    results['data_prepare_parallel_link'] = measure(
+        lambda: data_prepare(raw_path, linked_path, num_workers=4, link_mode='auto'), n_cases, raw_bytes,
+        reset=_removing(linked_path))
+    results['copy_plans_json'] = measure(
+        lambda: copy_plans_json(os.path.join(REPO_ROOT, 'dataset.json'), dataset_path, n_cases), 1)
+
+    labels_path = os.path.join(dataset_path, 'labelsTr')
+    label_bytes = folder_bytes(labels_path)
+    results['remove_additional_label'] = measure(
+        lambda: remove_additional_label(labels_path, os.path.join(work_dir, 'labels_clean'), 4), n_cases, label_bytes)
+    results['remove_additional_label_parallel'] = measure(
+        lambda: remove_additional_label(labels_path, os.path.join(work_dir, 'labels_clean_parallel'), 4, num_workers=4),
+        n_cases, label_bytes)
+    results['evaluate_folders'] = measure(
+        lambda: evaluate_folders(os.path.join(work_dir, 'labels_clean'), labels_path, os.path.join(REPO_ROOT, 'dataset.json'),
+                                 os.path.join(work_dir, 'evaluation.csv'), num_workers=4), n_cases, label_bytes)
+
+    images_path = os.path.join(dataset_path, 'imagesTr')
+    image_files = [os.path.join(images_path, f) for f in path_contents_pattern(images_path, '.nii.gz')]
+    image_bytes = folder_bytes(images_path)
+    results['read_nifti'] = measure(lambda: [read_nifti(f) for f in image_files], len(image_files), image_bytes)
+    results['read_nifti_view'] = measure(lambda: [read_nifti(f, as_view=True) for f in image_files],
+                                         len(image_files), image_bytes)
+    results['read_nifti_header'] = measure(lambda: [read_nifti_header(f) for f in image_files], len(image_files))
+
+    volume, _, _, spacing, origin, direction = read_nifti(image_files[0])
+    write_path = os.path.join(work_dir, 'written')
+    create_path(write_path)
+    for name, options in (('write_nifti_gzip_default', {}),
+                          ('write_nifti_gzip_level1', {'compression_level': 1}),
+                          ('write_nifti_gzip_parallel', {'backend': 'parallel', 'compression_level': 1}),
+                          ('write_nifti_uncompressed', {'compress': False})):
+        results[name] = measure(
+            lambda: [write_nifti_from_vol(volume, origin, spacing, direction,
+                                          os.path.join(write_path, '{}_{}'.format(name, i)), **options)
+                     for i in range(4)], 4, volume.nbytes * 4)
+
+    probabilities = synthetic_probabilities(synthetic_case(shape, 0)[1])
+    probabilities_path = os.path.join(work_dir, 'probabilities')
+    create_path(probabilities_path)
+    for dtype in ('uint8', 'float16'):
+        report = compare_with_npz(probabilities, os.path.join(probabilities_path, dtype), dtype)
+        results['probabilities_npz'] = {'seconds': report['npz_seconds'], 'bytes': report['npz_bytes']}
+        results['probabilities_' + dtype] = {'seconds': report['seconds'], 'bytes': report['bytes'],
+                                             'seconds_saved': report['seconds_saved'], 'bytes_saved': report['bytes_saved']}
+
+    dicom_path = os.path.join(work_dir, 'dicom')
+    write_dicom_dataset(dicom_path, n_cases, (size // 2, size, size))
+    dicom_bytes = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(dicom_path) for f in files)
+    results['dicom_ingest'] = measure(
+        lambda: ingest_dicom(dicom_path, os.path.join(work_dir, 'dicom_nifti'), num_workers=4), n_cases, dicom_bytes,
+        reset=_removing(os.path.join(work_dir, 'dicom_nifti')))
+
+    if with_inference:
+        results.update(run_inference_benchmarks(work_dir, images_path, n_cases))
+    if with_training:
+        results.update(run_finetune_folds_smoke(work_dir))
+    return results
+
+
+def run_inference_benchmarks(work_dir, images_path, n_cases):
+    """
+    CPU smoke run of the predictor session with a tiny untrained network.
+    """
+    import torch
+    from nnunet_session import PredictorSession, set_cpu_threads
+
+    model_folder = write_tiny_model(os.path.join(work_dir, 'tiny_model'), os.path.join(REPO_ROOT, 'dataset.json'))
+    set_cpu_threads()
+    results = {}
+    holder = {}
+    results['inference_load_model'] = measure(
+        lambda: holder.setdefault('session', PredictorSession(model_folder, (0,), 'checkpoint_final.pth',
+                                                              torch.device('cpu'))), 1)
+    session = holder['session']
+    from nnunet_weights import extract_weights
+    report = extract_weights(os.path.join(model_folder, 'fold_0', 'checkpoint_final.pth'))
+    results['checkpoint_load_torch'] = {'seconds': report['checkpoint_load_seconds'], 'bytes': report['checkpoint_bytes']}
+    results['checkpoint_load_mmap'] = {'seconds': report['weights_load_seconds'], 'bytes': report['weights_bytes']}
+    results['inference_load_model_slim'] = measure(
+        lambda: PredictorSession(model_folder, (0,), 'checkpoint_final.safetensors', torch.device('cpu')), 1)
+    for preset in ('fast', 'accurate'):
+        session.configure(preset)
+        output_folder = os.path.join(work_dir, 'predictions_' + preset)
+        results['inference_cpu_' + preset] = measure(
+            lambda: session.predict_files(images_path, output_folder, overwrite=True,
+                                          num_processes_preprocessing=1, num_processes_segmentation_export=1), n_cases)
+
+    # in-memory prediction of one case on the full volume and on the nonzero bounding box
+    from nnunet_arrays import case_from_images, predict_cropped
+    first_case = sorted(path_contents_pattern(images_path, '_0000.nii.gz'))[0][:-len('_0000.nii.gz')]
+    image, properties = case_from_images([read_nifti(os.path.join(images_path, '{}_{:04d}.nii.gz'.format(first_case, c)))[1]
+                                          for c in range(4)])
+    results['inference_cpu_array_full'] = measure(lambda: session.predict_array(image, properties), 1, image.nbytes)
+    results['inference_cpu_array_cropped'] = measure(lambda: predict_cropped(session, image, properties), 1, image.nbytes)
+    _, report = predict_cropped(session, image, properties, compare_full=True)
+    results['inference_cpu_array_cropped'].update({key: report[key] for key in ('bytes_saved', 'crop_seconds', 'seconds_saved')})
+    return results
+
+
+def _finetune_folds_smoke(smoke_dir, folds, num_epochs, kill_fold):
+    # runs in a spawned process, started after the nnUNet_* paths of smoke_dir were put in the environment,
+    # so that nnunetv2.paths picks them up on import
+    import threading
+    from nnunetv2.experiment_planning.plan_and_preprocess_api import extract_fingerprint_dataset
+    from nnunetv2.experiment_planning.dataset_fingerprint.fingerprint_extractor import DatasetFingerprintExtractor
+    from nnunetv2.preprocessing.preprocessors.default_preprocessor import DefaultPreprocessor
+    from nnunetv2.paths import nnUNet_raw, nnUNet_preprocessed
+    from benchmarks.synthetic_cases import tiny_plans
+    from nnunet_folds import finetune_folds, fold_output_folder
+    from nnunet_training import TrainingOptions
+
+    dataset_json_path = os.path.join(nnUNet_raw, FOLDS_SMOKE_DATASET, 'dataset.json')
+    extract_fingerprint_dataset(int(FOLDS_SMOKE_DATASET[7:10]), DatasetFingerprintExtractor, num_processes=2,
+                                check_dataset_integrity=False, clean=True, verbose=False)
+    preprocessed_path = os.path.join(nnUNet_preprocessed, FOLDS_SMOKE_DATASET)
+    write_json(os.path.join(preprocessed_path, 'nnUNetPlans.json'), tiny_plans(FOLDS_SMOKE_DATASET))
+    shutil.copy(dataset_json_path, os.path.join(preprocessed_path, 'dataset.json'))
+    DefaultPreprocessor(verbose=False).run(FOLDS_SMOKE_DATASET, '3d_fullres', 'nnUNetPlans', num_processes=2)
+    pretrained = write_tiny_model(os.path.join(smoke_dir, 'pretrained'), dataset_json_path, FOLDS_SMOKE_DATASET)
+
+    # kill the worker of kill_fold once it wrote its first checkpoint, so that it is restarted from it
+    checkpoint = os.path.join(fold_output_folder(FOLDS_SMOKE_DATASET, 'nnUNetTrainer', 'nnUNetPlans', '3d_fullres',
+                                                 kill_fold), 'checkpoint_latest.pth')
+    killed, finished = [], threading.Event()
+
+    def kill_after_checkpoint():
+        while not killed and not finished.is_set():
+            worker = next((p for p in multiprocessing.active_children() if p.name == 'fold_{}'.format(kill_fold)), None)
+            if worker is not None and os.path.isfile(checkpoint) and time.time() - os.path.getmtime(checkpoint) > 0.5:
+                worker.kill()
+                killed.append(kill_fold)
+            time.sleep(0.1)
+
+    killer = threading.Thread(target=kill_after_checkpoint, daemon=True)
+    killer.start()
+    options = TrainingOptions(num_processes_augmentation=0, num_iterations_per_epoch=10,
+                              num_val_iterations_per_epoch=2, compile=False, save_every=1)
+    try:
+        status = finetune_folds(int(FOLDS_SMOKE_DATASET[7:10]), '3d_fullres', list(folds),
+                                os.path.join(pretrained, 'fold_0', 'checkpoint_final.pth'), 'nnUNetPlans',
+                                num_epochs=num_epochs, initial_lr=1e-3, devices=['cpu', 'cpu'], num_threads=2,
+                                training_options=options, max_restarts=1, poll_interval=1.0,
+                                status_file=os.path.join(smoke_dir, 'finetune_folds_status.json'))
+    finally:
+        finished.set()
+    write_json(os.path.join(smoke_dir, 'smoke_result.json'), {'killed': killed, 'folds': status})
+
+
+def run_finetune_folds_smoke(work_dir, n_cases=6, size=64, folds=(0, 1), num_epochs=2, kill_fold=0):
+    """
+    CPU smoke run of nnunet_folds.finetune_folds: fine-tune the tiny network on synthetic preprocessed data,
+    two folds for num_epochs epochs on two CPU workers, killing the worker of kill_fold after its first
+    checkpoint so that it is restarted from it. nnU-Net reads its paths on import, so everything runs in a
+    spawned process started with the nnUNet_* variables of the scratch folder. Raises if a fold failed.
+    """
+    smoke_dir = os.path.join(work_dir, 'finetune_folds')
+    paths = {name: os.path.join(smoke_dir, name) for name in NNUNET_PATH_VARIABLES}
+    # 5-fold cross-validation splits need at least 5 cases
+    raw_path = os.path.join(smoke_dir, 'brats')
+    write_raw_dataset(raw_path, n_cases, (size, size, size), seed=100)
+    dataset_path = os.path.join(paths['nnUNet_raw'], FOLDS_SMOKE_DATASET)
+    data_prepare(raw_path, dataset_path)
+    copy_plans_json(os.path.join(REPO_ROOT, 'dataset.json'), dataset_path, n_cases)
+    for path in paths.values():
+        create_path(path)
+
+    old_environment = {name: os.environ.get(name) for name in NNUNET_PATH_VARIABLES}
+    os.environ.update(paths)
+    try:
+        process = multiprocessing.get_context('spawn').Process(
+            target=_finetune_folds_smoke, args=(smoke_dir, folds, num_epochs, kill_fold))
+        # timed once, the training runs in child processes whose memory measure() would not see
+        start = time.perf_counter()
+        process.start()
+        process.join()
+        seconds = time.perf_counter() - start
+        result = {'seconds': seconds, 'items_per_second': len(folds) * num_epochs / seconds}
+    finally:
+        for name, value in old_environment.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+    if process.exitcode != 0:
+        raise RuntimeError('finetune_folds smoke run exited with code {}'.format(process.exitcode))
+    smoke = read_json(os.path.join(smoke_dir, 'smoke_result.json'))
+    failed = [fold for fold, status in smoke['folds'].items() if status['state'] != 'done']
+    if failed:
+        raise RuntimeError('finetune_folds smoke run: folds {} failed'.format(failed))
+    restarted = [fold for fold, status in smoke['folds'].items() if status['attempts'] > 1]
+    if not smoke['killed']:
+        print('finetune_folds smoke run: fold {} finished before it could be killed, '
+              'the restart was not exercised'.format(kill_fold))
+    result.update({'killed': smoke['killed'], 'restarted_folds': restarted})
+    return {'finetune_folds_cpu': result}
+
+
+def environment():
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+            'commit': subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                                     text=True).stdout.strip() or None,
+            'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource else None}
+
+
+MEMORY_KEYS = ('peak_rss_increase_bytes', 'peak_traced_memory_bytes')
+
+
+def compare(results, baseline, tolerance=0.2, memory_tolerance=0.2, memory_floor_bytes=4 * 1024 ** 2):
+    """
+    print the time and memory ratio of every benchmark against a baseline, return the regressed ones.
+    memory only counts as regressed when it also grew by more than memory_floor_bytes, so that small
+    allocations do not trip the check.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['seconds'] / max(baseline[name]['seconds'], 1e-9)
+        flags = []
+        if ratio > 1 + tolerance:
+            flags.append('slower')
+        memory = ''
+        for key in MEMORY_KEYS:
+            new, old = result.get(key), baseline[name].get(key)
+            if new is None or old is None:
+                continue
+            memory += '  {} x{:.2f}'.format(key.split('_')[1], new / max(old, 1))
+            if new > old * (1 + memory_tolerance) and new - old > memory_floor_bytes:
+                flags.append('more ' + key.split('_')[1] + ' memory')
+        if flags:
+            regressions.append(name)
+        print('{:40s} {:9.3f} s  x{:.2f}{}{}'.format(name, result['seconds'], ratio, memory,
+                                                   '  <-- ' + ', '.join(flags) if flags else ''))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmarks on synthetic BraTS-like data')
+    parser.add_argument('-o', '--work_dir', required=True, help='scratch folder, it is deleted and recreated')
+    parser.add_argument('--cases', type=int, default=4)
+    parser.add_argument('--size', type=int, default=64, help='edge length of the cubic volumes')
+    parser.add_argument('--no_inference', action='store_true', help='skip the CPU inference smoke run')
+    parser.add_argument('--no_training', action='store_true', help='skip the CPU multi-fold fine-tuning smoke run')
+    parser.add_argument('--save', default=None, help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=None, help='compare against a previous result file')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against the baseline')
+    parser.add_argument('--memory_tolerance', type=float, default=0.2,
+                        help='allowed growth of the peak memory against the baseline')
+    args = parser.parse_args()
+
+    results = run_suite(args.work_dir, args.cases, args.size, not args.no_inference, not args.no_training)
+    report = {'environment': environment(), 'settings': {'cases': args.cases, 'size': args.size},
+              'results': results}
+    if args.save:
+        write_json(args.save, report)
+    if args.baseline:
+        regressed = compare(results, read_json(args.baseline)['results'], args.tolerance, args.memory_tolerance)
+        if regressed:
+            print('regressions: {}'.format(regressed))
+            sys.exit(1)
+    else:
+        for name, result in results.items():
+            print('{:40s} {:9.3f} s'.format(name, result['seconds']))
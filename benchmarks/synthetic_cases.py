@@ -0,0 +1,235 @@
+"""
+Synthetic BraTS-like cases and a tiny untrained nnU-Net model for offline benchmarks.
+"""
+import os
+import numpy as np
+import SimpleITK as itk
+from tools.writer import write_nifti_from_vol
+from tools.json_pickle_stuff import read_json, write_json
+from tools.paths_dirs_stuff import create_path
+
+BRATS_SEQUENCES = ('t1n', 't1c', 't2w', 't2f')
+
+
+def synthetic_case(shape=(64, 64, 64), seed=0, with_context_label=True):
+    """
+    a brain-like ellipsoid with a three-label tumour (necrosis 1, edema 2, enhancing 3)
+    and, optionally, a context label 4 at the brain border.
+
+    Returns
+    -------
+    channels : list
+        four float32 volumes (z, y, x).
+    seg : numpy array
+        uint8 label volume.
+    """
+    rng = np.random.default_rng(seed)
+    grid = np.stack(np.meshgrid(*[np.linspace(-1, 1, s) for s in shape], indexing='ij'))
+    brain = (grid ** 2).sum(0) < 0.8
+    center = rng.uniform(-0.3, 0.3, 3)
+    radius = np.sqrt(((grid - center[:, None, None, None]) ** 2).sum(0))
+    seg = np.zeros(shape, dtype=np.uint8)
+    seg[brain & (radius < 0.35)] = 2
+    seg[brain & (radius < 0.22)] = 3
+    seg[brain & (radius < 0.12)] = 1
+    if with_context_label:
+        seg[brain & ((grid ** 2).sum(0) > 0.75)] = 4
+    channels = []
+    for ix in range(len(BRATS_SEQUENCES)):
+        contrast = rng.uniform(0.5, 1.5, 5)
+        volume = brain * contrast[0] * 100 + contrast[seg] * 50 * (seg > 0)
+        volume = volume + rng.normal(0, 5, shape) * brain
+        channels.append(volume.astype(np.float32))
+    return channels, seg
+
+
+def synthetic_probabilities(seg, n_classes=4, seed=0):
+    """
+    softmax-like (n_classes, z, y, x) float32 probabilities around a label volume: noisy inside the
+    brain, exactly one-hot background outside, like the output of a segmentation network.
+    """
+    rng = np.random.default_rng(seed)
+    one_hot = (np.minimum(seg, n_classes - 1)[None] == np.arange(n_classes)[:, None, None, None]).astype(np.float32)
+    logits = one_hot * 8
+    brain = seg > 0
+    logits[:, brain] += rng.normal(0, 2, (n_classes, int(brain.sum()))).astype(np.float32)
+    probabilities = np.exp(logits - logits.max(0, keepdims=True))
+    probabilities /= probabilities.sum(0, keepdims=True)
+    probabilities[:, ~brain] = one_hot[:, ~brain]
+    return probabilities
+
+
+def write_raw_dataset(raw_path, n_cases=4, shape=(64, 64, 64), spacing=(1.0, 1.0, 1.0), seed=0):
+    """
+    write n_cases synthetic subjects in the BraTS folder layout expected by data_prepare.
+    """
+    origin = (0.0, 0.0, 0.0)
+    direction = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)
+    for case_ix in range(n_cases):
+        case = 'BraTS-SYN-{:05d}-000'.format(case_ix)
+        case_path = os.path.join(raw_path, case)
+        create_path(case_path)
+        channels, seg = synthetic_case(shape, seed + case_ix)
+        for sequence, volume in zip(BRATS_SEQUENCES, channels):
+            write_nifti_from_vol(volume, origin, spacing, direction, os.path.join(case_path, case + '-' + sequence))
+        write_nifti_from_vol(seg, origin, spacing, direction, os.path.join(case_path, case + '-seg'))
+    return None
+
+
+# series descriptions of the synthetic DICOM studies, matched by tools.dicom_ingest.BRATS_SERIES_RULES
+DICOM_DESCRIPTIONS = {'t1n': 'AX T1 SE', 't1c': 'AX T1 +C GD', 't2w': 'AX T2 FSE', 't2f': 'AX T2 FLAIR'}
+SYNTHETIC_UID_ROOT = '1.2.826.0.1.3680043.2.1125.9'
+
+
+def write_dicom_series(volume, series_folder, patient_id, study_uid, series_uid, series_description,
+                       spacing=(1.0, 1.0, 1.0), seed=0):
+    """
+    write a (z, y, x) volume as a 16-bit MR DICOM series, one file per slice, with shuffled file names
+    so that the slice order has to be recovered from the headers.
+    """
+    create_path(series_folder)
+    img_itk = itk.GetImageFromArray(volume.astype(np.int16))
+    img_itk.SetSpacing(spacing)
+    writer = itk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    order = np.random.default_rng(seed).permutation(volume.shape[0])
+    for z in range(volume.shape[0]):
+        slice_itk = img_itk[:, :, z]
+        tags = {'0008|0060': 'MR', '0010|0020': patient_id, '0010|0010': patient_id, '0008|0020': '20240101',
+                '0020|000d': study_uid, '0020|000e': series_uid, '0008|103e': series_description,
+                '0008|0018': '{}.{}'.format(series_uid, z + 1), '0020|0013': str(z + 1),
+                '0020|0037': '1\\0\\0\\0\\1\\0',
+                '0020|0032': '\\'.join(str(v) for v in img_itk.TransformIndexToPhysicalPoint((0, 0, z))),
+                '0018|0050': str(spacing[2])}
+        for tag, value in tags.items():
+            slice_itk.SetMetaData(tag, value)
+        writer.SetFileName(os.path.join(series_folder, 'IM{:05d}.dcm'.format(order[z])))
+        writer.Execute(slice_itk)
+    return series_folder
+
+
+def write_dicom_dataset(dicom_root, n_cases=2, shape=(32, 64, 64), seed=0, with_extra_series=True):
+    """
+    write n_cases synthetic studies with the four BraTS sequences as DICOM series in a
+    PATIENT/STUDY/SERIES folder tree, plus an unrelated localizer series per study.
+    """
+    for case_ix in range(n_cases):
+        patient_id = 'SYN{:04d}'.format(case_ix)
+        study_uid = '{}.{}'.format(SYNTHETIC_UID_ROOT, case_ix + 1)
+        channels, _ = synthetic_case(shape, seed + case_ix, with_context_label=False)
+        descriptions = [DICOM_DESCRIPTIONS[sequence] for sequence in BRATS_SEQUENCES]
+        volumes = list(channels)
+        if with_extra_series:
+            descriptions.append('3PLANE LOC')
+            volumes.append(channels[0][:3])
+        for series_ix, (description, volume) in enumerate(zip(descriptions, volumes)):
+            series_uid = '{}.{}'.format(study_uid, series_ix + 1)
+            write_dicom_series(volume, os.path.join(dicom_root, patient_id, 'study1', 'series{}'.format(series_ix + 1)),
+                               patient_id, study_uid, series_uid, description, seed=seed + series_ix)
+    return None
+
+
+def _tiny_architecture(n_stages=3):
+    return {
+        'network_class_name': 'dynamic_network_architectures.architectures.unet.PlainConvUNet',
+        'arch_kwargs': {
+            'n_stages': n_stages,
+            'features_per_stage': [4 * 2 ** i for i in range(n_stages)],
+            'conv_op': 'torch.nn.modules.conv.Conv3d',
+            'kernel_sizes': [[3, 3, 3]] * n_stages,
+            'strides': [[1, 1, 1]] + [[2, 2, 2]] * (n_stages - 1),
+            'n_conv_per_stage': [1] * n_stages,
+            'n_conv_per_stage_decoder': [1] * (n_stages - 1),
+            'conv_bias': True,
+            'norm_op': 'torch.nn.modules.instancenorm.InstanceNorm3d',
+            'norm_op_kwargs': {'eps': 1e-05, 'affine': True},
+            'dropout_op': None,
+            'dropout_op_kwargs': None,
+            'nonlin': 'torch.nn.LeakyReLU',
+            'nonlin_kwargs': {'inplace': True},
+        },
+        '_kw_requires_import': ['conv_op', 'norm_op', 'dropout_op', 'nonlin'],
+    }
+
+
+def tiny_plans(dataset_name, patch_size=(32, 32, 32), spacing=(1.0, 1.0, 1.0), image_shape=(64, 64, 64),
+               plans_name='nnUNetPlans'):
+    """
+    nnU-Net plans with a single '3d_fullres' configuration using a tiny PlainConvUNet.
+    """
+    resampling_kwargs = {'is_seg': False, 'order': 3, 'order_z': 0, 'force_separate_z': None}
+    intensity = {'max': 300.0, 'mean': 120.0, 'median': 120.0, 'min': 0.0,
+                 'percentile_00_5': 10.0, 'percentile_99_5': 250.0, 'std': 40.0}
+    configuration = {
+        'data_identifier': plans_name + '_3d_fullres',
+        'preprocessor_name': 'DefaultPreprocessor',
+        'batch_size': 2,
+        'patch_size': list(patch_size),
+        'median_image_size_in_voxels': list(image_shape),
+        'spacing': list(spacing),
+        'normalization_schemes': ['ZScoreNormalization'] * len(BRATS_SEQUENCES),
+        'use_mask_for_norm': [True] * len(BRATS_SEQUENCES),
+        'resampling_fn_data': 'resample_data_or_seg_to_shape',
+        'resampling_fn_seg': 'resample_data_or_seg_to_shape',
+        'resampling_fn_data_kwargs': resampling_kwargs,
+        'resampling_fn_seg_kwargs': dict(resampling_kwargs, is_seg=True, order=1),
+        'resampling_fn_probabilities': 'resample_data_or_seg_to_shape',
+        'resampling_fn_probabilities_kwargs': dict(resampling_kwargs, order=1),
+        'architecture': _tiny_architecture(),
+        'batch_dice': False,
+    }
+    return {
+        'dataset_name': dataset_name,
+        'plans_name': plans_name,
+        'original_median_spacing_after_transp': list(spacing),
+        'original_median_shape_after_transp': list(image_shape),
+        'image_reader_writer': 'SimpleITKIO',
+        'transpose_forward': [0, 1, 2],
+        'transpose_backward': [0, 1, 2],
+        'configurations': {'3d_fullres': configuration},
+        'experiment_planner_used': 'ExperimentPlanner',
+        'label_manager': 'LabelManager',
+        'foreground_intensity_properties_per_channel': {str(i): intensity for i in range(len(BRATS_SEQUENCES))},
+    }
+
+
+def write_tiny_model(model_folder, dataset_json_path, dataset_name='Dataset999_Synthetic', fold=0, seed=0):
+    """
+    write an untrained tiny nnU-Net model folder (dataset.json, plans.json and
+    fold_X/checkpoint_final.pth) that NnUnetApi sessions can load on CPU.
+    """
+    import torch
+    from nnunetv2.training.nnUNetTrainer.nnUNetTrainer import nnUNetTrainer
+    from nnunetv2.utilities.plans_handling.plans_handler import PlansManager
+
+    create_path(os.path.join(model_folder, 'fold_{}'.format(fold)))
+    dataset_json = read_json(dataset_json_path)
+    plans = tiny_plans(dataset_name)
+    write_json(os.path.join(model_folder, 'dataset.json'), dataset_json)
+    write_json(os.path.join(model_folder, 'plans.json'), plans)
+
+    plans_manager = PlansManager(plans)
+    configuration_manager = plans_manager.get_configuration('3d_fullres')
+    label_manager = plans_manager.get_label_manager(dataset_json)
+    torch.manual_seed(seed)
+    network = nnUNetTrainer.build_network_architecture(configuration_manager.network_arch_class_name,
+                                                       configuration_manager.network_arch_init_kwargs,
+                                                       configuration_manager.network_arch_init_kwargs_req_import,
+                                                       len(dataset_json['channel_names']),
+                                                       label_manager.num_segmentation_heads,
+                                                       enable_deep_supervision=False)
+    # SGD momentum buffers like the optimizer state of a real nnU-Net checkpoint
+    optimizer = torch.optim.SGD(network.parameters(), lr=1e-2, momentum=0.99, nesterov=True)
+    for parameter in network.parameters():
+        parameter.grad = torch.zeros_like(parameter)
+    optimizer.step()
+    checkpoint = {'network_weights': network.state_dict(),
+                  'optimizer_state': optimizer.state_dict(),
+                  'grad_scaler_state': None,
+                  'current_epoch': 0,
+                  'init_args': {'plans': plans, 'configuration': '3d_fullres', 'fold': fold,
+                                'dataset_json': dataset_json},
+                  'trainer_name': 'nnUNetTrainer',
+                  'inference_allowed_mirroring_axes': (0, 1, 2)}
+    torch.save(checkpoint, os.path.join(model_folder, 'fold_{}'.format(fold), 'checkpoint_final.pth'))
+    return model_folder
@@ -1,10 +1,9 @@
 import os
-import torch
 import shutil
 from nnunet_api import NnUnetApi
 from tools.data_reformat import data_prepare
 from tools.json_pickle_stuff import copy_plans_json
-from nnunetv2.paths import nnUNet_preprocessed, nnUNet_results, nnUNet_raw
+from nnunetv2.paths import nnUNet_preprocessed, nnUNet_raw
 
 # =================================================================================
 # 1. Configuration
@@ -30,6 +29,9 @@ FINETUNE_PLANS_ID = 'nnUNetPlans_finetune_from_brats'
 # This file contains the weights that will be used to initialize your new model.
 PRETRAINED_CHECKPOINT_PATH = '<nnUNet_results>/Dataset770_BraTSGLIPreCropRegion/nnUNetTrainer__nnUNetResEncUNetPlans__3d_fullres/fold_0/checkpoint_final.pth'
 
+# Number of subjects reformatted in parallel during data preparation
+N_WORKERS_PREPARE = 4
+
 # The GPU device to use for training.
 # DEVICE = torch.device('cuda')
 
@@ -48,6 +50,8 @@ INPUT_FOLDER_INFER = 'PATH_TO_TESTING_DATA'
 # ABS Path to the folder where the results of inference will be saved
 OUTPUT_FOLDER_INFER_FINETUNE = 'PATH_TO_SAVE_RESULTS_FINETUNE'
 OUTPUT_FOLDER_INFER_PRETRAINED = 'PATH_TO_SAVE_RESULTS_PRETRAINED'
+# ABS Path to the folder where the comparison report of the two models will be saved
+OUTPUT_FOLDER_INFER_COMPARISON = 'PATH_TO_SAVE_COMPARISON'
 
 
 if __name__ == '__main__':
@@ -62,7 +66,7 @@ if __name__ == '__main__':
     # ## --- Step 00: Preparing the raw dataset into Decathlon format
     print("\nStep 0: Running Data Preparation script...")
     DST_DATA_NAME = "Dataset"+str(FINETUNE_DATASET_ID)+"_finetune"
-    data_prepare(RAW_DATA_PATH, os.path.join(nnUNet_raw, DST_DATA_NAME))
+    data_prepare(RAW_DATA_PATH, os.path.join(nnUNet_raw, DST_DATA_NAME), num_workers=N_WORKERS_PREPARE, link_mode='auto')
     n_case=len(os.listdir(os.path.join(nnUNet_raw, DST_DATA_NAME,"labelsTr")))
     copy_plans_json("./dataset.json", os.path.join(nnUNet_raw, DST_DATA_NAME), n_case)
 
@@ -129,27 +133,21 @@ if __name__ == '__main__':
     print("\nFine-tuning process has been started!")
 
 
-    # --- Step 5: Run the inference of the newly fine tunned model ---
-    # This wraps:
-    print(f"Step 5: Infering fine-tuned model on a testing dataset")
-    api.predict(
+    # --- Step 5: Run the inference of the newly fine tunned and the original pretrained model ---
+    # Both models run in one pass over the testing data: every case is read and preprocessed once, the
+    # segmentations of each model are written to its own folder and the Dice between the two models and
+    # the timings of every case are saved to OUTPUT_FOLDER_INFER_COMPARISON/model_comparison.json
+    print("Step 5: Infering fine-tuned and pretrained models on a testing dataset")
+    api.predict_models(
         input_folder=INPUT_FOLDER_INFER,
-        output_folder=OUTPUT_FOLDER_INFER_FINETUNE,
-        dataset_name_or_id=DST_DATA_NAME,
-        plans_identifier=FINETUNE_PLANS_ID,
-        configuration='3d_fullres',
-        folds=[FOLD]
+        output_folder=OUTPUT_FOLDER_INFER_COMPARISON,
+        models={
+            'finetuned': {'dataset_name_or_id': DST_DATA_NAME, 'plans_identifier': FINETUNE_PLANS_ID,
+                          'configuration': '3d_fullres', 'folds': [FOLD],
+                          'output_folder': OUTPUT_FOLDER_INFER_FINETUNE},
+            'pretrained': {'dataset_name_or_id': "Dataset770_BraTSGLIPreCropRegion",
+                           'plans_identifier': "nnUNetResEncUNetPlans",
+                           'configuration': '3d_fullres', 'folds': [FOLD],
+                           'output_folder': OUTPUT_FOLDER_INFER_PRETRAINED},
+        }
     )
-
-
-    ## --- Step 5+: Run the inference of the original pretrained model ---
-    ## This wraps:
-    print(f"Step 5: Infering pretrained model on a testing dataset")
-    api.predict(
-        input_folder=INPUT_FOLDER_INFER,
-        output_folder=OUTPUT_FOLDER_INFER_PRETRAINED,
-        dataset_name_or_id="Dataset770_BraTSGLIPreCropRegion",
-        plans_identifier="nnUNetResEncUNetPlans",
-        configuration='3d_fullres',
-        folds=[FOLD]
-    )
\ No newline at end of file
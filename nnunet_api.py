@@ -1,122 +1,389 @@
-import sys
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 import torch
 from torch.backends import cudnn
-from nnunetv2.run.run_training import run_training
-from nnunetv2.paths import nnUNet_preprocessed, nnUNet_results
-from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.paths import nnUNet_preprocessed, nnUNet_results, nnUNet_raw
+from nnunetv2.utilities.dataset_name_id_conversion import maybe_convert_to_dataset_name, convert_dataset_name_to_id
 from nnunetv2.run.run_training import get_trainer_from_args, maybe_load_checkpoint
-from batchgenerators.utilities.file_and_folder_operations import join, subfiles, load_json
-from nnunetv2.experiment_planning.plan_and_preprocess_entrypoints import extract_fingerprint_entry, preprocess_entry
-from nnunetv2.experiment_planning.plans_for_pretraining.move_plans_between_datasets import entry_point_move_plans_between_datasets
+from batchgenerators.utilities.file_and_folder_operations import join, load_json, isfile
+from nnunetv2.configuration import default_num_processes
+from nnunetv2.utilities.plans_handling.plans_handler import PlansManager
+from nnunetv2.experiment_planning.plan_and_preprocess_api import extract_fingerprint_dataset
+from nnunetv2.experiment_planning.plan_and_preprocess_api import preprocess_dataset as nnunet_preprocess_dataset
+from nnunetv2.experiment_planning.dataset_fingerprint.fingerprint_extractor import DatasetFingerprintExtractor
+from nnunetv2.experiment_planning.verify_dataset_integrity import verify_dataset_integrity as verify_dataset_integrity_fn
+from nnunetv2.experiment_planning.plans_for_pretraining.move_plans_between_datasets import move_plans_between_datasets
+from nnunet_session import PredictorSession, SessionCache, set_cpu_threads
+from nnunet_streaming import StreamingPredictor, watch_folder, iter_queue
+from nnunet_sharding import predict_sharded
+from nnunet_incremental import update_fingerprint, preprocess_incremental
+from nnunet_arrays import IDENTITY_DIRECTION, case_from_arrays, case_from_images, segmentation_to_itk, predict_cropped
+from nnunet_ensemble import ModelComparison, ENSEMBLE_NAME, REPORT_NAME as COMPARISON_REPORT_NAME
+from nnunet_weights import WEIGHTS_SUFFIX, extract_weights, load_pretrained_weights
+from nnunet_folds import finetune_folds
+from nnunet_training import TrainingOptions, training_options_applied, configure_trainer, benchmark_dataloader
+from tools.case_index import case_lists_from_folder
+from tools.sitk_stuff import get_dicom_series
+from tools.probability_store import PROBABILITY_DTYPES
+from tools.geometry_index import build_geometry_index, index_digest
+from tools.profiling import profiled
+
+# worker processes per configuration used by nnUNetv2_preprocess when -np is not given
+DEFAULT_PREPROCESSING_PROCESSES = {'2d': 8, '3d_fullres': 4, '3d_lowres': 8}
+
 
 class NnUnetApi:
-    def train(self, dataset_name_or_id, configuration, fold, trainer_class_name='nnUNetTrainer', plans_identifier='nnUNetPlans', device=torch.device('cuda')):
-        # This function is a direct Python entry point, so we can call it normally.
-        run_training(str(dataset_name_or_id), configuration, fold, trainer_class_name, plans_identifier, requested_device=device)
-
-    def predict(self, input_folder, output_folder, dataset_name_or_id, configuration, folds=(0,), checkpoint_name='checkpoint_final.pth', plans_identifier='nnUNetPlans'):
-        # This is a class, so we instantiate and use it.
-        predictor = nnUNetPredictor(
-            tile_step_size=0.5,
-            use_gaussian=True,
-            use_mirroring=True,
-            perform_everything_on_device=True,
-            device=torch.device('cuda', 0),
-            verbose=False,
-            verbose_preprocessing=False,
-            allow_tqdm=True
-        )
-        
+    def __init__(self, session_memory_budget=4 * 1024 ** 3):
+        # Trained models stay loaded between predict calls, bounded by session_memory_budget (bytes of weights).
+        self.sessions = SessionCache(session_memory_budget)
+
+    @profiled('train')
+    def train(self, dataset_name_or_id, configuration, fold, trainer_class_name='nnUNetTrainer', plans_identifier='nnUNetPlans',
+              device=torch.device('cuda'), training_options: TrainingOptions = None):
+        # Same steps as nnU-Net's run_training, with the throughput settings of training_options applied.
+        with training_options_applied(training_options):
+            nnunet_trainer = get_trainer_from_args(str(dataset_name_or_id), configuration, fold, trainer_class_name,
+                                                   plans_identifier, device=device)
+            configure_trainer(nnunet_trainer, training_options)
+            maybe_load_checkpoint(nnunet_trainer, continue_training=False, validation_only=False,
+                                  pretrained_weights_file=None)
+            if torch.cuda.is_available():
+                cudnn.deterministic = False
+                cudnn.benchmark = True
+            nnunet_trainer.run_training()
+            nnunet_trainer.perform_actual_validation(False)
+
+    def model_folder(self, dataset_name_or_id, configuration, plans_identifier='nnUNetPlans'):
         # The model folder path is constructed using the plans_identifier.
-        model_folder = join(nnUNet_results, str(dataset_name_or_id), f'nnUNetTrainer__{plans_identifier}__{configuration}')
-        
-        predictor.initialize_from_trained_model_folder(
-            model_folder,
-            use_folds=folds,
-            checkpoint_name=checkpoint_name,
-        )
-        
-        # Create a list of lists, where each sub-list contains all modalities of a single case
-        input_files = subfiles(input_folder, suffix=predictor.dataset_json['file_ending'], join=False, sort=True)
-        case_identifiers = sorted(list(set([i[:-len(predictor.dataset_json['file_ending']) - 5] for i in input_files])))
-        list_of_lists_of_files = []
-        for c in case_identifiers:
-            files_for_case = [join(input_folder, i) for i in input_files if i.startswith(c)]
-            list_of_lists_of_files.append(files_for_case)
+        return join(nnUNet_results, str(dataset_name_or_id), f'nnUNetTrainer__{plans_identifier}__{configuration}')
+
+    def get_session(self, dataset_name_or_id, configuration, folds=(0,), checkpoint_name='checkpoint_final.pth', plans_identifier='nnUNetPlans', device=torch.device('cuda', 0)):
+        # Returns a PredictorSession with the weights resident, loading them from disk only on the first request.
+        # The session is not pinned: loading another model may close it, use session() while predicting with it.
+        return self.sessions.get(*self._session_entry(dataset_name_or_id, configuration, folds, checkpoint_name,
+                                                      plans_identifier, device))
+
+    def session(self, dataset_name_or_id, configuration, folds=(0,), checkpoint_name='checkpoint_final.pth', plans_identifier='nnUNetPlans', device=torch.device('cuda', 0)):
+        # Same as get_session as a context manager: the cache does not close the session before the with block ends.
+        return self.sessions.session(*self._session_entry(dataset_name_or_id, configuration, folds, checkpoint_name,
+                                                          plans_identifier, device))
+
+    def _session_entry(self, dataset_name_or_id, configuration, folds, checkpoint_name, plans_identifier, device):
+        key = (str(dataset_name_or_id), plans_identifier, configuration, tuple(folds), checkpoint_name, str(device))
+        model_folder = self.model_folder(dataset_name_or_id, configuration, plans_identifier)
+        return (key, lambda: PredictorSession(model_folder, folds, checkpoint_name, device),
+                lambda: PredictorSession.estimate_nbytes(model_folder, folds, checkpoint_name))
+
+    @profiled('predict')
+    def predict(self, input_folder, output_folder, dataset_name_or_id, configuration, folds=(0,), checkpoint_name='checkpoint_final.pth', plans_identifier='nnUNetPlans',
+                device=torch.device('cuda', 0), num_threads=None, num_concurrent_cases=1, preset='accurate', preset_overrides=None,
+                save_probabilities=False):
+        # preset is one of 'fast', 'balanced', 'accurate' (see nnunet_session.INFERENCE_PRESETS); preset_overrides is a dict
+        # that replaces single settings of it, e.g. {'tile_step_size': 0.6}.
+        # On CPU nodes the cores are split between num_concurrent_cases cases (num_threads defaults to all cores).
+        # On GPU nodes each volume keeps its sliding-window results on the device only if they fit.
+        # save_probabilities also writes the probability maps: True for nnU-Net's float32 .npz, 'uint8' or 'float16' for
+        # chunked memory-mappable maps (tools.probability_store), several times smaller and faster to write.
+        if device.type == 'cpu':
+            set_cpu_threads(num_threads, num_concurrent_cases)
+        elif num_threads is not None:
+            torch.set_num_threads(num_threads)
+        # Group the channel files of every case in one pass and report incomplete cases before the model is loaded
+        dataset_json = load_json(join(self.model_folder(dataset_name_or_id, configuration, plans_identifier), 'dataset.json'))
+        case_identifiers, list_of_lists_of_files = case_lists_from_folder(input_folder, dataset_json)
 
+        with self.session(dataset_name_or_id, configuration, folds, checkpoint_name, plans_identifier, device) as session:
+            # create the concurrent predictors first so that the preset reaches all of them
+            session.predictors(num_concurrent_cases)
+            session.configure(preset, preset_overrides)
+
+            print(f"Found {len(list_of_lists_of_files)} cases to predict")
+
+            if save_probabilities in PROBABILITY_DTYPES:
+                # nnU-Net can only export float32 .npz, the compact maps are written by the streaming export stage,
+                # which predicts num_concurrent_cases cases side by side like predict_files
+                streamer = StreamingPredictor(session, output_folder, save_probabilities=save_probabilities,
+                                              num_inference_workers=num_concurrent_cases)
+                for _ in streamer.run(zip(case_identifiers, list_of_lists_of_files)):
+                    pass
+                # failed cases were only skipped by the stream, fail like predict_files does
+                if streamer.failures:
+                    raise RuntimeError(f"{len(streamer.failures)} cases failed: {sorted(streamer.failures)}, "
+                                       f"see the tracebacks above")
+                return
+
+            session.predict_files(
+                list_of_lists_of_files,
+                output_folder,
+                save_probabilities=bool(save_probabilities),
+                overwrite=False,
+                num_processes_preprocessing=2,
+                num_processes_segmentation_export=2,
+                num_concurrent_cases=num_concurrent_cases
+            )
+
+    @profiled('predict_sharded')
+    def predict_sharded(self, input_folder, output_folder, dataset_name_or_id, configuration, folds=(0,), checkpoint_name='checkpoint_final.pth', plans_identifier='nnUNetPlans',
+                        devices=None, num_threads=None, preset='accurate', preset_overrides=None, overwrite=False):
+        # Splits the cases over one worker process per device (default: one per GPU, or two CPU workers without GPU),
+        # balanced by case volume. Returns one report with the progress and failures of all shards.
+        model_folder = self.model_folder(dataset_name_or_id, configuration, plans_identifier)
+        dataset_json = load_json(join(model_folder, 'dataset.json'))
+        case_identifiers, list_of_lists_of_files = case_lists_from_folder(input_folder, dataset_json)
         print(f"Found {len(list_of_lists_of_files)} cases to predict")
+        return predict_sharded(case_identifiers, list_of_lists_of_files, output_folder, model_folder, folds, checkpoint_name,
+                               devices, num_threads, preset, preset_overrides, overwrite, dataset_json['file_ending'])
+
+    @profiled('predict_arrays')
+    def predict_arrays(self, channels, spacing, dataset_name_or_id, configuration, folds=(0,), checkpoint_name='checkpoint_final.pth', plans_identifier='nnUNetPlans',
+                       device=torch.device('cuda', 0), origin=(0.0, 0.0, 0.0), direction=IDENTITY_DIRECTION, preset='accurate', preset_overrides=None,
+                       return_itk=False, crop_to_brain=False, compare_full=False):
+        # Predicts one case held in memory, nothing is written to disk. channels are (Z, Y, X) arrays in the channel order of
+        # dataset.json (or one (C, Z, Y, X) array); spacing, origin and direction follow the itk (x, y, z) convention.
+        # Returns the (Z, Y, X) segmentation, or an itk image with the input geometry if return_itk.
+        # crop_to_brain hands only the bounding box of the nonzero voxels to the predictor (see _predict_case); with
+        # compare_full the full volume is predicted too, to print the time the crop saves.
+        image, properties = case_from_arrays(channels, spacing, origin, direction)
+        return self._predict_case(image, properties, dataset_name_or_id, configuration, folds, checkpoint_name,
+                                  plans_identifier, device, preset, preset_overrides, return_itk, crop_to_brain, compare_full)
+
+    @profiled('predict_dicom')
+    def predict_dicom(self, dicom_series_paths, dataset_name_or_id, configuration, folds=(0,), checkpoint_name='checkpoint_final.pth', plans_identifier='nnUNetPlans',
+                      device=torch.device('cuda', 0), preset='accurate', preset_overrides=None, return_itk=True, orientation=None,
+                      crop_to_brain=False, compare_full=False):
+        # Same as predict_arrays for DICOM series folders, one per channel in the channel order of dataset.json.
+        # Series whose geometry differs from the first one are resampled onto it. With an orientation code (e.g. 'LPS',
+        # the orientation of the training data) all channels are reoriented together before inference.
+        images = [get_dicom_series(path)[0] for path in dicom_series_paths]
+        image, properties = case_from_images(images, orientation)
+        del images
+        return self._predict_case(image, properties, dataset_name_or_id, configuration, folds, checkpoint_name,
+                                  plans_identifier, device, preset, preset_overrides, return_itk, crop_to_brain, compare_full)
+
+    def _predict_case(self, image, properties, dataset_name_or_id, configuration, folds, checkpoint_name, plans_identifier,
+                      device, preset, preset_overrides, return_itk, crop_to_brain=False, compare_full=False):
+        with self.session(dataset_name_or_id, configuration, folds, checkpoint_name, plans_identifier, device) as session:
+            num_channels = len(session.dataset_json['channel_names'])
+            if image.shape[0] != num_channels:
+                raise ValueError(f"The model expects {num_channels} channels, got {image.shape[0]}")
+            session.configure(preset, preset_overrides)
+            if crop_to_brain:
+                # BraTS volumes are mostly zero background: crop before nnU-Net copies, normalizes and tiles the case,
+                # and paste the label map back afterwards
+                segmentation, report = predict_cropped(session, image, properties, compare_full=compare_full)
+                print(f"Cropped to {report['crop_shape']} of {report['full_shape']} ({100 * report['voxel_fraction']:.1f}% of the voxels), "
+                      f"{report['bytes_saved'] / 1024 ** 2:.1f} MB less input, inference {report['seconds']:.1f} s "
+                      f"+ {report['crop_seconds']:.2f} s crop and paste"
+                      + (f", {report['seconds_saved']:.1f} s saved against the full volume" if compare_full else ''))
+            else:
+                segmentation = session.predict_array(image, properties)
+            return segmentation_to_itk(segmentation, properties) if return_itk else segmentation
 
-        predictor.predict_from_files(
-            list_of_lists_of_files,
-            output_folder,
-            save_probabilities=False,
-            overwrite=False,
-            num_processes_preprocessing=2,
-            num_processes_segmentation_export=2,
-            folder_with_segs_from_prev_stage=None,
-            num_parts=1,
-            part_id=0
-        )
+    @profiled('predict_models')
+    def predict_models(self, input_folder, output_folder, models, device=torch.device('cuda', 0), preset='accurate', preset_overrides=None,
+                       write_per_model=True, ensemble=False, overwrite=False, num_export_workers=2):
+        # Runs several models over input_folder in one pass. models maps a name to the arguments of get_session, e.g.
+        #   {'finetuned': {'dataset_name_or_id': 666, 'configuration': '3d_fullres', 'plans_identifier': 'nnUNetPlans_finetune'},
+        #    'pretrained': {'dataset_name_or_id': 770, 'configuration': '3d_fullres', 'plans_identifier': 'nnUNetResEncUNetPlans'}}
+        # plus an optional 'output_folder' (default output_folder/name). Each case is read and preprocessed once per distinct
+        # preprocessing. With write_per_model the segmentations of every model are written; with ensemble the averaged
+        # probabilities are written to output_folder/ensemble. Returns the per-case Dice between models and timings,
+        # also saved to output_folder/model_comparison.json.
+        # all models are pinned for the whole comparison, loading one of them never closes another
+        sessions, output_folders = {}, {}
+        with ExitStack() as pinned:
+            for name, spec in models.items():
+                spec = dict(spec)
+                model_output_folder = spec.pop('output_folder', join(output_folder, name))
+                sessions[name] = pinned.enter_context(self.session(device=device, **spec))
+                sessions[name].configure(preset, preset_overrides)
+                output_folders[name] = model_output_folder if write_per_model else None
+            dataset_json = next(iter(sessions.values())).dataset_json
+            case_identifiers, list_of_lists_of_files = case_lists_from_folder(input_folder, dataset_json)
+            comparison = ModelComparison(sessions, output_folders, join(output_folder, ENSEMBLE_NAME) if ensemble else None,
+                                         num_export_workers, overwrite)
+            return comparison.run(case_identifiers, list_of_lists_of_files, join(output_folder, COMPARISON_REPORT_NAME))
+
+    def predict_stream(self, cases, output_folder, dataset_name_or_id, configuration, folds=(0,), checkpoint_name='checkpoint_final.pth', plans_identifier='nnUNetPlans',
+                       device=torch.device('cuda', 0), preset='accurate', preset_overrides=None, max_queue_size=2, poll_interval=5.0, idle_timeout=None,
+                       save_probabilities=False, stop_event=None):
+        # cases is a folder to watch, a queue.Queue of (case_identifier, list_of_files) items ended by None,
+        # or any iterable of such items. Yields (case_identifier, output_file) as soon as each result is written,
+        # or (case_identifier, None) for a case that could not be read or predicted; the stream goes on.
+        # Setting stop_event (a threading.Event) ends a watched folder or queue after the cases already taken are
+        # written; closing the generator stops at once.
+        # save_probabilities: False, True (float32 .npz) or 'uint8' / 'float16' (see tools.probability_store).
+        with self.session(dataset_name_or_id, configuration, folds, checkpoint_name, plans_identifier, device) as session:
+            session.configure(preset, preset_overrides)
+            own_stop_event = stop_event is None
+            stop_event = threading.Event() if own_stop_event else stop_event
+            if isinstance(cases, str):
+                cases = watch_folder(cases, session.dataset_json['file_ending'], len(session.dataset_json['channel_names']),
+                                     poll_interval, idle_timeout, stop_event)
+            elif isinstance(cases, queue.Queue):
+                cases = iter_queue(cases, stop_event)
+            streamer = StreamingPredictor(session, output_folder, max_queue_size=max_queue_size,
+                                          save_probabilities=save_probabilities, stop_event=stop_event)
+            try:
+                yield from streamer.run(cases)
+            finally:
+                # ends the folder watch or queue read at once; an event of the caller is left to the caller
+                if own_stop_event:
+                    stop_event.set()
 
     def load_pretrained_plan(self, pretrained_dataset_name_or_id, plans_identifier='nnUNetPlans'):
         plans_file = join(nnUNet_preprocessed, str(pretrained_dataset_name_or_id), plans_identifier + '.json')
         return load_json(plans_file)
 
-    def extract_fingerprint(self, finetune_dataset_id):
-        # This is a CLI entry point, so we need to simulate a command-line call.
-        original_argv = sys.argv
-        try:
-            # Simulates: nnUNetv2_extract_fingerprint -d DATASET_ID
-            sys.argv = ['', '-d', str(finetune_dataset_id)]
-            extract_fingerprint_entry()
-        finally:
-            # Restore original arguments
-            sys.argv = original_argv
+    @profiled('extract_fingerprint')
+    def extract_fingerprint(self, finetune_dataset_id, skip_if_unchanged=True, num_processes=default_num_processes,
+                            verify_dataset_integrity=False, verbose=True, incremental=False):
+        # The raw files are summarized in a geometry index (tools.geometry_index) that is only updated for new or changed
+        # files. If the index is unchanged since the last extraction, the existing fingerprint is kept and no volume is read.
+        # With incremental=True only new or modified cases are analysed and merged into the cached per-case statistics
+        # (nnunet_incremental.update_fingerprint) instead of running nnU-Net's extractor over the whole dataset.
+        dataset_name = maybe_convert_to_dataset_name(finetune_dataset_id)
+        if incremental:
+            if verify_dataset_integrity:
+                verify_dataset_integrity_fn(join(nnUNet_raw, dataset_name), num_processes)
+            update_fingerprint(dataset_name, num_processes)
+            return
+        index = build_geometry_index(join(nnUNet_raw, dataset_name), with_statistics=False)
+        digest_file = join(nnUNet_preprocessed, dataset_name, 'dataset_fingerprint.digest')
+        fingerprint_file = join(nnUNet_preprocessed, dataset_name, 'dataset_fingerprint.json')
+        if skip_if_unchanged and isfile(fingerprint_file) and isfile(digest_file):
+            with open(digest_file, 'r') as handle:
+                if handle.read().strip() == index_digest(index):
+                    print(f"Raw data of {dataset_name} unchanged, keeping the existing fingerprint")
+                    return
+
+        # Same as: nnUNetv2_extract_fingerprint -d DATASET_ID -np NUM_PROCESSES --clean [--verify_dataset_integrity]
+        # (clean because an existing fingerprint is outdated once we get here)
+        extract_fingerprint_dataset(convert_dataset_name_to_id(dataset_name), DatasetFingerprintExtractor,
+                                    num_processes=num_processes, check_dataset_integrity=verify_dataset_integrity,
+                                    clean=True, verbose=verbose)
+        with open(digest_file, 'w') as handle:
+            handle.write(index_digest(index))
 
+    @profiled('apply_pretrained_plans')
     def apply_pretrained_plans(self, pretrained_dataset_id, finetune_dataset_id, pretrained_plans_identifier='nnUNetResEncUNetPlans', finetune_plans_identifier='nnUNetPlans_finetune'):
-        # This is a CLI entry point, so we need to simulate a command-line call.
-        original_argv = sys.argv
-        try:
-            # Simulates: nnUNetv2_move_plans_between_datasets -s SOURCE_ID -t TARGET_ID -sp SOURCE_PLANS -tp TARGET_PLANS
-            sys.argv = ['', '-s', str(pretrained_dataset_id), '-t', str(finetune_dataset_id), '-sp', pretrained_plans_identifier, '-tp', finetune_plans_identifier]
-            entry_point_move_plans_between_datasets()
-        finally:
-            sys.argv = original_argv
-
-    def preprocess_dataset(self, dataset_id, plans_identifier, configurations=('3d_fullres',)):
-        # This is a CLI entry point, so we need to simulate a command-line call.
-        original_argv = sys.argv
-        try:
-            # Simulates: nnUNetv2_preprocess -d DATASET_ID -plans_name PLANS_NAME -c CONFIGS
-            args = ['-d', str(dataset_id), '-plans_name', plans_identifier, '-c'] + list(configurations)
-            sys.argv = [''] + args
-            preprocess_entry()
-        finally:
-            sys.argv = original_argv
+        # Same as: nnUNetv2_move_plans_between_datasets -s SOURCE_ID -t TARGET_ID -sp SOURCE_PLANS -tp TARGET_PLANS
+        move_plans_between_datasets(pretrained_dataset_id, finetune_dataset_id, pretrained_plans_identifier, finetune_plans_identifier)
+
+    @profiled('preprocess_dataset')
+    def preprocess_dataset(self, dataset_id, plans_identifier, configurations=('3d_fullres',), num_processes=None,
+                           parallel_configurations=False, verbose=False, incremental=False):
+        # Same as: nnUNetv2_preprocess -d DATASET_ID -plans_name PLANS_NAME -c CONFIGS -np NUM_PROCESSES
+        # num_processes is one number for all configurations or one per configuration (CLI defaults if None).
+        # With parallel_configurations the configurations are preprocessed at the same time, each with its own workers.
+        # With incremental=True only new or modified cases are preprocessed, the files of all other cases are kept.
+        configurations = list(configurations)
+        if num_processes is None:
+            num_processes = [DEFAULT_PREPROCESSING_PROCESSES.get(c, 4) for c in configurations]
+        elif isinstance(num_processes, int):
+            num_processes = [num_processes] * len(configurations)
+        dataset_id = convert_dataset_name_to_id(maybe_convert_to_dataset_name(dataset_id))
+        if incremental:
+            for configuration, n in zip(configurations, num_processes):
+                preprocess_incremental(maybe_convert_to_dataset_name(dataset_id), plans_identifier, configuration, n)
+            nnunet_preprocess_dataset(dataset_id, plans_identifier, [], [], verbose)
+            return
+        if not parallel_configurations or len(configurations) < 2:
+            nnunet_preprocess_dataset(dataset_id, plans_identifier, configurations, num_processes, verbose)
+            return
+
+        plans_manager = PlansManager(join(nnUNet_preprocessed, maybe_convert_to_dataset_name(dataset_id), plans_identifier + '.json'))
 
+        def _run(configuration, n):
+            preprocessor = plans_manager.get_configuration(configuration).preprocessor_class(verbose=verbose)
+            preprocessor.run(dataset_id, configuration, plans_identifier, num_processes=n)
+
+        with ThreadPoolExecutor(max_workers=len(configurations)) as pool:
+            for future in [pool.submit(_run, c, n) for c, n in zip(configurations, num_processes)]:
+                future.result()
+        # no configuration left, this only copies the ground truth segmentations into nnUNet_preprocessed
+        nnunet_preprocess_dataset(dataset_id, plans_identifier, [], [], verbose)
+
+    @profiled('finetune')
     def finetune(self, finetune_dataset_id, configuration, fold, pretrained_checkpoint_path,
                  plans_identifier='nnUNetPlans_finetune', trainer_class_name='nnUNetTrainer',
-                 num_epochs: int = 1000, initial_lr: float = 1e-2, device=torch.device('cuda')):
+                 num_epochs: int = 1000, initial_lr: float = 1e-2, device=torch.device('cuda'),
+                 training_options: TrainingOptions = None, continue_training=False, on_epoch_end=None):
         """
         Run fine-tuning with custom epoch and learning rate settings.
         This method replicates the logic of `run_training` to allow for hyperparameter modification
         without changing the core `run_training.py` script.
+        training_options sets data augmentation workers, pinned memory, prefetch depth, batch size,
+        iterations per epoch, AMP, torch.compile and the checkpoint interval (see nnunet_training.TrainingOptions).
+        continue_training resumes from the latest checkpoint of the fold instead of loading the pretrained weights.
+        on_epoch_end(trainer) is called after every epoch, e.g. to report progress.
         """
-        # Get the trainer instance
-        nnunet_trainer = get_trainer_from_args(str(finetune_dataset_id), configuration, fold, trainer_class_name,
-                                               plans_identifier, device=device)
+        with training_options_applied(training_options):
+            # Get the trainer instance
+            nnunet_trainer = get_trainer_from_args(str(finetune_dataset_id), configuration, fold, trainer_class_name,
+                                                   plans_identifier, device=device)
+
+            # Set custom hyperparameters before initialization and weight loading
+            nnunet_trainer.num_epochs = num_epochs
+            nnunet_trainer.initial_lr = initial_lr
+            configure_trainer(nnunet_trainer, training_options)
+            if on_epoch_end is not None:
+                nnunet_on_epoch_end = nnunet_trainer.on_epoch_end
 
-        # Set custom hyperparameters before initialization and weight loading
-        nnunet_trainer.num_epochs = num_epochs
-        nnunet_trainer.initial_lr = initial_lr
+                def epoch_end_with_callback():
+                    nnunet_on_epoch_end()
+                    on_epoch_end(nnunet_trainer)
+                nnunet_trainer.on_epoch_end = epoch_end_with_callback
 
-        # Load pretrained weights
-        maybe_load_checkpoint(nnunet_trainer, continue_training=False, validation_only=False,
-                              pretrained_weights_file=pretrained_checkpoint_path)
+            # Load pretrained weights, slim weights files are memory-mapped instead of unpickling the full checkpoint
+            if continue_training:
+                maybe_load_checkpoint(nnunet_trainer, continue_training=True, validation_only=False)
+            elif pretrained_checkpoint_path.endswith(WEIGHTS_SUFFIX):
+                if not nnunet_trainer.was_initialized:
+                    nnunet_trainer.initialize()
+                load_pretrained_weights(nnunet_trainer.network, pretrained_checkpoint_path)
+            else:
+                maybe_load_checkpoint(nnunet_trainer, continue_training=False, validation_only=False,
+                                      pretrained_weights_file=pretrained_checkpoint_path)
 
-        # Set up cuDNN and run training
-        if torch.cuda.is_available():
-            cudnn.deterministic = False
-            cudnn.benchmark = True
+            # Set up cuDNN and run training
+            if torch.cuda.is_available():
+                cudnn.deterministic = False
+                cudnn.benchmark = True
 
-        nnunet_trainer.run_training()
+            nnunet_trainer.run_training()
+
+    @profiled('finetune_folds')
+    def finetune_folds(self, finetune_dataset_id, configuration, folds, pretrained_checkpoint_path,
+                       plans_identifier='nnUNetPlans_finetune', trainer_class_name='nnUNetTrainer',
+                       num_epochs: int = 1000, initial_lr: float = 1e-2, devices=None, num_threads=None,
+                       training_options: TrainingOptions = None, max_restarts=2, resume=False):
+        """
+        Fine-tune several folds at once, one process per fold on its own device (or CPU thread share), restarting
+        failed folds from their latest checkpoint. See nnunet_folds.finetune_folds. Returns the status of every fold.
+        """
+        return finetune_folds(finetune_dataset_id, configuration, list(folds), pretrained_checkpoint_path,
+                              plans_identifier, trainer_class_name, num_epochs, initial_lr, devices, num_threads,
+                              training_options, max_restarts, resume)
+
+    def extract_weights(self, dataset_name_or_id, configuration, folds=(0,), checkpoint_name='checkpoint_final.pth', plans_identifier='nnUNetPlans'):
+        # Writes fold_X/<checkpoint>.safetensors with only the network weights next to each checkpoint. Pass its name as
+        # checkpoint_name to predict, or its path as pretrained_checkpoint_path to finetune. Returns one report per fold.
+        model_folder = self.model_folder(dataset_name_or_id, configuration, plans_identifier)
+        return {fold: extract_weights(join(model_folder, f'fold_{fold}', checkpoint_name)) for fold in folds}
+
+    @profiled('benchmark_dataloader')
+    def benchmark_dataloader(self, dataset_name_or_id, configuration, fold, plans_identifier='nnUNetPlans',
+                             trainer_class_name='nnUNetTrainer', device=torch.device('cuda'),
+                             training_options: TrainingOptions = None, num_batches=50, num_warmup_batches=5):
+        """
+        Dry run of the training data pipeline: loading and augmentation only, no forward or backward pass.
+        Returns samples per second, to tune training_options before a long train or finetune run.
+        """
+        with training_options_applied(training_options):
+            nnunet_trainer = get_trainer_from_args(str(dataset_name_or_id), configuration, fold, trainer_class_name,
+                                                   plans_identifier, device=device)
+            configure_trainer(nnunet_trainer, training_options)
+            return benchmark_dataloader(nnunet_trainer, num_batches, num_warmup_batches, training_options)
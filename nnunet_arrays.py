@@ -0,0 +1,121 @@
+import time
+
+import numpy as np
+import SimpleITK as itk
+from tools.sitk_stuff import reorient_channels
+from tools.profiling import stage
+
+IDENTITY_DIRECTION = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)
+
+
+def case_from_arrays(channels, spacing, origin=(0.0, 0.0, 0.0), direction=IDENTITY_DIRECTION):
+    """
+    Build the (image, properties) pair that nnU-Net's SimpleITK reader would return for in-memory volumes.
+
+    channels: list of (Z, Y, X) arrays in the channel order of dataset.json, or one (C, Z, Y, X) array
+    spacing, origin, direction: itk convention, i.e. (x, y, z) spacing and a flattened 3x3 direction
+    """
+    image = np.stack([np.asarray(c) for c in channels]) if isinstance(channels, (list, tuple)) else np.asarray(channels)
+    if image.ndim != 4:
+        raise ValueError(f"Expected (C, Z, Y, X) channels, got an array of shape {image.shape}")
+    properties = {'sitk_stuff': {'spacing': tuple(float(s) for s in spacing),
+                                 'origin': tuple(float(o) for o in origin),
+                                 'direction': tuple(float(d) for d in direction)},
+                  'spacing': [float(s) for s in spacing][::-1]}
+    return image.astype(np.float32, copy=False), properties
+
+
+def case_from_images(images, orientation=None, tolerance=1e-4):
+    """
+    Same as case_from_arrays for a list of itk images, one per channel. Channels whose geometry differs from
+    the first one are resampled onto it (linear interpolation) so that all channels share one voxel grid.
+    With an orientation code (e.g. 'LPS') the stacked channels are also reoriented in one pass.
+    """
+    image, spacing, origin, direction = reorient_channels(images, orientation, tolerance)
+    return case_from_arrays(image, spacing, origin, direction)
+
+
+def segmentation_to_itk(segmentation, properties):
+    """
+    Wrap a predicted (Z, Y, X) segmentation into an itk image with the geometry of the input case.
+    """
+    seg_itk = itk.GetImageFromArray(segmentation.astype(np.uint8, copy=False))
+    seg_itk.SetSpacing(properties['sitk_stuff']['spacing'])
+    seg_itk.SetOrigin(properties['sitk_stuff']['origin'])
+    seg_itk.SetDirection(properties['sitk_stuff']['direction'])
+    return seg_itk
+
+
+def nonzero_bbox(image, margin=0):
+    """
+    (Z, Y, X) slices of the box holding every voxel that is nonzero in any channel of a (C, Z, Y, X) image,
+    grown by margin voxels. None if the image is empty. One any() reduction per axis, no hole filling.
+    """
+    mask = np.any(image != 0, axis=0)
+    bbox = []
+    for axis in range(mask.ndim):
+        nonzero = np.flatnonzero(mask.any(axis=tuple(a for a in range(mask.ndim) if a != axis)))
+        if len(nonzero) == 0:
+            return None
+        bbox.append(slice(max(int(nonzero[0]) - margin, 0), min(int(nonzero[-1]) + 1 + margin, mask.shape[axis])))
+    return tuple(bbox)
+
+
+def crop_case(image, properties, bbox):
+    """
+    Crop a case to bbox. The origin of the returned properties is moved to the first voxel of the box.
+    """
+    sitk_stuff = properties['sitk_stuff']
+    start_xyz = np.array([s.start for s in bbox][::-1], dtype=float)
+    direction = np.array(sitk_stuff['direction'], dtype=float).reshape(3, 3)
+    origin = np.array(sitk_stuff['origin']) + direction @ (np.array(sitk_stuff['spacing']) * start_xyz)
+    cropped_properties = dict(properties, sitk_stuff=dict(sitk_stuff, origin=tuple(float(o) for o in origin)))
+    return np.ascontiguousarray(image[(slice(None),) + tuple(bbox)]), cropped_properties
+
+
+def paste_segmentation(segmentation, bbox, full_shape):
+    """
+    Place a segmentation of the bbox crop into a full-size background label map.
+    """
+    full = np.zeros(full_shape, dtype=segmentation.dtype)
+    full[tuple(bbox)] = segmentation
+    return full
+
+
+def predict_cropped(session, image, properties, margin=0, case=None, compare_full=False):
+    """
+    Predict a case on the bounding box of its nonzero voxels only and paste the result back into a full-size
+    label map. Returns the segmentation and a report with the crop size, the input bytes handed to the
+    predictor with and without the crop, the inference time and the time spent on finding the box, cropping
+    and pasting. With compare_full the full volume is predicted as well, to report the time saved
+    (seconds_full, seconds_saved).
+    """
+    full_shape = image.shape[1:]
+    start = time.perf_counter()
+    bbox = nonzero_bbox(image, margin)
+    if bbox is None:
+        segmentation = np.zeros(full_shape, dtype=np.uint8)
+        report = {'full_shape': full_shape, 'crop_shape': None, 'voxel_fraction': 0.0, 'bytes_full': image.nbytes,
+                  'bytes_cropped': 0, 'bytes_saved': image.nbytes, 'seconds': 0.0,
+                  'crop_seconds': time.perf_counter() - start}
+    else:
+        cropped, cropped_properties = crop_case(image, properties, bbox)
+        report = {'full_shape': full_shape, 'crop_shape': cropped.shape[1:],
+                  'voxel_fraction': cropped[0].size / image[0].size,
+                  'bytes_full': image.nbytes, 'bytes_cropped': cropped.nbytes, 'bytes_saved': image.nbytes - cropped.nbytes}
+        crop_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        with stage('predict.cropped', case=case, voxel_fraction=report['voxel_fraction'], bytes_saved=report['bytes_saved']):
+            segmentation = session.predict_array(cropped, cropped_properties)
+        report['seconds'] = time.perf_counter() - start
+        del cropped
+        start = time.perf_counter()
+        segmentation = paste_segmentation(segmentation, bbox, full_shape)
+        report['crop_seconds'] = crop_seconds + time.perf_counter() - start
+    if compare_full:
+        start = time.perf_counter()
+        with stage('predict.full', case=case):
+            session.predict_array(image, properties)
+        report['seconds_full'] = time.perf_counter() - start
+        report['seconds_saved'] = report['seconds_full'] - report['seconds'] - report['crop_seconds']
+    return segmentation, report
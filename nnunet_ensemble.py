@@ -0,0 +1,166 @@
+import json
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations
+
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import join, load_json, save_json, maybe_mkdir_p, isfile
+
+from tools.evaluation import label_agreement
+
+ENSEMBLE_NAME = 'ensemble'
+REPORT_NAME = 'model_comparison.json'
+# configuration entries that change the preprocessed input of a model
+PREPROCESSING_KEYS = ('preprocessor_name', 'spacing', 'normalization_schemes', 'use_mask_for_norm',
+                      'resampling_fn_data', 'resampling_fn_data_kwargs')
+
+
+def preprocessing_key(predictor):
+    """
+    Models with the same key receive identical preprocessed data, so each case is preprocessed once per key.
+    """
+    configuration = predictor.configuration_manager.configuration
+    plans = predictor.plans_manager.plans
+    return json.dumps([{k: configuration.get(k) for k in PREPROCESSING_KEYS},
+                       plans.get('transpose_forward'), plans.get('image_reader_writer'),
+                       plans.get('foreground_intensity_properties_per_channel'),
+                       predictor.dataset_json['channel_names']], sort_keys=True)
+
+
+class ModelComparison:
+    """
+    Run several trained models (e.g. pretrained and fine-tuned, or several folds or checkpoints) on the same cases.
+    Every case is read and preprocessed once per distinct preprocessing and then passed through all models.
+    The segmentations of each model can be written to its own folder, and the probabilities of all models can be
+    averaged into an ensemble. Per case the Dice between every pair of models and the timings are reported.
+
+    sessions: dict model name -> PredictorSession, all trained on the same labels
+    output_folders: dict model name -> folder for its segmentations (None to not write them)
+    """
+    def __init__(self, sessions, output_folders, ensemble_folder=None, num_export_workers=2, overwrite=False):
+        self.sessions = OrderedDict(sessions)
+        self.output_folders = output_folders
+        self.ensemble_folder = ensemble_folder
+        self.num_export_workers = num_export_workers
+        self.overwrite = overwrite
+        label_managers = [s.predictor.label_manager for s in self.sessions.values()]
+        if ensemble_folder is not None and len({(str(lm.all_labels), str(lm.regions)) for lm in label_managers}) > 1:
+            raise ValueError("Only models trained on the same labels or regions can be ensembled")
+        # preprocessing key -> names of the models sharing it
+        self.groups = OrderedDict()
+        for name, session in self.sessions.items():
+            self.groups.setdefault(preprocessing_key(session.predictor), []).append(name)
+
+    def _predict_case(self, case_identifier, preprocessed, export_pool, exports):
+        predict_ensemble = self.ensemble_folder is not None
+        segmentations, probabilities, timings = {}, [], {}
+        for key, names in self.groups.items():
+            data, properties = preprocessed[key]
+            for name in names:
+                session = self.sessions[name]
+                predictor = session.predictor
+                start = time.perf_counter()
+                logits = session.predict_logits(data, case_identifier, model=name)
+                result = session.segmentation_from_logits(logits, properties, predict_ensemble)
+                del logits
+                timings[name] = time.perf_counter() - start
+                segmentation = result[0] if predict_ensemble else result
+                if predict_ensemble:
+                    probabilities.append(result[1])
+                segmentations[name] = segmentation
+                if self.output_folders.get(name) is not None:
+                    exports.append(self._export(export_pool, predictor, segmentation, properties,
+                                                join(self.output_folders[name], case_identifier)))
+        if predict_ensemble:
+            predictor = next(iter(self.sessions.values())).predictor
+            fused = np.mean(probabilities, axis=0)
+            segmentations[ENSEMBLE_NAME] = predictor.label_manager.convert_probabilities_to_segmentation(fused)
+            exports.append(self._export(export_pool, predictor, segmentations[ENSEMBLE_NAME], properties,
+                                        join(self.ensemble_folder, case_identifier)))
+        return segmentations, timings
+
+    @staticmethod
+    def _export(export_pool, predictor, segmentation, properties, output_file_truncated):
+        reader_writer = predictor.plans_manager.image_reader_writer_class()
+        output_file = output_file_truncated + predictor.dataset_json['file_ending']
+        return export_pool.submit(reader_writer.write_seg, segmentation, output_file, properties)
+
+    def _done(self, case_identifier):
+        # a case is skipped only if every requested output of it exists
+        folders = [f for f in self.output_folders.values() if f is not None] + \
+                  ([self.ensemble_folder] if self.ensemble_folder is not None else [])
+        file_ending = next(iter(self.sessions.values())).dataset_json['file_ending']
+        return bool(folders) and all(isfile(join(f, case_identifier + file_ending)) for f in folders)
+
+    def _previous_cases(self, report_file):
+        # cases of an earlier run with the same models (and ensemble), i.e. the same model pairs
+        if report_file is None or self.overwrite or not isfile(report_file):
+            return {}
+        names = list(self.sessions) + ([ENSEMBLE_NAME] if self.ensemble_folder is not None else [])
+        pairs = {f'{a} vs {b}' for a, b in combinations(names, 2)}
+        previous = load_json(report_file).get('cases', {})
+        return {c: r for c, r in previous.items() if set(r['dice']) == pairs and set(r['inference_seconds']) == set(self.sessions)}
+
+    def run(self, case_identifiers, list_of_lists_of_files, report_file=None):
+        """
+        Predict all cases. Returns the report, also written to report_file if given.
+        The next case is preprocessed in the background while the models run on the current one.
+        Cases of an existing report_file that are skipped on a rerun are kept in the report.
+        """
+        for folder in list(self.output_folders.values()) + [self.ensemble_folder]:
+            if folder is not None:
+                maybe_mkdir_p(folder)
+        todo = [(c, files) for c, files in zip(case_identifiers, list_of_lists_of_files)
+                if self.overwrite or not self._done(c)]
+        print(f"Comparing {len(self.sessions)} models on {len(todo)} cases "
+              f"({len(self.groups)} distinct preprocessing)")
+
+        def preprocess(files):
+            start = time.perf_counter()
+            preprocessed = {key: self.sessions[names[0]].preprocess(files)
+                            for key, names in self.groups.items()}
+            return preprocessed, time.perf_counter() - start
+
+        cases, exports = {}, []
+        with ThreadPoolExecutor(max_workers=1) as preprocess_pool, \
+                ThreadPoolExecutor(max_workers=max(self.num_export_workers, 1)) as export_pool:
+            upcoming = preprocess_pool.submit(preprocess, todo[0][1]) if todo else None
+            for ix, (case_identifier, _) in enumerate(todo):
+                preprocessed, preprocess_seconds = upcoming.result()
+                if ix + 1 < len(todo):
+                    upcoming = preprocess_pool.submit(preprocess, todo[ix + 1][1])
+                segmentations, timings = self._predict_case(case_identifier, preprocessed, export_pool, exports)
+                del preprocessed
+                cases[case_identifier] = {
+                    'preprocess_seconds': preprocess_seconds,
+                    'inference_seconds': timings,
+                    'dice': {f'{a} vs {b}': label_agreement(segmentations[a], segmentations[b])
+                             for a, b in combinations(segmentations, 2)}}
+                print(f"{case_identifier}: " + ', '.join(f"{pair} {dice:.3f}"
+                                                          for pair, dice in cases[case_identifier]['dice'].items()))
+                # drop finished writes so that their segmentations are released, raising export errors
+                for future in [f for f in exports if f.done()]:
+                    exports.remove(future)
+                    future.result()
+            for future in exports:
+                future.result()
+
+        cases = dict(self._previous_cases(report_file), **cases)
+        report = {'models': list(self.sessions), 'cases': cases, 'summary': summarize(cases)}
+        if report_file is not None:
+            save_json(report, report_file, sort_keys=False)
+        return report
+
+
+def summarize(cases):
+    """
+    Mean Dice of every model pair and total time of every stage over all cases.
+    """
+    if not cases:
+        return {}
+    pairs = next(iter(cases.values()))['dice']
+    models = next(iter(cases.values()))['inference_seconds']
+    return {'mean_dice': {pair: float(np.mean([c['dice'][pair] for c in cases.values()])) for pair in pairs},
+            'preprocess_seconds': float(sum(c['preprocess_seconds'] for c in cases.values())),
+            'inference_seconds': {m: float(sum(c['inference_seconds'][m] for c in cases.values())) for m in models}}
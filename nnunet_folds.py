@@ -0,0 +1,238 @@
+import os
+import time
+import queue
+import shutil
+import dataclasses
+import traceback
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager
+
+import torch
+import nnunetv2.training.nnUNetTrainer.nnUNetTrainer as trainer_module
+from batchgenerators.utilities.file_and_folder_operations import join, load_json, save_json, isfile, maybe_mkdir_p
+from nnunetv2.paths import nnUNet_preprocessed
+from nnunetv2.utilities.dataset_name_id_conversion import maybe_convert_to_dataset_name
+from nnunetv2.utilities.file_path_utilities import get_output_folder
+from nnunetv2.utilities.plans_handling.plans_handler import PlansManager
+
+from nnunet_session import set_cpu_threads
+from nnunet_sharding import default_devices
+from nnunet_training import TrainingOptions
+
+STATUS_NAME = 'finetune_folds_status.json'
+CHECKPOINTS = ('checkpoint_final.pth', 'checkpoint_latest.pth', 'checkpoint_best.pth')
+# written by every trainer into the model folder shared by the folds
+SHARED_MODEL_FILES = ('plans.json', 'dataset.json', 'dataset_fingerprint.json')
+
+
+def prepare_shared_data(dataset_name, plans_identifier, configuration, num_processes=4, output_folder_base=None):
+    """
+    Do once, before the folds start, the steps every nnU-Net trainer would otherwise run on the shared
+    folders at the same time: writing splits_final.json and unpacking the .npz files (only for nnU-Net
+    versions that unpack) in the preprocessed folder, and copying plans.json, dataset.json and
+    dataset_fingerprint.json into output_folder_base, the model folder of the folds. Afterwards the fold
+    processes only read the preprocessed data and leave these files alone (see _shared_files_kept).
+    """
+    plans = load_json(join(nnUNet_preprocessed, dataset_name, plans_identifier + '.json'))
+    if output_folder_base is not None:
+        # same content as nnUNetTrainer.on_train_start writes
+        maybe_mkdir_p(output_folder_base)
+        save_json(plans, join(output_folder_base, 'plans.json'), sort_keys=False)
+        save_json(load_json(join(nnUNet_preprocessed, dataset_name, 'dataset.json')),
+                  join(output_folder_base, 'dataset.json'), sort_keys=False)
+        shutil.copyfile(join(nnUNet_preprocessed, dataset_name, 'dataset_fingerprint.json'),
+                        join(output_folder_base, 'dataset_fingerprint.json'))
+    data_folder = join(nnUNet_preprocessed, dataset_name, PlansManager(plans).get_configuration(configuration).data_identifier)
+    splits_file = join(nnUNet_preprocessed, dataset_name, 'splits_final.json')
+    if not isfile(splits_file):
+        try:
+            from nnunetv2.utilities.crossval_split import generate_crossval_split
+        except ImportError:
+            generate_crossval_split = None
+        if generate_crossval_split is not None:
+            # same sorted identifiers, seed and number of splits as nnUNetTrainer.do_split
+            identifiers = sorted(f[:-len('.pkl')] for f in os.listdir(data_folder) if f.endswith('.pkl'))
+            save_json(generate_crossval_split(identifiers, seed=12345, n_splits=5), splits_file)
+    try:
+        from nnunetv2.training.dataloading.utils import unpack_dataset
+    except ImportError:
+        unpack_dataset = None
+    if unpack_dataset is not None:
+        unpack_dataset(data_folder, unpack_segmentation=True, overwrite_existing=False, num_processes=num_processes)
+
+
+def fold_output_folder(dataset_name, trainer_class_name, plans_identifier, configuration, fold):
+    return get_output_folder(dataset_name, trainer_class_name, plans_identifier, configuration, fold)
+
+
+def has_checkpoint(output_folder):
+    return any(isfile(join(output_folder, c)) for c in CHECKPOINTS)
+
+
+def _last(log, key):
+    values = log.get(key) or []
+    return float(values[-1]) if len(values) else None
+
+
+@contextmanager
+def _shared_files_kept(output_folder_base):
+    # on_train_start of every fold would rewrite the files prepare_shared_data wrote, while the other folds may
+    # read them; in the fold process these writes are skipped, all others go through
+    shared = {join(output_folder_base, name) for name in SHARED_MODEL_FILES}
+    save_json_fn, copyfile = trainer_module.save_json, shutil.copyfile
+
+    def save_json_unless_shared(obj, file, *args, **kwargs):
+        if file not in shared:
+            save_json_fn(obj, file, *args, **kwargs)
+
+    def copyfile_unless_shared(src, dst, *args, **kwargs):
+        return dst if dst in shared else copyfile(src, dst, *args, **kwargs)
+
+    trainer_module.save_json, shutil.copyfile = save_json_unless_shared, copyfile_unless_shared
+    try:
+        yield
+    finally:
+        trainer_module.save_json, shutil.copyfile = save_json_fn, copyfile
+
+
+def _fold_worker(fold, device, num_threads, continue_training, finetune_kwargs, output_folder_base, status_queue):
+    # runs in its own process; reports (fold, 'epoch' | 'done' | 'failed', info)
+    from nnunet_api import NnUnetApi
+    device = torch.device(device)
+    if device.type == 'cpu':
+        set_cpu_threads(num_threads)
+    elif device.type == 'cuda':
+        torch.cuda.set_device(device)
+
+    def report(trainer):
+        log = trainer.logger.my_fantastic_logging
+        status_queue.put((fold, 'epoch', {'epoch': trainer.current_epoch, 'num_epochs': trainer.num_epochs,
+                                          'train_loss': _last(log, 'train_losses'), 'val_loss': _last(log, 'val_losses'),
+                                          'ema_fg_dice': _last(log, 'ema_fg_dice')}))
+
+    try:
+        with _shared_files_kept(output_folder_base):
+            NnUnetApi().finetune(fold=fold, device=device, continue_training=continue_training, on_epoch_end=report,
+                                 **finetune_kwargs)
+    except Exception:
+        status_queue.put((fold, 'failed', {'error': traceback.format_exc()}))
+        raise
+    status_queue.put((fold, 'done', {}))
+
+
+def format_status(status):
+    """
+    One line per fold: device, state, epoch, last losses, EMA foreground Dice and attempts.
+    """
+    lines = []
+    for fold, s in status.items():
+        epoch = f"{s['epoch']}/{s['num_epochs']}" if s['epoch'] is not None else '-'
+        loss = f"{s['train_loss']:.4f}" if s['train_loss'] is not None else '-'
+        val_loss = f"{s['val_loss']:.4f}" if s['val_loss'] is not None else '-'
+        dice = f"{s['ema_fg_dice']:.4f}" if s['ema_fg_dice'] is not None else '-'
+        lines.append(f"fold {fold:<4} {str(s['device']):8s} {s['state']:10s} epoch {epoch:>9s}  train loss {loss:>8s}  "
+                     f"val loss {val_loss:>8s}  EMA Dice {dice:>6s}  attempts {s['attempts']}")
+    return '\n'.join(lines)
+
+
+def finetune_folds(finetune_dataset_id, configuration, folds, pretrained_checkpoint_path,
+                   plans_identifier='nnUNetPlans_finetune', trainer_class_name='nnUNetTrainer', num_epochs=1000,
+                   initial_lr=1e-2, devices=None, num_threads=None, training_options: TrainingOptions = None,
+                   max_restarts=2, resume=False, status_file=None, poll_interval=5.0):
+    """
+    Fine-tune several folds in parallel, one process per fold. At most one fold runs per entry of devices
+    (default: one per GPU, or two CPU workers); the other folds wait for a free device. CPU workers split
+    num_threads (all cores by default) between them and, unless training_options sets it, use half of their
+    share for data augmentation processes. A fold whose process fails is restarted up to max_restarts times,
+    from its latest checkpoint when one was written (see TrainingOptions.save_every). With resume, folds that
+    already have checkpoints continue from them on the first attempt too.
+    Progress of all folds is printed as one table and written to status_file (default: STATUS_NAME in the
+    model folder). Returns the final status of every fold.
+    """
+    dataset_name = maybe_convert_to_dataset_name(finetune_dataset_id)
+    devices = default_devices() if devices is None else list(devices)
+    training_options = TrainingOptions() if training_options is None else training_options
+    n_cpu_workers = min(len(folds), sum(1 for d in devices if torch.device(d).type == 'cpu'))
+    cpu_budget = num_threads if num_threads is not None else (os.cpu_count() or 1)
+    threads_per_cpu_worker = max(1, cpu_budget // max(1, n_cpu_workers))
+    output_folders = {f: fold_output_folder(dataset_name, trainer_class_name, plans_identifier, configuration, f) for f in folds}
+    output_folder_base = os.path.dirname(output_folders[folds[0]])
+    if status_file is None:
+        status_file = join(output_folder_base, STATUS_NAME)
+    os.makedirs(os.path.dirname(status_file), exist_ok=True)
+
+    prepare_shared_data(dataset_name, plans_identifier, configuration, output_folder_base=output_folder_base)
+    finetune_kwargs = {'finetune_dataset_id': finetune_dataset_id, 'configuration': configuration,
+                       'pretrained_checkpoint_path': pretrained_checkpoint_path, 'plans_identifier': plans_identifier,
+                       'trainer_class_name': trainer_class_name, 'num_epochs': num_epochs, 'initial_lr': initial_lr}
+
+    status = {f: {'state': 'pending', 'device': None, 'attempts': 0, 'epoch': None, 'num_epochs': num_epochs,
+                  'train_loss': None, 'val_loss': None, 'ema_fg_dice': None, 'seconds': 0.0, 'error': None}
+              for f in folds}
+    context = multiprocessing.get_context('spawn')
+    status_queue = context.Queue()
+    pending = deque(folds)
+    free_devices = deque(devices)
+    running = {}
+    started = {}
+    last_print = 0.0
+    start = time.perf_counter()
+    while pending or running:
+        changed = False
+        while pending and free_devices:
+            fold = pending.popleft()
+            device = free_devices.popleft()
+            options = training_options
+            if torch.device(device).type == 'cpu' and options.num_processes_augmentation is None:
+                options = dataclasses.replace(options, num_processes_augmentation=max(1, threads_per_cpu_worker // 2))
+            continue_training = (status[fold]['attempts'] > 0 or resume) and has_checkpoint(output_folders[fold])
+            worker = context.Process(target=_fold_worker, name=f'fold_{fold}',
+                                     args=(fold, device, threads_per_cpu_worker, continue_training,
+                                           dict(finetune_kwargs, training_options=options), output_folder_base,
+                                           status_queue))
+            worker.start()
+            running[fold] = (worker, device)
+            started[fold] = time.perf_counter()
+            status[fold].update({'state': 'running', 'device': device, 'attempts': status[fold]['attempts'] + 1})
+            print(f"fold {fold}: {'continuing from checkpoint' if continue_training else 'starting'} on {device}")
+            changed = True
+
+        try:
+            fold, event, info = status_queue.get(timeout=poll_interval)
+            status[fold].update(info)
+            if event == 'failed':
+                print(f"fold {fold} failed:\n{info['error']}")
+            changed = True
+        except queue.Empty:
+            pass
+
+        for fold, (worker, device) in list(running.items()):
+            if worker.is_alive():
+                continue
+            worker.join()
+            del running[fold]
+            free_devices.append(device)
+            status[fold]['seconds'] += time.perf_counter() - started[fold]
+            if worker.exitcode == 0:
+                status[fold]['state'] = 'done'
+                status[fold]['error'] = None
+            elif status[fold]['attempts'] <= max_restarts:
+                status[fold]['state'] = 'restarting'
+                status[fold]['error'] = status[fold]['error'] or f'worker exited with code {worker.exitcode}'
+                pending.append(fold)
+            else:
+                status[fold]['state'] = 'failed'
+                status[fold]['error'] = status[fold]['error'] or f'worker exited with code {worker.exitcode}'
+            changed = True
+
+        if changed:
+            save_json({'seconds': time.perf_counter() - start, 'folds': status}, status_file, sort_keys=False)
+            if time.perf_counter() - last_print > poll_interval or not (pending or running):
+                print(format_status(status))
+                last_print = time.perf_counter()
+
+    failed = [f for f, s in status.items() if s['state'] != 'done']
+    if failed:
+        print(f"folds {failed} failed, see {status_file}")
+    return status
@@ -0,0 +1,229 @@
+import os
+import json
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import join, load_json, save_json, maybe_mkdir_p, isfile
+from nnunetv2.paths import nnUNet_raw, nnUNet_preprocessed
+from nnunetv2.preprocessing.cropping.cropping import crop_to_nonzero
+from nnunetv2.utilities.utils import get_filenames_of_train_images_and_targets
+from nnunetv2.utilities.plans_handling.plans_handler import PlansManager
+from nnunetv2.imageio.reader_writer_registry import determine_reader_writer_from_dataset_json
+
+from tools.geometry_index import build_geometry_index
+
+FINGERPRINT_CACHE = 'fingerprint_cache'
+CASE_HASHES = 'case_hashes.json'
+# foreground intensities sampled over the whole dataset, as DatasetFingerprintExtractor.num_foreground_voxels_for_intensitystats
+NUM_FOREGROUND_SAMPLES = 10e7
+
+
+def samples_per_case(n_cases):
+    # the per-case sample count of DatasetFingerprintExtractor.run
+    return int(NUM_FOREGROUND_SAMPLES // n_cases)
+
+
+def case_hashes(dataset_name):
+    """
+    One content hash per training case, combining the checksums of its channels and label from the
+    geometry index of the raw dataset. Only new or modified files are read to build it.
+    """
+    raw_folder = join(nnUNet_raw, dataset_name)
+    dataset_json = load_json(join(raw_folder, 'dataset.json'))
+    dataset = get_filenames_of_train_images_and_targets(raw_folder, dataset_json)
+    files = build_geometry_index(raw_folder, with_statistics=False)['files']
+    hashes = {}
+    for case_identifier, entry in dataset.items():
+        digest = hashlib.blake2b(digest_size=16)
+        for file_path in list(entry['images']) + [entry['label']]:
+            rel_path = os.path.relpath(file_path, raw_folder).replace(os.sep, '/')
+            digest.update(files[rel_path]['checksum'].encode() if rel_path in files else file_path.encode())
+        hashes[case_identifier] = digest.hexdigest()
+    return dataset, dataset_json, hashes
+
+
+def analyze_case(image_files, segmentation_file, dataset_json, output_file, num_samples=10000, seed=1234):
+    """
+    Fingerprint contribution of one case, written to output_file (.npz): shape before and after cropping
+    to the nonzero region, spacing, and per channel the exact foreground voxel count, mean, sum of squared
+    deviations, min and max, plus num_samples foreground intensities drawn like nnU-Net's
+    collect_foreground_intensities (same seed, with replacement) for median and percentiles.
+    """
+    reader_writer = determine_reader_writer_from_dataset_json(dataset_json, image_files[0])()
+    images, properties = reader_writer.read_images(image_files)
+    segmentation, _ = reader_writer.read_seg(segmentation_file)
+    data_cropped, seg_cropped, _ = crop_to_nonzero(images, segmentation)
+    foreground_mask = seg_cropped[0] > 0
+    rng = np.random.RandomState(seed)
+    counts, means, m2s, minimums, maximums, samples = [], [], [], [], [], []
+    for channel in data_cropped:
+        foreground = channel[foreground_mask].astype(np.float64)
+        counts.append(len(foreground))
+        means.append(foreground.mean() if len(foreground) else 0.0)
+        m2s.append(((foreground - means[-1]) ** 2).sum() if len(foreground) else 0.0)
+        minimums.append(foreground.min() if len(foreground) else np.inf)
+        maximums.append(foreground.max() if len(foreground) else -np.inf)
+        samples.append(rng.choice(foreground, num_samples).astype(np.float32) if len(foreground)
+                       else np.zeros(0, dtype=np.float32))
+    np.savez(output_file, shape_before_crop=np.array(images.shape[1:]), shape_after_crop=np.array(data_cropped.shape[1:]),
+             spacing=np.array(properties['spacing']), counts=np.array(counts), means=np.array(means),
+             m2s=np.array(m2s), minimums=np.array(minimums), maximums=np.array(maximums), num_samples=num_samples,
+             samples=np.stack(samples) if all(len(s) for s in samples) else np.zeros((len(samples), 0), np.float32))
+    return output_file
+
+
+def _cached_num_samples(case_file):
+    # None for contributions written before the sample count was stored
+    with np.load(case_file) as case:
+        return int(case['num_samples']) if 'num_samples' in case.files else None
+
+
+def merge_fingerprint(case_files, num_samples=None):
+    """
+    Merge per-case contributions into an nnU-Net dataset fingerprint. Median and percentiles come from the pooled
+    samples, the first num_samples of every case (all by default). Unlike extract_fingerprint, which computes every
+    statistic from the samples, mean and std are merged exactly over all foreground voxels (parallel variance
+    formula) and min and max are those of all foreground voxels, so they can differ slightly from a full run.
+    """
+    spacings, shapes_after_crop, relative_sizes = [], [], []
+    count = mean = m2 = None
+    minimum = maximum = None
+    samples = []
+    for case_file in case_files:
+        case = np.load(case_file)
+        spacings.append([float(s) for s in case['spacing']])
+        shapes_after_crop.append([int(s) for s in case['shape_after_crop']])
+        relative_sizes.append(np.prod(case['shape_after_crop']) / np.prod(case['shape_before_crop']))
+        n_b, mean_b, m2_b = case['counts'].astype(np.float64), case['means'], case['m2s']
+        if count is None:
+            count, mean, m2 = n_b, mean_b.copy(), m2_b.copy()
+            minimum, maximum = case['minimums'].copy(), case['maximums'].copy()
+        else:
+            total = count + n_b
+            delta = mean_b - mean
+            with np.errstate(invalid='ignore', divide='ignore'):
+                weight = np.where(total > 0, n_b / total, 0.0)
+            mean = mean + delta * weight
+            m2 = m2 + m2_b + delta ** 2 * count * weight
+            count = total
+            minimum = np.minimum(minimum, case['minimums'])
+            maximum = np.maximum(maximum, case['maximums'])
+        if case['samples'].shape[1]:
+            samples.append(case['samples'][:, :num_samples])
+
+    pooled = np.concatenate(samples, axis=1) if samples else np.zeros((len(count), 0))
+    intensity_properties = {}
+    for channel in range(len(count)):
+        channel_samples = pooled[channel]
+        intensity_properties[channel] = {
+            'mean': float(mean[channel]),
+            'median': float(np.median(channel_samples)) if len(channel_samples) else np.nan,
+            'std': float(np.sqrt(m2[channel] / count[channel])) if count[channel] else np.nan,
+            'min': float(minimum[channel]),
+            'max': float(maximum[channel]),
+            'percentile_99_5': float(np.percentile(channel_samples, 99.5)) if len(channel_samples) else np.nan,
+            'percentile_00_5': float(np.percentile(channel_samples, 0.5)) if len(channel_samples) else np.nan,
+        }
+    return {'foreground_intensity_properties_per_channel': intensity_properties,
+            'median_relative_size_after_cropping': float(np.median(relative_sizes)),
+            'shapes_after_crop': shapes_after_crop,
+            'spacings': spacings}
+
+
+def _process_pool(num_processes):
+    # same start method as nnU-Net's own worker pools
+    return ProcessPoolExecutor(max_workers=num_processes, mp_context=multiprocessing.get_context('spawn'))
+
+
+def update_fingerprint(dataset_name, num_processes=8, num_samples=None):
+    """
+    Update dataset_fingerprint.json analysing only cases that were added or modified since the last update.
+    num_samples foreground intensities are used per case, by default nnU-Net's count for the current number
+    of cases. Cached cases sampled for a smaller dataset (more samples) contribute their first num_samples;
+    cases with fewer samples, e.g. after cases were removed, are analysed again. See merge_fingerprint for the
+    remaining differences to extract_fingerprint. Returns the list of analysed cases.
+    """
+    dataset, dataset_json, hashes = case_hashes(dataset_name)
+    num_samples = samples_per_case(len(dataset)) if num_samples is None else num_samples
+    cache_folder = join(nnUNet_preprocessed, dataset_name, FINGERPRINT_CACHE)
+    maybe_mkdir_p(cache_folder)
+    cached_hashes = load_json(join(cache_folder, CASE_HASHES)) if isfile(join(cache_folder, CASE_HASHES)) else {}
+    todo = [c for c in dataset if cached_hashes.get(c) != hashes[c] or not isfile(join(cache_folder, c + '.npz'))
+            or (_cached_num_samples(join(cache_folder, c + '.npz')) or 0) < num_samples]
+    print(f"Fingerprint of {dataset_name}: analysing {len(todo)} new or modified cases out of {len(dataset)}")
+    with _process_pool(num_processes) as pool:
+        futures = {c: pool.submit(analyze_case, dataset[c]['images'], dataset[c]['label'], dataset_json,
+                                  join(cache_folder, c + '.npz'), num_samples) for c in todo}
+        for case_identifier, future in futures.items():
+            future.result()
+            cached_hashes[case_identifier] = hashes[case_identifier]
+    for case_identifier in set(cached_hashes) - set(dataset):
+        cached_hashes.pop(case_identifier)
+        if isfile(join(cache_folder, case_identifier + '.npz')):
+            os.remove(join(cache_folder, case_identifier + '.npz'))
+    save_json(cached_hashes, join(cache_folder, CASE_HASHES))
+
+    fingerprint = merge_fingerprint([join(cache_folder, c + '.npz') for c in sorted(dataset)], num_samples)
+    save_json(fingerprint, join(nnUNet_preprocessed, dataset_name, 'dataset_fingerprint.json'), sort_keys=False)
+    return todo
+
+
+def _preprocess_case(output_file_truncated, image_files, segmentation_file, plans, configuration, dataset_json):
+    plans_manager = PlansManager(plans)
+    configuration_manager = plans_manager.get_configuration(configuration)
+    preprocessor = configuration_manager.preprocessor_class(verbose=False)
+    preprocessor.run_case_save(output_file_truncated, image_files, segmentation_file, plans_manager,
+                               configuration_manager, dataset_json)
+
+
+def preprocess_incremental(dataset_name, plans_identifier, configuration, num_processes=4):
+    """
+    Preprocess only the cases that were added or modified since the last run of this configuration and keep
+    the existing preprocessed files of all other cases. Everything is redone when the plans of the
+    configuration change. Returns the list of preprocessed cases.
+    """
+    dataset, dataset_json, hashes = case_hashes(dataset_name)
+    plans = load_json(join(nnUNet_preprocessed, dataset_name, plans_identifier + '.json'))
+    configuration_manager = PlansManager(plans).get_configuration(configuration)
+    output_folder = join(nnUNet_preprocessed, dataset_name, configuration_manager.data_identifier)
+    maybe_mkdir_p(output_folder)
+
+    # the preprocessed data depends on the configuration and on the intensity properties used for normalization
+    plans_digest = hashlib.blake2b(json.dumps([configuration_manager.configuration,
+                                               plans.get('foreground_intensity_properties_per_channel')],
+                                              sort_keys=True).encode(), digest_size=16).hexdigest()
+    hash_file = join(output_folder, CASE_HASHES)
+    state = load_json(hash_file) if isfile(hash_file) else {}
+    cached_hashes = state.get('cases', {}) if state.get('plans') == plans_digest else {}
+    # case identifier -> its files in the output folder (CASE.npz, CASE.pkl, CASE.b2nd, CASE_seg.b2nd, ...)
+    existing = {}
+    for file_name in os.listdir(output_folder):
+        case_identifier = file_name.partition('.')[0]
+        if case_identifier.endswith('_seg'):
+            case_identifier = case_identifier[:-len('_seg')]
+        existing.setdefault(case_identifier, []).append(file_name)
+    todo = [c for c in dataset if cached_hashes.get(c) != hashes[c] or c not in existing]
+    print(f"Preprocessing {dataset_name} {configuration}: {len(todo)} new or modified cases out of {len(dataset)}")
+
+    with _process_pool(num_processes) as pool:
+        futures = {c: pool.submit(_preprocess_case, join(output_folder, c), dataset[c]['images'], dataset[c]['label'],
+                                  plans, configuration, dataset_json) for c in todo}
+        for case_identifier, future in futures.items():
+            future.result()
+            cached_hashes[case_identifier] = hashes[case_identifier]
+
+    removed = set(cached_hashes) - set(dataset)
+    for case_identifier in removed:
+        cached_hashes.pop(case_identifier)
+        for file_name in existing.get(case_identifier, []):
+            os.remove(join(output_folder, file_name))
+    save_json({'plans': plans_digest, 'cases': cached_hashes}, hash_file)
+
+    splits_file = join(nnUNet_preprocessed, dataset_name, 'splits_final.json')
+    if (todo or removed) and isfile(splits_file):
+        split_cases = set(c for split in load_json(splits_file) for c in split['train'] + split['val'])
+        if split_cases != set(dataset):
+            print(f"WARNING: {splits_file} does not match the current cases, delete it to get new splits")
+    return todo
@@ -0,0 +1,424 @@
+import os
+import copy
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import RLock
+
+import numpy as np
+import torch
+from torch._dynamo import OptimizedModule
+import nnunetv2
+from batchgenerators.utilities.file_and_folder_operations import join, load_json
+from nnunetv2.inference.export_prediction import export_prediction_from_logits, \
+    convert_predicted_logits_to_segmentation_with_correct_shape
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
+from nnunetv2.utilities.label_handling.label_handling import determine_num_input_channels
+from nnunetv2.utilities.plans_handling.plans_handler import PlansManager
+from nnunet_weights import WEIGHTS_SUFFIX, load_weights, weights_nbytes
+from tools.probability_store import PROBABILITY_DTYPES, write_probabilities
+from tools.profiling import stage
+
+
+# Speed/accuracy presets for sliding-window inference.
+# tile_step_size: distance between neighbouring tiles as a fraction of the patch size (larger = fewer tiles)
+# mirror_axes: spatial axes used for test-time mirroring, None = every axis the model allows
+INFERENCE_PRESETS = {
+    'fast': {'tile_step_size': 0.75, 'use_gaussian': True, 'use_mirroring': False, 'mirror_axes': ()},
+    'balanced': {'tile_step_size': 0.5, 'use_gaussian': True, 'use_mirroring': True, 'mirror_axes': (2,)},
+    'accurate': {'tile_step_size': 0.5, 'use_gaussian': True, 'use_mirroring': True, 'mirror_axes': None},
+}
+
+
+def resolve_preset(preset='accurate', overrides=None):
+    """
+    Return the inference settings of a named preset with the given overrides applied.
+    """
+    if preset not in INFERENCE_PRESETS:
+        raise ValueError(f"Unknown inference preset '{preset}', choose one of {list(INFERENCE_PRESETS)}")
+    settings = dict(INFERENCE_PRESETS[preset])
+    for key, value in (overrides or {}).items():
+        if key not in settings:
+            raise ValueError(f"Unknown inference setting '{key}', choose one of {list(settings)}")
+        settings[key] = value
+    return settings
+
+
+def set_cpu_threads(num_threads=None, num_concurrent_cases=1):
+    """
+    Cap torch intra-op threads so that num_concurrent_cases cases running side by side
+    share num_threads cores (all cores by default) instead of oversubscribing them.
+    """
+    if num_threads is None:
+        num_threads = os.cpu_count() or 1
+    threads_per_case = max(1, num_threads // max(1, num_concurrent_cases))
+    torch.set_num_threads(threads_per_case)
+    return threads_per_case
+
+
+class DeviceAwarePredictor(nnUNetPredictor):
+    """
+    nnUNetPredictor that decides for every volume whether the sliding-window results fit on the
+    device or have to be accumulated in host memory, instead of trying the device first and
+    falling back after an out-of-memory error. It also leaves the torch thread count alone so that
+    set_cpu_threads is respected on CPU nodes.
+    """
+    device_memory_fraction = 0.8
+
+    def fits_on_device(self, data_shape):
+        if self.device.type != 'cuda':
+            return False
+        n_voxels = int(np.prod(data_shape[1:]))
+        n_heads = self.label_manager.num_segmentation_heads
+        # half precision logits + prediction counter, float32 input volume
+        required = n_voxels * (2 * n_heads + 2 + 4 * data_shape[0])
+        free, _ = torch.cuda.mem_get_info(self.device)
+        return required < free * self.device_memory_fraction
+
+    def initialize_from_trained_model_folder(self, model_training_output_dir, use_folds, checkpoint_name='checkpoint_final.pth'):
+        if not checkpoint_name.endswith(WEIGHTS_SUFFIX):
+            return super().initialize_from_trained_model_folder(model_training_output_dir, use_folds, checkpoint_name)
+        # slim weights files (nnunet_weights.extract_weights) are memory-mapped instead of unpickling full checkpoints
+        dataset_json = load_json(join(model_training_output_dir, 'dataset.json'))
+        plans_manager = PlansManager(load_json(join(model_training_output_dir, 'plans.json')))
+        parameters = []
+        for f in ([use_folds] if isinstance(use_folds, str) else use_folds):
+            f = int(f) if f != 'all' else f
+            weights, metadata = load_weights(join(model_training_output_dir, f'fold_{f}', checkpoint_name))
+            parameters.append(weights)
+        configuration_manager = plans_manager.get_configuration(metadata['configuration'])
+        trainer_class = recursive_find_python_class(join(nnunetv2.__path__[0], 'training', 'nnUNetTrainer'),
+                                                    metadata['trainer_name'], 'nnunetv2.training.nnUNetTrainer')
+        if trainer_class is None:
+            raise RuntimeError(f"Unable to locate trainer class {metadata['trainer_name']}")
+        network = trainer_class.build_network_architecture(
+            configuration_manager.network_arch_class_name,
+            configuration_manager.network_arch_init_kwargs,
+            configuration_manager.network_arch_init_kwargs_req_import,
+            determine_num_input_channels(plans_manager, configuration_manager, dataset_json),
+            plans_manager.get_label_manager(dataset_json).num_segmentation_heads,
+            enable_deep_supervision=False)
+        axes = metadata.get('inference_allowed_mirroring_axes')
+        self.manual_initialization(network, plans_manager, configuration_manager, parameters, dataset_json,
+                                   metadata['trainer_name'], None if axes is None else tuple(axes))
+        # same torch.compile step as nnU-Net's loader (manual_initialization only does it in some versions)
+        if os.environ.get('nnUNet_compile', '').lower() in ('true', '1', 't') \
+                and not isinstance(self.network, OptimizedModule):
+            print('Using torch.compile')
+            self.network = torch.compile(self.network)
+
+    def predict_logits_from_preprocessed_data(self, data):
+        self.perform_everything_on_device = self.fits_on_device(data.shape)
+        prediction = None
+        for params in self.list_of_parameters:
+            if not isinstance(self.network, OptimizedModule):
+                self.network.load_state_dict(params)
+            else:
+                self.network._orig_mod.load_state_dict(params)
+            if prediction is None:
+                prediction = self.predict_sliding_window_return_logits(data).to('cpu')
+            else:
+                prediction += self.predict_sliding_window_return_logits(data).to('cpu')
+        if len(self.list_of_parameters) > 1:
+            prediction /= len(self.list_of_parameters)
+        return prediction
+
+
+class PredictorSession:
+    """
+    A trained nnU-Net model kept in memory between predictions.
+    The weights of all requested folds are loaded once, so every call after the first
+    one skips reading the checkpoints from disk. checkpoint_name may also name slim weights
+    files (e.g. 'checkpoint_final.safetensors', see nnunet_weights.extract_weights).
+    """
+    def __init__(self, model_folder, folds=(0,), checkpoint_name='checkpoint_final.pth', device=torch.device('cuda', 0)):
+        self.model_folder = model_folder
+        self.folds = tuple(folds)
+        self.checkpoint_name = checkpoint_name
+        self.device = device
+        self.predictor = DeviceAwarePredictor(
+            tile_step_size=0.5,
+            use_gaussian=True,
+            use_mirroring=True,
+            perform_everything_on_device=device.type == 'cuda',
+            device=device,
+            verbose=False,
+            verbose_preprocessing=False,
+            allow_tqdm=True
+        )
+        self.predictor.initialize_from_trained_model_folder(
+            model_folder,
+            use_folds=self.folds,
+            checkpoint_name=checkpoint_name,
+        )
+        # mirroring axes the model was trained with, the upper bound for any preset
+        self.trained_mirror_axes = self.predictor.allowed_mirroring_axes
+        # extra predictors with their own network copy, used to run several cases concurrently
+        self._clones = []
+        # set by SessionCache: called with the bytes of new network copies before predictors() makes them
+        self.reserve_memory = None
+
+    def configure(self, preset='accurate', overrides=None):
+        """
+        Apply an inference preset (see INFERENCE_PRESETS) to this session. Only the sliding-window
+        settings change, the loaded weights are reused.
+        """
+        settings = resolve_preset(preset, overrides)
+        mirror_axes = settings['mirror_axes']
+        if mirror_axes is None or self.trained_mirror_axes is None:
+            mirror_axes = self.trained_mirror_axes
+        else:
+            mirror_axes = tuple(a for a in mirror_axes if a in self.trained_mirror_axes)
+        for predictor in [self.predictor] + self._clones:
+            predictor.tile_step_size = settings['tile_step_size']
+            predictor.use_gaussian = settings['use_gaussian']
+            predictor.use_mirroring = settings['use_mirroring'] and bool(mirror_axes)
+            predictor.allowed_mirroring_axes = mirror_axes
+        return settings
+
+    @staticmethod
+    def estimate_nbytes(model_folder, folds=(0,), checkpoint_name='checkpoint_final.pth'):
+        """
+        nbytes of a session before it is loaded: the weights of every fold plus one network, read from the
+        checkpoint of the first fold without loading its tensors.
+        """
+        fold = folds[0]
+        fold = int(fold) if fold != 'all' else fold
+        return (len(folds) + 1) * weights_nbytes(join(model_folder, f'fold_{fold}', checkpoint_name))
+
+    @staticmethod
+    def _network_nbytes(network):
+        return sum(t.numel() * t.element_size() for t in network.state_dict().values())
+
+    @property
+    def nbytes(self):
+        # weights of every fold (kept on host) plus each network instance
+        n_bytes = sum(t.numel() * t.element_size() for params in self.predictor.list_of_parameters
+                      for t in params.values() if torch.is_tensor(t))
+        for predictor in [self.predictor] + self._clones:
+            n_bytes += self._network_nbytes(predictor.network)
+        return n_bytes
+
+    def predictors(self, n):
+        """
+        Return n predictors that can run at the same time. They share the fold weights but each owns a
+        network, since switching folds loads the weights into the network in place.
+        """
+        n_missing = n - 1 - len(self._clones)
+        if n_missing > 0 and self.reserve_memory is not None:
+            self.reserve_memory(n_missing * self._network_nbytes(self.predictor.network))
+        while len(self._clones) < n - 1:
+            clone = copy.copy(self.predictor)
+            clone.network = copy.deepcopy(self.predictor.network)
+            self._clones.append(clone)
+        return [self.predictor] + self._clones[:n - 1]
+
+    @property
+    def dataset_json(self):
+        return self.predictor.dataset_json
+
+    def predict_files(self, list_of_lists_or_source_folder, output_folder, save_probabilities=False, overwrite=False,
+                      num_processes_preprocessing=2, num_processes_segmentation_export=2, num_concurrent_cases=1):
+        """
+        Predict a folder or a list of lists of files (one list with all channels per case)
+        and write the segmentations to output_folder. With num_concurrent_cases > 1 the cases are split
+        into interleaved parts that are predicted side by side.
+        """
+        predictors = self.predictors(num_concurrent_cases)
+        with ThreadPoolExecutor(max_workers=len(predictors)) as pool:
+            futures = [pool.submit(predictor.predict_from_files,
+                                   list_of_lists_or_source_folder,
+                                   output_folder,
+                                   save_probabilities=save_probabilities,
+                                   overwrite=overwrite,
+                                   num_processes_preprocessing=num_processes_preprocessing,
+                                   num_processes_segmentation_export=num_processes_segmentation_export,
+                                   folder_with_segs_from_prev_stage=None,
+                                   num_parts=len(predictors),
+                                   part_id=part_id)
+                       for part_id, predictor in enumerate(predictors)]
+            return [future.result() for future in futures]
+
+    def predict_array(self, image, properties, output_file_truncated=None, return_probabilities=False):
+        """
+        Predict a single in-memory case. image is a (C, Z, Y, X) float array and properties the
+        dict returned by the nnU-Net image reader (it must at least hold 'spacing').
+        Returns the segmentation (and probabilities) unless output_file_truncated is given.
+        """
+        return self.predictor.predict_single_npy_array(image, properties, None, output_file_truncated,
+                                                       return_probabilities)
+
+    def predict_arrays(self, images, properties, output_files_truncated=None, save_probabilities=False,
+                       num_processes=2):
+        """
+        Predict several in-memory cases, preprocessing them in background workers.
+        """
+        return self.predictor.predict_from_list_of_npy_arrays(images, None, properties, output_files_truncated,
+                                                              num_processes=num_processes,
+                                                              save_probabilities=save_probabilities,
+                                                              num_processes_segmentation_export=num_processes)
+
+    def preprocess(self, files, case=None):
+        """
+        Read and preprocess one case (the files of all its channels). Returns the float32 data tensor and the
+        properties needed to export its prediction.
+        """
+        predictor = self.predictor
+        with stage('predict.preprocess', case=case):
+            preprocessor = predictor.configuration_manager.preprocessor_class(verbose=False)
+            data, _, properties = preprocessor.run_case(files, None, predictor.plans_manager,
+                                                        predictor.configuration_manager, predictor.dataset_json)
+            data = torch.from_numpy(data).to(dtype=torch.float32, memory_format=torch.contiguous_format)
+        return data, properties
+
+    def predict_logits(self, data, case=None, predictor=None, **labels):
+        """
+        Host copy of the logits of a preprocessed case. predictor is one of predictors(n) when several cases
+        run at the same time, the session's own predictor by default.
+        """
+        predictor = self.predictor if predictor is None else predictor
+        with stage('predict.inference', case=case, **labels), torch.no_grad():
+            return predictor.predict_logits_from_preprocessed_data(data).cpu()
+
+    def segmentation_from_logits(self, logits, properties, return_probabilities=False):
+        """
+        Resample logits to the geometry of the input case and convert them to a segmentation (and probabilities).
+        """
+        predictor = self.predictor
+        return convert_predicted_logits_to_segmentation_with_correct_shape(
+            logits, predictor.plans_manager, predictor.configuration_manager, predictor.label_manager, properties,
+            return_probabilities=return_probabilities, num_threads_torch=torch.get_num_threads())
+
+    def export(self, logits, properties, output_file_truncated, save_probabilities=False, case=None):
+        """
+        Write the segmentation of a case's logits next to output_file_truncated. save_probabilities is False,
+        True (nnU-Net's float32 .npz) or 'uint8' / 'float16' for the compact maps of tools.probability_store.
+        Returns the segmentation file.
+        """
+        predictor = self.predictor
+        output_file = output_file_truncated + predictor.dataset_json['file_ending']
+        if save_probabilities in PROBABILITY_DTYPES:
+            with stage('predict.export', case=case, probabilities=save_probabilities):
+                segmentation, probabilities = self.segmentation_from_logits(logits, properties, True)
+                del logits
+                predictor.plans_manager.image_reader_writer_class().write_seg(segmentation, output_file, properties)
+                start = time.perf_counter()
+                n_bytes = write_probabilities(probabilities, output_file_truncated, save_probabilities)
+                print(f"{os.path.basename(output_file_truncated)}: {save_probabilities} probabilities written in "
+                      f"{time.perf_counter() - start:.2f} s, {n_bytes / 1024 ** 2:.1f} MB instead of "
+                      f"{probabilities.size * 4 / 1024 ** 2:.1f} MB as float32")
+        else:
+            with stage('predict.export', case=case):
+                export_prediction_from_logits(logits, properties, predictor.configuration_manager,
+                                              predictor.plans_manager, predictor.dataset_json, output_file_truncated,
+                                              save_probabilities, num_threads_torch=torch.get_num_threads())
+        return output_file
+
+    def predict_case(self, files, output_file_truncated, save_probabilities=False, predictor=None):
+        """
+        Preprocess, predict and export one case. Returns the segmentation file.
+        """
+        case = os.path.basename(output_file_truncated)
+        data, properties = self.preprocess(files, case)
+        logits = self.predict_logits(data, case, predictor)
+        del data
+        return self.export(logits, properties, output_file_truncated, save_probabilities, case)
+
+    def close(self):
+        self._clones = []
+        self.predictor.network = None
+        self.predictor.list_of_parameters = []
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+class SessionCache:
+    """
+    LRU cache of PredictorSession objects. When the weights of the cached sessions exceed
+    memory_budget bytes the least recently used sessions are closed, but never one that is pinned
+    (see session()). The budget is checked before a model is loaded and before a session makes
+    network copies for concurrent cases. The most recent session is always kept, even if it alone
+    is larger than the budget.
+    """
+    def __init__(self, memory_budget=4 * 1024 ** 3):
+        self.memory_budget = memory_budget
+        self._sessions = OrderedDict()
+        # key -> number of callers currently using the session
+        self._pins = {}
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, key):
+        return key in self._sessions
+
+    @property
+    def nbytes(self):
+        return sum(session.nbytes for session in self._sessions.values())
+
+    def _make_room(self, n_bytes, keep=None):
+        # close the least recently used sessions nobody holds until n_bytes more fit into the budget
+        for key in list(self._sessions):
+            if self.nbytes + n_bytes <= self.memory_budget:
+                break
+            if key != keep and not self._pins.get(key):
+                self._sessions.pop(key).close()
+
+    def get(self, key, factory, estimate=None):
+        """
+        Return the session stored under key, creating it with factory() on a miss. estimate() gives the
+        bytes of the new session, for which unpinned sessions are closed before it is loaded.
+        The returned session is not pinned: a later miss may close it. Use session() while it is in use.
+        """
+        with self._lock:
+            if key in self._sessions:
+                self._sessions.move_to_end(key)
+                return self._sessions[key]
+            if estimate is not None:
+                self._make_room(estimate())
+            session = factory()
+            session.reserve_memory = lambda n_bytes: self._reserve(key, n_bytes)
+            self._sessions[key] = session
+            self._make_room(0, keep=key)
+            return session
+
+    def _reserve(self, key, n_bytes):
+        with self._lock:
+            self._make_room(n_bytes, keep=key)
+
+    @contextmanager
+    def session(self, key, factory, estimate=None):
+        """
+        Same as get, but the session is pinned until the with block ends: no other request closes it.
+        """
+        with self._lock:
+            session = self.get(key, factory, estimate)
+            self._pins[key] = self._pins.get(key, 0) + 1
+        try:
+            yield session
+        finally:
+            with self._lock:
+                self._pins[key] -= 1
+                if not self._pins[key]:
+                    del self._pins[key]
+                # sessions kept over the budget while pinned are closed now, except the most recent one
+                if self._sessions:
+                    self._make_room(0, keep=next(reversed(self._sessions)))
+
+    def evict(self, key):
+        with self._lock:
+            if self._pins.get(key):
+                raise RuntimeError(f"Session {key} is in use and cannot be evicted")
+            session = self._sessions.pop(key, None)
+            if session is not None:
+                session.close()
+
+    def clear(self):
+        # pinned sessions stay cached until their with block ends
+        with self._lock:
+            for key in list(self._sessions):
+                if not self._pins.get(key):
+                    self._sessions.pop(key).close()
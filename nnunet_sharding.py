@@ -0,0 +1,144 @@
+import os
+import time
+import heapq
+import queue
+import traceback
+import multiprocessing
+
+import numpy as np
+import torch
+from batchgenerators.utilities.file_and_folder_operations import join, maybe_mkdir_p, save_json
+
+from nnunet_session import PredictorSession, set_cpu_threads
+from tools.sitk_stuff import read_nifti_header
+
+
+def case_voxels(files):
+    """
+    Number of voxels of a case, read from the header of its first channel only.
+    """
+    return int(np.prod(read_nifti_header(files[0])[0]))
+
+
+def balance_shards(list_of_lists, num_shards, weights=None):
+    """
+    Split cases into num_shards shards with about the same total volume (largest case first,
+    always into the lightest shard). Returns a list with the case indices of every shard.
+    """
+    if weights is None:
+        weights = [case_voxels(files) for files in list_of_lists]
+    shards = [[] for _ in range(num_shards)]
+    heap = [(0, shard_id) for shard_id in range(num_shards)]
+    for case_ix in sorted(range(len(list_of_lists)), key=lambda i: weights[i], reverse=True):
+        load, shard_id = heapq.heappop(heap)
+        shards[shard_id].append(case_ix)
+        heapq.heappush(heap, (load + weights[case_ix], shard_id))
+    return shards
+
+
+def _shard_worker(shard_id, cases, output_folder, model_folder, folds, checkpoint_name, device, num_threads,
+                  preset, preset_overrides, progress_queue):
+    # runs in its own process; reports ('done' | 'failed', shard_id, case_identifier, seconds, error) per case
+    device = torch.device(device)
+    if device.type == 'cpu':
+        set_cpu_threads(num_threads)
+    elif device.type == 'cuda':
+        torch.cuda.set_device(device)
+    session = PredictorSession(model_folder, folds, checkpoint_name, device)
+    session.configure(preset, preset_overrides)
+    for case_identifier, files in cases:
+        start = time.perf_counter()
+        try:
+            session.predict_case(files, join(output_folder, case_identifier))
+            progress_queue.put(('done', shard_id, case_identifier, time.perf_counter() - start, None))
+        except Exception:
+            progress_queue.put(('failed', shard_id, case_identifier, time.perf_counter() - start,
+                                traceback.format_exc()))
+    progress_queue.put(('finished', shard_id, None, None, None))
+
+
+def default_devices(num_shards=None):
+    """
+    One shard per visible GPU, or num_shards (default 2) CPU shards when there is no GPU.
+    """
+    if torch.cuda.is_available():
+        n_gpus = torch.cuda.device_count()
+        num_shards = n_gpus if num_shards is None else num_shards
+        return [f'cuda:{i % n_gpus}' for i in range(num_shards)]
+    return ['cpu'] * (2 if num_shards is None else num_shards)
+
+
+def predict_sharded(case_identifiers, list_of_lists, output_folder, model_folder, folds=(0,),
+                    checkpoint_name='checkpoint_final.pth', devices=None, num_threads=None, preset='accurate',
+                    preset_overrides=None, overwrite=False, file_ending='.nii.gz'):
+    """
+    Predict the cases with one worker process per entry of devices (e.g. ['cuda:0', 'cuda:1'] or
+    ['cpu'] * 4). Shards are balanced by case volume; CPU workers split num_threads (all cores by
+    default) between them. Returns a report with the status of every case and shard, which is also
+    written to output_folder/sharded_predict_report.json.
+    """
+    devices = default_devices() if devices is None else list(devices)
+    maybe_mkdir_p(output_folder)
+    todo = [i for i, c in enumerate(case_identifiers)
+            if overwrite or not os.path.isfile(join(output_folder, c + file_ending))]
+    weights = {i: case_voxels(list_of_lists[i]) for i in todo}
+    shards = balance_shards([list_of_lists[i] for i in todo], len(devices), [weights[i] for i in todo])
+    shards = [[todo[j] for j in shard] for shard in shards]
+
+    n_cpu_workers = sum(1 for d in devices if torch.device(d).type == 'cpu')
+    cpu_budget = num_threads if num_threads is not None else (os.cpu_count() or 1)
+    threads_per_cpu_worker = max(1, cpu_budget // max(1, n_cpu_workers))
+
+    report = {'cases': {}, 'shards': {}}
+    context = multiprocessing.get_context('spawn')
+    progress_queue = context.Queue()
+    workers = {}
+    for shard_id, (device, shard) in enumerate(zip(devices, shards)):
+        if not shard:
+            continue
+        cases = [(case_identifiers[i], list_of_lists[i]) for i in shard]
+        report['shards'][shard_id] = {'device': device, 'n_cases': len(shard),
+                                      'voxels': int(sum(weights[i] for i in shard)), 'seconds': 0.0}
+        for case_identifier, _ in cases:
+            report['cases'][case_identifier] = {'shard': shard_id, 'status': 'pending'}
+        worker = context.Process(target=_shard_worker,
+                                 args=(shard_id, cases, output_folder, model_folder, tuple(folds), checkpoint_name,
+                                       device, threads_per_cpu_worker, preset, preset_overrides, progress_queue))
+        worker.start()
+        workers[shard_id] = worker
+
+    n_total = len(todo)
+    n_finished_cases = 0
+    running = set(workers)
+    start = time.perf_counter()
+    while running:
+        try:
+            status, shard_id, case_identifier, seconds, error = progress_queue.get(timeout=5)
+        except queue.Empty:
+            # a worker that died without reporting leaves its remaining cases failed
+            for shard_id in [s for s in running if not workers[s].is_alive()]:
+                running.discard(shard_id)
+                for case in report['cases'].values():
+                    if case['shard'] == shard_id and case['status'] == 'pending':
+                        case['status'] = 'failed'
+                        case['error'] = f'worker exited with code {workers[shard_id].exitcode}'
+            continue
+        if status == 'finished':
+            running.discard(shard_id)
+            continue
+        n_finished_cases += 1
+        report['cases'][case_identifier].update({'status': status, 'seconds': seconds})
+        report['shards'][shard_id]['seconds'] += seconds
+        if error is not None:
+            report['cases'][case_identifier]['error'] = error
+        print(f"[{n_finished_cases}/{n_total}] {case_identifier} {status} on shard {shard_id} "
+              f"({report['shards'][shard_id]['device']}) in {seconds:.1f} s")
+
+    for worker in workers.values():
+        worker.join()
+    report['seconds'] = time.perf_counter() - start
+    report['failed'] = sorted(c for c, v in report['cases'].items() if v['status'] != 'done')
+    save_json(report, join(output_folder, 'sharded_predict_report.json'), sort_keys=False)
+    if report['failed']:
+        print(f"{len(report['failed'])} cases failed: {report['failed']}")
+    return report
@@ -0,0 +1,291 @@
+import os
+import time
+import queue
+import threading
+import traceback
+
+from batchgenerators.utilities.file_and_folder_operations import join, maybe_mkdir_p
+from tools.case_index import parse_channel_file
+
+# marks the end of a stream between pipeline stages
+_DONE = object()
+# how often blocked stages check whether the pipeline was aborted
+_POLL_SECONDS = 0.5
+
+
+class _Aborted(Exception):
+    pass
+
+
+class _StageEnd:
+    """
+    Counts the workers of a stage that finished; the last one sends one end marker per worker of the next stage.
+    """
+    def __init__(self, n_workers, n_next_workers):
+        self.remaining = n_workers
+        self.n_next_workers = n_next_workers
+        self.lock = threading.Lock()
+
+    def worker_done(self, put, next_queue):
+        with self.lock:
+            self.remaining -= 1
+            last = self.remaining == 0
+        if last:
+            for _ in range(self.n_next_workers):
+                put(next_queue, _DONE)
+
+
+def scan_folder_cases(folder, file_ending='.nii.gz', num_channels=4):
+    """
+    One pass over folder. Returns {case_identifier: [channel files]} for the cases that have all
+    num_channels channel files (CASE_XXXX<file_ending>), together with the size of each file.
+    """
+    cases = {}
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            parsed = parse_channel_file(entry.name, file_ending)
+            if parsed is None or not entry.is_file():
+                continue
+            case_identifier, channel = parsed
+            cases.setdefault(case_identifier, {})[channel] = (entry.path, entry.stat().st_size)
+    complete = {}
+    for case_identifier, channels in cases.items():
+        if sorted(channels) == list(range(num_channels)):
+            complete[case_identifier] = [channels[c] for c in range(num_channels)]
+    return complete
+
+
+def watch_folder(folder, file_ending='.nii.gz', num_channels=4, poll_interval=5.0, idle_timeout=None, stop_event=None):
+    """
+    Yield (case_identifier, list_of_files) for every complete case that appears in folder.
+    A case is only handed out once the sizes of its files did not change between two polls,
+    so files that are still being copied are not read. The generator ends after idle_timeout
+    seconds without a new case (never if None) or when stop_event is set.
+    """
+    seen = set()
+    previous_sizes = {}
+    last_new_case = time.monotonic()
+    while stop_event is None or not stop_event.is_set():
+        for case_identifier, files in sorted(scan_folder_cases(folder, file_ending, num_channels).items()):
+            if case_identifier in seen:
+                continue
+            sizes = [size for _, size in files]
+            if previous_sizes.get(case_identifier) == sizes:
+                seen.add(case_identifier)
+                previous_sizes.pop(case_identifier)
+                last_new_case = time.monotonic()
+                yield case_identifier, [path for path, _ in files]
+            else:
+                previous_sizes[case_identifier] = sizes
+        if idle_timeout is not None and time.monotonic() - last_new_case > idle_timeout:
+            return
+        if stop_event is not None:
+            stop_event.wait(poll_interval)
+        else:
+            time.sleep(poll_interval)
+
+
+def iter_queue(case_queue, stop_event=None):
+    """
+    Yield (case_identifier, list_of_files) items from a queue.Queue until a None item is received
+    or stop_event is set.
+    """
+    while stop_event is None or not stop_event.is_set():
+        try:
+            item = case_queue.get(timeout=_POLL_SECONDS)
+        except queue.Empty:
+            continue
+        if item is None:
+            return
+        yield item
+
+
+class StreamingPredictor:
+    """
+    Predict cases as they arrive. Preprocessing, the network forward pass and the NIfTI export run
+    as overlapping stages in their own threads, connected by bounded queues, so the device keeps
+    working while the previous case is exported and the next ones are preprocessed.
+    max_queue_size bounds the number of preprocessed volumes and logits held in memory at once.
+    num_inference_workers cases are predicted side by side, each by its own predictor of the session
+    (see PredictorSession.predictors); on CPU the torch threads should be split accordingly (set_cpu_threads).
+    save_probabilities is False, True (nnU-Net's float32 .npz) or 'uint8' / 'float16' for the compact
+    memory-mappable maps of tools.probability_store.
+    Setting stop_event (or calling stop) ends the stream after the cases already taken are written. A case that
+    fails in any stage is reported as (case_identifier, None), its traceback kept in failures, and the stream
+    goes on.
+    """
+    def __init__(self, session, output_folder, max_queue_size=2, num_preprocessing_workers=2, num_export_workers=2,
+                 save_probabilities=False, overwrite=False, stop_event=None, num_inference_workers=1):
+        self.session = session
+        self.predictor = session.predictor
+        self.output_folder = output_folder
+        self.max_queue_size = max_queue_size
+        self.num_preprocessing_workers = num_preprocessing_workers
+        self.num_export_workers = num_export_workers
+        self.num_inference_workers = num_inference_workers
+        self.save_probabilities = save_probabilities
+        self.overwrite = overwrite
+        self.stop_event = threading.Event() if stop_event is None else stop_event
+        # set when the consumer stops early or a stage fails: every stage leaves at its next queue operation
+        self._abort = threading.Event()
+        self.failures = {}
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _put(self, q, item):
+        while not self._abort.is_set():
+            try:
+                q.put(item, timeout=_POLL_SECONDS)
+                return
+            except queue.Full:
+                pass
+        raise _Aborted()
+
+    def _get(self, q):
+        while not self._abort.is_set():
+            try:
+                return q.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                pass
+        raise _Aborted()
+
+    def _case_failed(self, case_identifier, out_queue, stage_name):
+        self.failures[case_identifier] = traceback.format_exc()
+        print(f"{case_identifier}: {stage_name} failed, skipping the case\n{self.failures[case_identifier]}")
+        out_queue.put((case_identifier, None))
+
+    def _feed(self, cases, in_queue):
+        file_ending = self.predictor.dataset_json['file_ending']
+        for item in cases:
+            if self.stop_event.is_set():
+                break
+            if isinstance(item, tuple):
+                case_identifier, files = item
+            else:
+                files = item
+                case_identifier = parse_channel_file(os.path.basename(files[0]), file_ending)[0]
+            output_file = join(self.output_folder, case_identifier + file_ending)
+            if not self.overwrite and os.path.isfile(output_file):
+                continue
+            self._put(in_queue, (case_identifier, files))
+        for _ in range(self.num_preprocessing_workers):
+            self._put(in_queue, _DONE)
+
+    def _preprocess_worker(self, in_queue, preprocessed_queue, out_queue, stage_end):
+        while True:
+            item = self._get(in_queue)
+            if item is _DONE:
+                break
+            case_identifier, files = item
+            try:
+                data, properties = self.session.preprocess(files, case_identifier)
+            except Exception:
+                self._case_failed(case_identifier, out_queue, 'preprocessing')
+                continue
+            self._put(preprocessed_queue, (case_identifier, data, properties))
+            del data
+        stage_end.worker_done(self._put, preprocessed_queue)
+
+    def _inference_worker(self, predictor, preprocessed_queue, logits_queue, out_queue, stage_end):
+        while True:
+            item = self._get(preprocessed_queue)
+            if item is _DONE:
+                break
+            case_identifier, data, properties = item
+            del item
+            try:
+                logits = self.session.predict_logits(data, case_identifier, predictor)
+            except Exception:
+                self._case_failed(case_identifier, out_queue, 'inference')
+                continue
+            finally:
+                del data
+            self._put(logits_queue, (case_identifier, logits, properties))
+            del logits
+        stage_end.worker_done(self._put, logits_queue)
+
+    def _export_worker(self, logits_queue, out_queue):
+        while True:
+            item = self._get(logits_queue)
+            if item is _DONE:
+                break
+            case_identifier, logits, properties = item
+            del item
+            try:
+                output_file = self.session.export(logits, properties, join(self.output_folder, case_identifier),
+                                                  self.save_probabilities, case_identifier)
+            except Exception:
+                self._case_failed(case_identifier, out_queue, 'export')
+                continue
+            finally:
+                del logits
+            out_queue.put((case_identifier, output_file))
+        out_queue.put(_DONE)
+
+    def _guarded(self, target, out_queue, *args):
+        # errors of any stage that are not tied to one case are forwarded to the consumer and abort the pipeline
+        def run():
+            try:
+                target(*args)
+            except _Aborted:
+                pass
+            except BaseException as e:
+                self._abort.set()
+                out_queue.put(e)
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def run(self, cases):
+        """
+        Generator yielding (case_identifier, output_file) as soon as each segmentation is written, or
+        (case_identifier, None) for a case that failed. cases is any iterable of (case_identifier, list_of_files)
+        or of list_of_files, e.g. watch_folder(...) or iter_queue(...). Closing the generator early stops all stages
+        and releases the volumes they hold.
+        """
+        maybe_mkdir_p(self.output_folder)
+        self.failures = {}
+        self._abort.clear()
+        in_queue = queue.Queue(maxsize=self.max_queue_size)
+        preprocessed_queue = queue.Queue(maxsize=self.max_queue_size)
+        logits_queue = queue.Queue(maxsize=self.max_queue_size)
+        out_queue = queue.Queue()
+
+        preprocessing_end = _StageEnd(self.num_preprocessing_workers, self.num_inference_workers)
+        inference_end = _StageEnd(self.num_inference_workers, self.num_export_workers)
+        self._guarded(self._feed, out_queue, cases, in_queue)
+        workers = [self._guarded(self._preprocess_worker, out_queue, in_queue, preprocessed_queue, out_queue,
+                                 preprocessing_end)
+                   for _ in range(self.num_preprocessing_workers)]
+        workers += [self._guarded(self._inference_worker, out_queue, predictor, preprocessed_queue, logits_queue,
+                                  out_queue, inference_end)
+                    for predictor in self.session.predictors(self.num_inference_workers)]
+        workers += [self._guarded(self._export_worker, out_queue, logits_queue, out_queue)
+                    for _ in range(self.num_export_workers)]
+
+        try:
+            remaining = self.num_export_workers
+            while remaining:
+                item = out_queue.get()
+                if item is _DONE:
+                    remaining -= 1
+                elif isinstance(item, BaseException):
+                    raise item
+                else:
+                    yield item
+        finally:
+            # the feeder may be blocked in the cases iterable, it is not joined and leaves once that yields; the
+            # stages leave at their next queue operation, after which nothing is put any more and the queues can be
+            # emptied. stop_event belongs to the caller and may be shared with the next stream, it is left alone.
+            self._abort.set()
+            for worker in workers:
+                worker.join()
+            for q in (in_queue, preprocessed_queue, logits_queue):
+                while True:
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        break
+            if self.failures:
+                print(f"{len(self.failures)} cases failed: {sorted(self.failures)}")
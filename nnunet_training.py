@@ -0,0 +1,154 @@
+import os
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import wraps
+from typing import Optional
+
+import torch
+import nnunetv2.training.nnUNetTrainer.nnUNetTrainer as trainer_module
+
+
+@dataclass
+class TrainingOptions:
+    """
+    Throughput settings of nnU-Net training. None keeps the trainer default.
+
+    num_processes_augmentation: data augmentation worker processes (nnUNet_n_proc_DA)
+    pin_memory: pin the batches in page-locked memory (default: on for cuda)
+    prefetch: number of augmented batches kept ready by the workers
+    batch_size: overrides the batch size of the plans
+    num_iterations_per_epoch / num_val_iterations_per_epoch: length of an epoch
+    use_amp: mixed precision on cuda (on by default)
+    compile: torch.compile the network (nnUNet_compile)
+    save_every: epochs between two checkpoint_latest.pth, i.e. how much work a restart can lose
+    """
+    num_processes_augmentation: Optional[int] = None
+    pin_memory: Optional[bool] = None
+    prefetch: Optional[int] = None
+    batch_size: Optional[int] = None
+    num_iterations_per_epoch: Optional[int] = None
+    num_val_iterations_per_epoch: Optional[int] = None
+    use_amp: bool = True
+    compile: Optional[bool] = None
+    save_every: Optional[int] = None
+
+
+def _disabled_autocast(*args, **kwargs):
+    kwargs['enabled'] = False
+    return torch.autocast(*args, **kwargs)
+
+
+def _augmenter_with(augmenter_class, augmenter_kwargs):
+    # nnU-Net passes num_cached and pin_memory as keywords, so they are overwritten here rather than bound
+    # with functools.partial, whose stored keywords lose against the ones given at the call site
+    @wraps(augmenter_class)
+    def make_augmenter(*args, **kwargs):
+        kwargs.update(augmenter_kwargs)
+        return augmenter_class(*args, **kwargs)
+    return make_augmenter
+
+
+def check_augmenter(dataloader, options=None):
+    """
+    Raise if the pin memory and prefetch settings of options did not reach a multi-process augmenter.
+    Returns the settings the augmenter uses (empty for the single-threaded augmenter).
+    """
+    options = TrainingOptions() if options is None else options
+    if not hasattr(dataloader, 'num_cached'):
+        return {}
+    used = {'num_cached': dataloader.num_cached, 'pin_memory': dataloader.pin_memory}
+    requested = {'num_cached': options.prefetch, 'pin_memory': options.pin_memory}
+    wrong = {k: (v, used[k]) for k, v in requested.items() if v is not None and used[k] != v}
+    if wrong:
+        raise RuntimeError(f"The augmenter did not receive the training options (requested, used): {wrong}")
+    return used
+
+
+@contextmanager
+def training_options_applied(options=None):
+    """
+    Apply the settings that nnU-Net reads from the environment or creates inside the trainer module
+    (augmentation workers, compile, pin memory, prefetch depth, autocast) for the duration of the block.
+    """
+    options = TrainingOptions() if options is None else options
+    environment = {'nnUNet_n_proc_DA': options.num_processes_augmentation,
+                   'nnUNet_compile': None if options.compile is None else ('t' if options.compile else 'f')}
+    augmenter_kwargs = {}
+    if options.pin_memory is not None:
+        augmenter_kwargs['pin_memory'] = options.pin_memory
+    if options.prefetch is not None:
+        augmenter_kwargs['num_cached'] = options.prefetch
+    patches = {}
+    if augmenter_kwargs:
+        patches['NonDetMultiThreadedAugmenter'] = _augmenter_with(trainer_module.NonDetMultiThreadedAugmenter,
+                                                                   augmenter_kwargs)
+    if not options.use_amp:
+        patches['autocast'] = _disabled_autocast
+
+    old_environment = {key: os.environ.get(key) for key in environment}
+    old_attributes = {name: getattr(trainer_module, name) for name in patches}
+    try:
+        for key, value in environment.items():
+            if value is not None:
+                os.environ[key] = str(value)
+        for name, value in patches.items():
+            setattr(trainer_module, name, value)
+        yield
+    finally:
+        for key, value in old_environment.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        for name, value in old_attributes.items():
+            setattr(trainer_module, name, value)
+
+
+def configure_trainer(trainer, options=None):
+    """
+    Set the per-trainer settings. Must be called before the trainer is initialized.
+    """
+    options = TrainingOptions() if options is None else options
+    if options.batch_size is not None:
+        trainer.configuration_manager.configuration['batch_size'] = options.batch_size
+    if options.num_iterations_per_epoch is not None:
+        trainer.num_iterations_per_epoch = options.num_iterations_per_epoch
+    if options.num_val_iterations_per_epoch is not None:
+        trainer.num_val_iterations_per_epoch = options.num_val_iterations_per_epoch
+    if not options.use_amp:
+        trainer.grad_scaler = None
+    if options.save_every is not None:
+        trainer.save_every = options.save_every
+    return trainer
+
+
+def benchmark_dataloader(trainer, num_batches=50, num_warmup_batches=5, options=None):
+    """
+    Draw batches from the training dataloader only, without running the network.
+    Returns batches and samples per second, and the prefetch depth and pin memory setting of the augmenter,
+    which are checked against options.
+    """
+    if not trainer.was_initialized:
+        trainer.initialize()
+    dataloader_train, dataloader_val = trainer.get_dataloaders()
+    try:
+        augmenter_settings = check_augmenter(dataloader_train, options)
+        for _ in range(num_warmup_batches):
+            next(dataloader_train)
+        start = time.perf_counter()
+        n_samples = 0
+        for _ in range(num_batches):
+            batch = next(dataloader_train)
+            n_samples += len(batch['data'])
+        seconds = time.perf_counter() - start
+    finally:
+        for dataloader in (dataloader_train, dataloader_val):
+            if hasattr(dataloader, '_finish'):
+                dataloader._finish()
+    result = {'batches': num_batches, 'samples': n_samples, 'seconds': seconds,
+              'batches_per_second': num_batches / seconds, 'samples_per_second': n_samples / seconds,
+              'batch_size': trainer.batch_size, **augmenter_settings}
+    print(f"dataloader: {result['samples_per_second']:.2f} samples/s ({result['batches_per_second']:.2f} batches/s, "
+          f"batch size {trainer.batch_size})")
+    return result
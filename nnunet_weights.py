@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import struct
+
+import numpy as np
+import torch
+from torch._dynamo import OptimizedModule
+from torch.nn.parallel import DistributedDataParallel as DDP
+
+# Weight-only files in the safetensors layout: an 8 byte little-endian header length, a JSON header with
+# dtype, shape and byte offsets of every tensor (plus string metadata), then the raw tensor data. The data
+# is memory-mapped on load, so nothing is read from disk until a tensor is used.
+WEIGHTS_SUFFIX = '.safetensors'
+_DTYPES = {torch.float64: 'F64', torch.float32: 'F32', torch.float16: 'F16', torch.bfloat16: 'BF16',
+           torch.int64: 'I64', torch.int32: 'I32', torch.int16: 'I16', torch.int8: 'I8', torch.uint8: 'U8',
+           torch.bool: 'BOOL'}
+_TORCH_DTYPES = {name: dtype for dtype, name in _DTYPES.items()}
+
+
+def weights_path_for(checkpoint_path):
+    """
+    Slim weights file written next to a checkpoint, e.g. fold_0/checkpoint_final.safetensors.
+    """
+    return os.path.splitext(checkpoint_path)[0] + WEIGHTS_SUFFIX
+
+
+def save_weights(state_dict, weights_path, metadata=None):
+    """
+    Write a state dict (and a JSON-serializable metadata dict) in the safetensors layout.
+    """
+    # largest item size first (as the safetensors library does): the data section starts 8-byte aligned, so every
+    # tensor then starts at a multiple of its item size and the memory-mapped views are aligned, without gaps
+    tensors = {name: t.detach().cpu().contiguous()
+               for name, t in sorted(state_dict.items(), key=lambda item: -item[1].element_size())}
+    header, offset = {}, 0
+    for name, t in tensors.items():
+        n_bytes = t.numel() * t.element_size()
+        header[name] = {'dtype': _DTYPES[t.dtype], 'shape': list(t.shape), 'data_offsets': [offset, offset + n_bytes]}
+        offset += n_bytes
+    header['__metadata__'] = {'nnunet': json.dumps(metadata or {})}
+    header_bytes = json.dumps(header).encode()
+    # the data section starts 8-byte aligned
+    header_bytes += b' ' * (-len(header_bytes) % 8)
+    part_path = weights_path + '.part'
+    with open(part_path, 'wb') as f:
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        for t in tensors.values():
+            if t.numel():
+                f.write(t.reshape(-1).view(torch.uint8).numpy().tobytes())
+    os.replace(part_path, weights_path)
+    return weights_path
+
+
+def _read_header(weights_path):
+    with open(weights_path, 'rb') as f:
+        header_length = struct.unpack('<Q', f.read(8))[0]
+        return header_length, json.loads(f.read(header_length))
+
+
+def weights_nbytes(path):
+    """
+    Bytes of the network weights in a weights file or an nnU-Net checkpoint, without reading the tensor data.
+    """
+    if path.endswith(WEIGHTS_SUFFIX):
+        header = _read_header(path)[1]
+        return sum(e['data_offsets'][1] - e['data_offsets'][0] for name, e in header.items() if name != '__metadata__')
+    # memory-mapped, only the pickled structure of the checkpoint is read
+    checkpoint = torch.load(path, map_location=torch.device('cpu'), weights_only=False, mmap=True)
+    return sum(t.numel() * t.element_size() for t in checkpoint['network_weights'].values())
+
+
+def load_weights(weights_path):
+    """
+    Memory-map a weights file. Returns (state_dict, metadata); the tensors are backed by the file
+    (copy-on-write) and only read when they are used.
+    """
+    header_length, header = _read_header(weights_path)
+    metadata = json.loads(header.pop('__metadata__', {}).get('nnunet', '{}'))
+    data_start = 8 + header_length
+    data = np.memmap(weights_path, dtype=np.uint8, mode='c', offset=data_start) \
+        if os.path.getsize(weights_path) > data_start else None
+    state_dict = {}
+    for name, entry in header.items():
+        dtype = _TORCH_DTYPES[entry['dtype']]
+        begin, end = entry['data_offsets']
+        if begin == end:
+            state_dict[name] = torch.empty(entry['shape'], dtype=dtype)
+        else:
+            state_dict[name] = torch.from_numpy(data[begin:end]).view(dtype).reshape(entry['shape'])
+    return state_dict, metadata
+
+
+def _current_rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def _rss_increase(function):
+    rss_before = _current_rss_bytes()
+    start = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - start
+    rss_after = _current_rss_bytes()
+    return result, seconds, None if rss_before is None else rss_after - rss_before
+
+
+def _load_and_touch(weights_path):
+    state_dict, metadata = load_weights(weights_path)
+    for t in state_dict.values():
+        if t.numel():
+            t.reshape(-1).view(torch.uint8).sum()
+    return state_dict, metadata
+
+
+def extract_weights(checkpoint_path, weights_path=None):
+    """
+    Write the network weights of an nnU-Net training checkpoint to a slim weights file, leaving out the
+    optimizer and grad scaler state and the training logs. The metadata needed for inference (trainer name,
+    configuration, fold, mirroring axes) is kept. Returns a report comparing the load time, resident memory
+    increase and size of the checkpoint against the weights file; both are measured with every tensor read.
+    """
+    weights_path = weights_path_for(checkpoint_path) if weights_path is None else weights_path
+    checkpoint, checkpoint_seconds, checkpoint_rss = _rss_increase(
+        lambda: torch.load(checkpoint_path, map_location=torch.device('cpu'), weights_only=False))
+    axes = checkpoint.get('inference_allowed_mirroring_axes')
+    metadata = {'trainer_name': checkpoint['trainer_name'],
+                'configuration': checkpoint['init_args']['configuration'],
+                'fold': checkpoint['init_args'].get('fold'),
+                'inference_allowed_mirroring_axes': None if axes is None else [int(a) for a in axes]}
+    save_weights(checkpoint['network_weights'], weights_path, metadata)
+    del checkpoint
+
+    # the memory-mapped tensors are only read when used, so every tensor is touched before RSS is measured,
+    # like torch.load which reads the whole checkpoint
+    (state_dict, _), weights_seconds, weights_rss = _rss_increase(lambda: _load_and_touch(weights_path))
+    del state_dict
+    report = {'checkpoint_path': checkpoint_path, 'weights_path': weights_path,
+              'checkpoint_bytes': os.path.getsize(checkpoint_path), 'weights_bytes': os.path.getsize(weights_path),
+              'checkpoint_load_seconds': checkpoint_seconds, 'weights_load_seconds': weights_seconds,
+              'checkpoint_load_rss_bytes': checkpoint_rss, 'weights_load_rss_bytes': weights_rss}
+    print(f"{weights_path}: {report['weights_bytes'] / 1024 ** 2:.1f} MB instead of "
+          f"{report['checkpoint_bytes'] / 1024 ** 2:.1f} MB, loads in {weights_seconds:.3f} s instead of {checkpoint_seconds:.3f} s")
+    return report
+
+
+def load_pretrained_weights(network, weights_path, skip_strings=('.seg_layers.',)):
+    """
+    Same checks and transfer as nnU-Net's load_pretrained_weights, from a slim weights file: every
+    parameter except the segmentation heads must exist in the weights with the same shape.
+    """
+    pretrained, _ = load_weights(weights_path)
+    module = network.module if isinstance(network, DDP) else network
+    if isinstance(module, OptimizedModule):
+        module = module._orig_mod
+    model_dict = module.state_dict()
+    for key, value in model_dict.items():
+        if all(s not in key for s in skip_strings):
+            if key not in pretrained:
+                raise RuntimeError(f"Key {key} is missing in the pretrained weights {weights_path}")
+            if pretrained[key].shape != value.shape:
+                raise RuntimeError(f"The shape of {key} does not match: pretrained {tuple(pretrained[key].shape)}, "
+                                   f"network {tuple(value.shape)}")
+    model_dict.update({k: v for k, v in pretrained.items() if k in model_dict and all(s not in k for s in skip_strings)})
+    module.load_state_dict(model_dict)
+    print(f"Loaded pretrained weights from {weights_path}")
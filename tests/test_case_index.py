@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+from tools.case_index import parse_channel_file, index_case_files, find_incomplete_cases, case_lists_from_folder
+
+DATASET_JSON = {'file_ending': '.nii.gz', 'channel_names': {'0': 't1c', '1': 't1n', '2': 't2f', '3': 't2w'}}
+
+
+def _touch(folder, *file_names):
+    for file_name in file_names:
+        open(os.path.join(folder, file_name), 'w').close()
+
+
+def test_parse_channel_file():
+    assert parse_channel_file('BraTS-GLI-00160-000_0001.nii.gz') == ('BraTS-GLI-00160-000', 1)
+    assert parse_channel_file('BraTS-GLI-00160-000_0001.nii') is None
+    assert parse_channel_file('BraTS-GLI-00160-000_01.nii.gz') is None
+    assert parse_channel_file('_0001.nii.gz') is None
+
+
+def test_find_incomplete_cases():
+    case_index = {'complete': {0: 'a', 1: 'b'}, 'missing': {1: 'c'}, 'extra': {0: 'd', 1: 'e', 3: 'f'}}
+    assert find_incomplete_cases(case_index, 2) == {'missing': [0], 'extra': [-3]}
+
+
+def test_case_lists_from_folder(tmp_path):
+    # natural order: case 2 before case 10, channels in channel order whatever the listing order
+    for case in ('case_10', 'case_2'):
+        _touch(tmp_path, *[f'{case}_{c:04d}.nii.gz' for c in (3, 0, 2, 1)])
+    _touch(tmp_path, 'dataset.json', 'case_2_0000.nii')
+    case_identifiers, list_of_lists = case_lists_from_folder(str(tmp_path), DATASET_JSON)
+    assert case_identifiers == ['case_2', 'case_10']
+    assert list_of_lists[0] == [os.path.join(str(tmp_path), f'case_2_{c:04d}.nii.gz') for c in range(4)]
+    _, file_names = case_lists_from_folder(str(tmp_path), DATASET_JSON, join_path=False)
+    assert file_names[1] == [f'case_10_{c:04d}.nii.gz' for c in range(4)]
+
+
+def test_case_lists_from_folder_rejects_incomplete_cases(tmp_path):
+    _touch(tmp_path, *[f'case_1_{c:04d}.nii.gz' for c in range(4)])
+    _touch(tmp_path, *[f'case_2_{c:04d}.nii.gz' for c in (0, 1, 2)])
+    assert sorted(index_case_files(str(tmp_path))) == ['case_1', 'case_2']
+    with pytest.raises(ValueError, match=r'case_2 \(\[3\]\)'):
+        case_lists_from_folder(str(tmp_path), DATASET_JSON)
@@ -0,0 +1,50 @@
+import pytest
+
+from tools.dicom_ingest import match_channel, plan_cases
+
+
+@pytest.mark.parametrize('series_description, channel', [
+    ('T1 MPRAGE +C', 't1c'),
+    ('t1_se_tra_GD', 't1c'),
+    ('AX T1 POST', 't1c'),
+    ('T1 CE', 't1c'),
+    ('AX T2 FLAIR', 't2f'),
+    ('t2_tse_tra', 't2w'),
+    ('T1 AX pre', 't1n'),
+    ('DWI b1000', None),
+])
+def test_match_channel(series_description, channel):
+    assert match_channel(series_description) == channel
+
+
+def test_match_channel_custom_rules_in_order():
+    rules = {'flair': r'flair', 't2': r't2'}
+    assert match_channel('T2 FLAIR', rules) == 'flair'
+    assert match_channel('T2 FLAIR', (('t2', r't2'), ('flair', r'flair'))) == 't2'
+
+
+def _series(patient_id, study_uid, study_date, description, n_files):
+    return {'patient_id': patient_id, 'study_uid': study_uid, 'study_date': study_date,
+            'series_description': description, 'modality': 'MR', 'files': ['f'] * n_files}
+
+
+def test_plan_cases():
+    descriptions = {'t1n': 'T1 pre', 't1c': 'T1 +C', 't2w': 'T2 TSE', 't2f': 'FLAIR'}
+    series = {}
+    # two complete studies of one patient, numbered by date whatever the uid order
+    for study_uid, study_date in (('1.2.9', '20240301'), ('1.2.1', '20230101')):
+        for channel, description in descriptions.items():
+            series[f'{study_uid}.{channel}'] = _series('P^01', study_uid, study_date, description, 100)
+    # a second FLAIR with more slices replaces the first one, a localizer matches no rule
+    series['1.2.1.t2f.fine'] = _series('P^01', '1.2.1', '20230101', 'FLAIR 1mm', 160)
+    series['1.2.1.loc'] = _series('P^01', '1.2.1', '20230101', 'localizer', 3)
+    # a study without T2
+    for channel in ('t1n', 't1c', 't2f'):
+        series[f'3.4.{channel}'] = _series('', '3.4', '20220101', descriptions[channel], 100)
+
+    cases, incomplete, skipped = plan_cases(series)
+    assert sorted(cases) == ['P01-001', 'P01-002']
+    assert cases['P01-001'] == {'t1n': '1.2.1.t1n', 't1c': '1.2.1.t1c', 't2w': '1.2.1.t2w', 't2f': '1.2.1.t2f.fine'}
+    assert cases['P01-002']['t2f'] == '1.2.9.t2f'
+    assert incomplete == {'anonymous-001': ['t2w']}
+    assert sorted(skipped) == ['1.2.1.loc', '1.2.1.t2f']
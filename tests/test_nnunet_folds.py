@@ -0,0 +1,62 @@
+import os
+import json
+import multiprocessing
+from types import SimpleNamespace
+
+import pytest
+
+import nnunet_api
+import nnunet_folds
+
+
+def _fake_finetune(self, fold, device, continue_training, on_epoch_end, training_options=None, **kwargs):
+    # stands in for the nnU-Net trainer: one epoch, a checkpoint, and the failures the scheduler must handle
+    output_folder = nnunet_folds.fold_output_folder(None, None, None, None, fold)
+    os.makedirs(output_folder, exist_ok=True)
+    open(os.path.join(output_folder, 'checkpoint_latest.pth'), 'w').close()
+    log = {'train_losses': [0.5], 'val_losses': [0.6], 'ema_fg_dice': [0.7]}
+    on_epoch_end(SimpleNamespace(current_epoch=1, num_epochs=2, logger=SimpleNamespace(my_fantastic_logging=log)))
+    if fold == 1 and not continue_training:
+        raise RuntimeError('worker killed')
+    if fold == 2:
+        raise RuntimeError('always fails')
+
+
+@pytest.fixture
+def mocked_folds(tmp_path, monkeypatch):
+    # fork instead of spawn so that the fold processes inherit the mocked trainer
+    get_context = multiprocessing.get_context
+    monkeypatch.setattr(multiprocessing, 'get_context', lambda method=None: get_context('fork'))
+    monkeypatch.setattr(nnunet_api.NnUnetApi, 'finetune', _fake_finetune)
+    monkeypatch.setattr(nnunet_folds, 'prepare_shared_data', lambda *args, **kwargs: None)
+    monkeypatch.setattr(nnunet_folds, 'fold_output_folder',
+                        lambda *args: str(tmp_path / 'model' / f'fold_{args[-1]}'))
+    return tmp_path
+
+
+def test_status_and_restarts(mocked_folds):
+    status_file = str(mocked_folds / 'status.json')
+    status = nnunet_folds.finetune_folds('Dataset999_Test', '3d_fullres', [0, 1, 2], 'pretrained.pth',
+                                         devices=['cpu', 'cpu'], num_threads=2, max_restarts=1,
+                                         status_file=status_file, poll_interval=0.05)
+    assert status[0]['state'] == 'done' and status[0]['attempts'] == 1
+    # restarted from its checkpoint after the first attempt failed
+    assert status[1]['state'] == 'done' and status[1]['attempts'] == 2 and status[1]['error'] is None
+    assert status[2]['state'] == 'failed' and status[2]['attempts'] == 2
+    assert 'always fails' in status[2]['error']
+    for fold in (0, 1):
+        assert status[fold]['epoch'] == 1 and status[fold]['ema_fg_dice'] == 0.7
+        assert status[fold]['device'] == 'cpu'
+    with open(status_file) as f:
+        written = json.load(f)
+    assert {int(fold): s['state'] for fold, s in written['folds'].items()} == {0: 'done', 1: 'done', 2: 'failed'}
+    assert 'fold 2' in nnunet_folds.format_status(status)
+
+
+def test_resume_continues_from_checkpoints(mocked_folds):
+    os.makedirs(str(mocked_folds / 'model' / 'fold_1'))
+    open(str(mocked_folds / 'model' / 'fold_1' / 'checkpoint_latest.pth'), 'w').close()
+    status = nnunet_folds.finetune_folds('Dataset999_Test', '3d_fullres', [1], 'pretrained.pth', devices=['cpu'],
+                                         num_threads=1, max_restarts=0, resume=True,
+                                         status_file=str(mocked_folds / 'status.json'), poll_interval=0.05)
+    assert status[1]['state'] == 'done' and status[1]['attempts'] == 1
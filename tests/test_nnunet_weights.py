@@ -0,0 +1,56 @@
+import json
+import struct
+
+import torch
+
+from nnunet_weights import save_weights, load_weights, weights_nbytes
+
+
+def _state_dict():
+    # odd-sized tensors between 8 byte ones, as the num_batches_tracked and bool buffers of a real network
+    return {'encoder.0.weight': torch.randn(3, 2, 3, dtype=torch.float32),
+            'encoder.0.num_batches_tracked': torch.tensor(7, dtype=torch.int64),
+            'mask': torch.tensor([True, False, True]),
+            'encoder.1.weight': torch.randn(5, dtype=torch.float64),
+            'labels': torch.arange(3, dtype=torch.uint8),
+            'encoder.1.bias': torch.randn(3, dtype=torch.float16),
+            'counts': torch.arange(5, dtype=torch.int16),
+            'empty': torch.empty(0, 4)}
+
+
+def test_round_trip(tmp_path):
+    state_dict = _state_dict()
+    weights_path = str(tmp_path / 'checkpoint_final.safetensors')
+    save_weights(state_dict, weights_path, {'trainer_name': 'nnUNetTrainer', 'fold': 0})
+    loaded, metadata = load_weights(weights_path)
+    assert metadata == {'trainer_name': 'nnUNetTrainer', 'fold': 0}
+    assert set(loaded) == set(state_dict)
+    for name, tensor in state_dict.items():
+        assert loaded[name].dtype == tensor.dtype
+        assert torch.equal(loaded[name], tensor)
+    assert weights_nbytes(weights_path) == sum(t.numel() * t.element_size() for t in state_dict.values())
+
+
+def test_offsets_are_aligned(tmp_path):
+    weights_path = str(tmp_path / 'weights.safetensors')
+    save_weights(_state_dict(), weights_path)
+    with open(weights_path, 'rb') as f:
+        header_length = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_length))
+    assert (8 + header_length) % 8 == 0
+    item_sizes = {'F64': 8, 'I64': 8, 'F32': 4, 'F16': 2, 'I16': 2, 'U8': 1, 'BOOL': 1}
+    offsets = sorted(entry['data_offsets'] for name, entry in header.items() if name != '__metadata__')
+    for name, entry in header.items():
+        if name != '__metadata__':
+            assert entry['data_offsets'][0] % item_sizes[entry['dtype']] == 0
+    # the tensors follow each other without gaps, as the safetensors format requires
+    assert offsets[0][0] == 0
+    assert all(a[1] == b[0] for a, b in zip(offsets, offsets[1:]))
+
+
+def test_weights_nbytes_of_checkpoint(tmp_path):
+    state_dict = _state_dict()
+    checkpoint_path = str(tmp_path / 'checkpoint_final.pth')
+    torch.save({'network_weights': state_dict, 'optimizer_state': {'momentum': torch.randn(100)},
+                'trainer_name': 'nnUNetTrainer'}, checkpoint_path)
+    assert weights_nbytes(checkpoint_path) == sum(t.numel() * t.element_size() for t in state_dict.values())
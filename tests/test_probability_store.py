@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from tools.probability_store import write_probabilities, ProbabilityMap, CHUNKS_SUFFIX
+
+
+@pytest.mark.parametrize('dtype', ['uint8', 'float16'])
+def test_every_chunk_constant(tmp_path, dtype):
+    # background everywhere, as the empty prediction of a tumor-free case
+    probabilities = np.zeros((3, 40, 70, 70), dtype=np.float32)
+    probabilities[0] = 1
+    output_file_truncated = str(tmp_path / 'case')
+    n_bytes = write_probabilities(probabilities, output_file_truncated, dtype)
+    assert np.load(output_file_truncated + CHUNKS_SUFFIX).shape[0] == 0
+    assert n_bytes < 4096
+    prob = ProbabilityMap(output_file_truncated)
+    assert prob.shape == probabilities.shape
+    np.testing.assert_array_equal(prob.read(), probabilities)
+    np.testing.assert_array_equal(prob.read((slice(35, 40), slice(60, 70), slice(0, 9)), channels=[0]),
+                                  probabilities[:1, 35:40, 60:70, 0:9])
+
+
+def test_mixed_chunks(tmp_path):
+    rng = np.random.default_rng(0)
+    probabilities = np.zeros((2, 40, 70, 70), dtype=np.float32)
+    probabilities[1, 30:38, 60:66, 10:20] = rng.random((8, 6, 10))
+    probabilities[0] = 1 - probabilities[1]
+    output_file_truncated = str(tmp_path / 'case')
+    write_probabilities(probabilities, output_file_truncated, 'float16', chunk_shape=(32, 64, 64))
+    prob = ProbabilityMap(output_file_truncated)
+    np.testing.assert_allclose(prob.read(), probabilities, atol=1e-3)
+    np.testing.assert_allclose(prob[28:40, 58:70, 5:25], probabilities[:, 28:40, 58:70, 5:25], atol=1e-3)
@@ -0,0 +1,119 @@
+import os
+from tools.paths_dirs_stuff import natural_sort_key
+
+
+def parse_channel_file(file_name, file_ending='.nii.gz'):
+    """
+    split a Decathlon image file name into case identifier and channel.
+
+    Parameters
+    ----------
+    file_name : string
+        file name such as 'BraTS-GLI-00160-000_0001.nii.gz'.
+    file_ending : string
+        file extension of the dataset.
+
+    Returns
+    -------
+    tuple or None
+        (case_identifier, channel) e.g. ('BraTS-GLI-00160-000', 1), None if the
+        name does not follow the CASE_XXXX<file_ending> convention.
+
+    """
+    if not file_name.endswith(file_ending):
+        return None
+    case_identifier, _, channel = file_name[:-len(file_ending)].rpartition('_')
+    if not case_identifier or len(channel) != 4 or not channel.isdigit():
+        return None
+    return case_identifier, int(channel)
+
+
+def index_case_files(folder, file_ending='.nii.gz'):
+    """
+    group the channel files of a folder by case in a single directory scan.
+
+    Parameters
+    ----------
+    folder : string
+        absolute path of a folder with Decathlon named images.
+    file_ending : string
+        file extension of the dataset.
+
+    Returns
+    -------
+    case_index : dict
+        case identifier -> {channel: file name}.
+
+    """
+    case_index = {}
+    for file_name in os.listdir(folder):
+        parsed = parse_channel_file(file_name, file_ending)
+        if parsed is None:
+            continue
+        case_identifier, channel = parsed
+        case_index.setdefault(case_identifier, {})[channel] = file_name
+    return case_index
+
+
+def find_incomplete_cases(case_index, num_channels):
+    """
+    check every case for the channels 0 .. num_channels-1.
+
+    Returns
+    -------
+    incomplete : dict
+        case identifier -> sorted list of missing channels (unexpected extra
+        channels are reported as negative numbers), only for incomplete cases.
+
+    """
+    expected = set(range(num_channels))
+    incomplete = {}
+    for case_identifier, channels in case_index.items():
+        problems = sorted(expected - set(channels)) + sorted(-c for c in set(channels) - expected)
+        if problems:
+            incomplete[case_identifier] = problems
+    return incomplete
+
+
+def case_lists_from_folder(folder, dataset_json, join_path=True):
+    """
+    build the nnU-Net input list: one list of channel files (in channel order) per case.
+
+    Parameters
+    ----------
+    folder : string
+        absolute path of a folder with Decathlon named images.
+    dataset_json : dict
+        dataset.json of the model/dataset, gives 'file_ending' and 'channel_names'.
+    join_path : bool
+        return absolute paths instead of file names.
+
+    Returns
+    -------
+    case_identifiers : list
+        naturally sorted case identifiers.
+    list_of_lists : list
+        list of channel files of each case.
+
+    Raises
+    ------
+    ValueError
+        if any case misses channels declared in dataset_json.
+
+    """
+    num_channels = len(dataset_json['channel_names'])
+    case_index = index_case_files(folder, dataset_json['file_ending'])
+    incomplete = find_incomplete_cases(case_index, num_channels)
+    if incomplete:
+        details = ', '.join('{} ({})'.format(case, problems) for case, problems in sorted(incomplete.items()))
+        raise ValueError("{} of {} cases in {} do not have exactly the channels 0..{} "
+                         "(missing / unexpected as negative): {}".format(len(incomplete), len(case_index), folder,
+                                                                         num_channels - 1, details))
+    case_identifiers = sorted(case_index, key=natural_sort_key)
+    list_of_lists = []
+    for case_identifier in case_identifiers:
+        files = [case_index[case_identifier][c] for c in range(num_channels)]
+        if join_path:
+            files = [os.path.join(folder, f) for f in files]
+        list_of_lists.append(files)
+    return case_identifiers, list_of_lists
@@ -1,16 +1,94 @@
 import os
 import shutil
-import numpy as np
-from tools.sitk_stuff import read_nifti
-from tools.writer import write_nifti_from_itk, write_nifti_from_vol
-from tools.paths_dirs_stuff import path_contents_pattern, path_contents, create_path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from tools.paths_dirs_stuff import path_contents_pattern, path_contents, create_path, place_file
+from tools.case_index import index_case_files, find_incomplete_cases
+from tools.postprocess import remap_label_folder
+from tools.geometry_index import build_geometry_index, find_geometry_mismatches
+from tools.profiling import stage, profiled
 
 
-def data_prepare(in_path, out_path):
+# BraTS file suffix -> Decathlon channel suffix ('' is the segmentation mask)
+BRATS_MODALITIES = {'t1n.nii.gz': '_0000',
+                    't1c.nii.gz': '_0001',
+                    't2w.nii.gz': '_0002',
+                    't2f.nii.gz': '_0003',
+                    'seg.nii.gz': ''}
+
+MANIFEST_NAME = '.data_prepare_manifest'
+
+
+def classify_case_files(case_path):
+    """
+    list a subject folder once and map each BraTS modality to its file name
+    :param case_path: Abs path to a single BraTS subject folder
+    :return: dict of BraTS suffix (e.g. 't1n.nii.gz') -> file name
+    """
+    case_files = {}
+    for file_name in path_contents(case_path):
+        for suffix in BRATS_MODALITIES:
+            if file_name.endswith(suffix) and suffix not in case_files:
+                case_files[suffix] = file_name
+                break
+    missing = [suffix for suffix in BRATS_MODALITIES if suffix not in case_files]
+    if missing:
+        raise FileNotFoundError("case {} is missing {}".format(case_path, missing))
+    return case_files
+
+
+def prepare_case(case, in_path, out_path_img, out_path_mask, link_mode='copy'):
+    """
+    place the files of one BraTS subject into the Decathlon folders
+    :param case: subject folder name, used as case identifier
+    :param in_path: Abs path to standard BraTS data
+    :param out_path_img: Abs path to imagesTr
+    :param out_path_mask: Abs path to labelsTr
+    :param link_mode: see tools.paths_dirs_stuff.place_file
+    :return: the case identifier
+    """
+    with stage('data_prepare.case', case=case):
+        case_path = os.path.join(in_path, case)
+        case_files = classify_case_files(case_path)
+        for suffix, channel in BRATS_MODALITIES.items():
+            dst_folder = out_path_mask if channel == '' else out_path_img
+            src = os.path.join(case_path, case_files[suffix])
+            dst = os.path.join(dst_folder, case + channel + '.nii.gz')
+            if not os.path.exists(dst):
+                # place under a temporary name so an interrupted run never leaves a truncated file behind;
+                # a .part left by an interrupted run may be a hardlink of the source, remove it first
+                if os.path.lexists(dst + '.part'):
+                    os.remove(dst + '.part')
+                place_file(src, dst + '.part', link_mode)
+                os.replace(dst + '.part', dst)
+    return case
+
+
+def read_manifest(out_path):
+    """
+    read the cases already completed by a previous data_prepare run
+    :param out_path: Abs path of the Decathlon dataset
+    :return: set of case identifiers
+    """
+    manifest_path = os.path.join(out_path, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return set()
+    with open(manifest_path, 'r') as handle:
+        return set(line.strip() for line in handle if line.strip())
+
+
+@profiled('data_prepare')
+def data_prepare(in_path, out_path, num_workers=1, use_processes=False, link_mode='copy', use_manifest=True,
+                 check_geometry=False):
     """
     reformulate the standard brats data structure into Decathlon file naming convention
     :param in_path: Abs path to standard BraTS data: each subject presented by a separate folder
     :param out_path: Abs path to saving image data in Decathlon format
+    :param num_workers: number of cases prepared concurrently
+    :param use_processes: use a process pool instead of a thread pool
+    :param link_mode: 'copy', 'hardlink', 'reflink' or 'auto' (link when possible, copy otherwise)
+    :param use_manifest: record completed cases in out_path so that an interrupted run resumes
+    :param check_geometry: update the geometry index of out_path and report cases whose channels and
+        label do not share the same geometry
     :return:
     """
     print('-'*8)
@@ -19,42 +97,59 @@ def data_prepare(in_path, out_path):
     out_path_mask = os.path.join(out_path, "labelsTr")
     create_path(out_path_img)
     create_path(out_path_mask)
+
+    done = read_manifest(out_path) if use_manifest else set()
+    todo = [case for case in subjects if case not in done]
     n_subjects = len(subjects)
-    for ix, case in enumerate(subjects):
-        print("data reformat in process for case {} out of {} ...".format(ix + 1, n_subjects))
+    if done:
+        print("{} out of {} cases already reformated, resuming ...".format(n_subjects - len(todo), n_subjects))
 
-        case_path = os.path.join(in_path, case)
-        case_t1n = path_contents_pattern(case_path, 't1n.nii.gz')[0]
-        case_t1c = path_contents_pattern(case_path, 't1c.nii.gz')[0]
-        case_t2w = path_contents_pattern(case_path, 't2w.nii.gz')[0]
-        case_t2f = path_contents_pattern(case_path, 't2f.nii.gz')[0]
-        case_sg = path_contents_pattern(case_path, 'seg.nii.gz')[0]
-        decathlon_t1n_name = case+'_0000.nii.gz'
-        decathlon_t1c_name = case+'_0001.nii.gz'
-        decathlon_t2w_name = case+'_0002.nii.gz'
-        decathlon_t2f_name = case+'_0003.nii.gz'
-        decathlon_sg_name = case + '.nii.gz'
-        t1n_src = os.path.join(case_path, case_t1n)
-        t1c_src = os.path.join(case_path, case_t1c)
-        t2w_src = os.path.join(case_path, case_t2w)
-        t2f_src = os.path.join(case_path, case_t2f)
-        sg_src = os.path.join(case_path, case_sg)
-        t1n_dst = os.path.join(out_path_img, decathlon_t1n_name)
-        t1c_dst = os.path.join(out_path_img, decathlon_t1c_name)
-        t2w_dst = os.path.join(out_path_img, decathlon_t2w_name)
-        t2f_dst = os.path.join(out_path_img, decathlon_t2f_name)
-        sg_dst = os.path.join(out_path_mask, decathlon_sg_name)
-
-        if not os.path.exists(t1n_dst):
-            shutil.copy(t1n_src, t1n_dst)
-        if not os.path.exists(t1c_dst):
-            shutil.copy(t1c_src, t1c_dst)
-        if not os.path.exists(t2w_dst):
-            shutil.copy(t2w_src, t2w_dst)
-        if not os.path.exists(t2f_dst):
-            shutil.copy(t2f_src, t2f_dst)
-        if not os.path.exists(sg_dst):
-            shutil.copy(sg_src, sg_dst)
+    manifest = open(os.path.join(out_path, MANIFEST_NAME), 'a') if use_manifest else None
+    n_done = n_subjects - len(todo)
+
+    def _case_done(case):
+        print("data reformat done for case {} out of {} ...".format(n_done + len(finished), n_subjects))
+        if manifest is not None:
+            manifest.write(case + '\n')
+            manifest.flush()
+
+    finished = []
+    try:
+        if num_workers <= 1:
+            for case in todo:
+                finished.append(prepare_case(case, in_path, out_path_img, out_path_mask, link_mode))
+                _case_done(case)
+        else:
+            pool_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+            with pool_class(max_workers=num_workers) as pool:
+                futures = [pool.submit(prepare_case, case, in_path, out_path_img, out_path_mask, link_mode)
+                           for case in todo]
+                error = None
+                for future in as_completed(futures):
+                    if future.cancelled():
+                        continue
+                    if future.exception() is not None:
+                        # cases that are already running still finish, they are recorded before the error is raised
+                        if error is None:
+                            error = future.exception()
+                            for pending in futures:
+                                pending.cancel()
+                        continue
+                    finished.append(future.result())
+                    _case_done(finished[-1])
+            if error is not None:
+                raise error
+    finally:
+        if manifest is not None:
+            manifest.close()
+
+    incomplete = find_incomplete_cases(index_case_files(out_path_img), len(BRATS_MODALITIES) - 1)
+    if incomplete:
+        print("WARNING: incomplete cases in {}: {}".format(out_path_img, incomplete))
+    if check_geometry:
+        mismatches = find_geometry_mismatches(build_geometry_index(out_path, num_workers=max(1, num_workers)))
+        if mismatches:
+            print("WARNING: cases with inconsistent geometry: {}".format(mismatches))
 
     print('-' * 8)
     print('All files were reformated, ready for segmentation!')
@@ -74,23 +169,17 @@ def move_preds(nnunet_out, path_out):
         shutil.move(src, dst)
     return None
 
-def remove_additional_label(save_path_preds, save_path_preds_labelRemoved, remove_label):
+@profiled('remove_additional_label')
+def remove_additional_label(save_path_preds, save_path_preds_labelRemoved, remove_label, num_workers=1):
     """
     Removing the additional predicted labels (context labels)
     :param save_path_preds: Abs path where the raw prediciton are stored
     :param save_path_preds_labelRemoved: Abs path where the cleaned prediciton will be stored
-    :param remove_label: Integer showing the label to be removed
+    :param remove_label: Integer (or list of integers) showing the label(s) to be removed
+    :param num_workers: number of predictions processed concurrently
     :return:
     """
-    if not os.path.exists(save_path_preds_labelRemoved):
-        os.makedirs(save_path_preds_labelRemoved)
-    pred_files = path_contents_pattern(save_path_preds, ".nii.gz")
-    for pred_mask in pred_files:
-        src_pred = os.path.join(save_path_preds, pred_mask)
-        dst_pred = os.path.join(save_path_preds_labelRemoved, pred_mask)
-        img_array, img_itk, img_size, img_spacing, img_origin, img_direction = read_nifti(src_pred)
-        img_itk[img_itk==remove_label] = 0
-        write_nifti_from_itk(img_itk, img_origin, img_spacing, img_direction, dst_pred)
-
+    remove_labels = remove_label if isinstance(remove_label, (list, tuple, set)) else [remove_label]
+    remap_label_folder(save_path_preds, save_path_preds_labelRemoved, {label: 0 for label in remove_labels},
+                       num_workers=num_workers)
     return None
-
@@ -0,0 +1,237 @@
+"""
+bulk conversion of a DICOM export into Decathlon-named nifti files (CASE_0000.nii.gz, ...).
+
+e.g.
+    report = ingest_dicom('/mnt/pacs/export', '/mnt/nnunet_raw/Dataset771_New/imagesTs', num_workers=8)
+"""
+import os
+import re
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+import SimpleITK as itk
+from tools.paths_dirs_stuff import create_path
+from tools.writer import write_itk_image
+from tools.json_pickle_stuff import write_json
+from tools.profiling import stage, profiled
+
+# the only tags read while indexing, private tags are never loaded
+INDEX_TAGS = {'patient_id': '0010|0020',
+              'study_uid': '0020|000d',
+              'study_date': '0008|0020',
+              'series_uid': '0020|000e',
+              'series_description': '0008|103e',
+              'modality': '0008|0060',
+              'position': '0020|0032',
+              'orientation': '0020|0037',
+              'instance_number': '0020|0013'}
+
+# (channel, regular expression) rules matched in order against the series description, case-insensitive,
+# the first match wins. the contrast-enhanced T1 and FLAIR rules come before the generic T1 and T2 ones.
+BRATS_SERIES_RULES = (('t1c', r't1.*(\+c|gd|gad|post|contrast|ce\b)'),
+                      ('t2f', r'flair'),
+                      ('t2w', r't2'),
+                      ('t1n', r't1'))
+# channel order of dataset.json, i.e. t1n -> _0000, t1c -> _0001, t2w -> _0002, t2f -> _0003
+BRATS_CHANNELS = ('t1n', 't1c', 't2w', 't2f')
+REPORT_NAME = 'dicom_ingest.json'
+
+
+def read_slice_header(file_path):
+    """
+    read the INDEX_TAGS of one file without decoding the pixel data.
+    returns None for files that are not readable DICOM images.
+    """
+    reader = itk.ImageFileReader()
+    reader.SetImageIO('GDCMImageIO')
+    reader.SetFileName(file_path)
+    reader.LoadPrivateTagsOff()
+    try:
+        reader.ReadImageInformation()
+    except RuntimeError:
+        return None
+    tags = {name: reader.GetMetaData(tag).strip() if reader.HasMetaDataKey(tag) else ''
+            for name, tag in INDEX_TAGS.items()}
+    tags['file'] = file_path
+    return tags
+
+
+def _slice_position(tags):
+    # distance along the slice normal, falls back to the instance number when the geometry tags are missing
+    try:
+        position = np.array(tags['position'].split('\\'), dtype=float)
+        orientation = np.array(tags['orientation'].split('\\'), dtype=float)
+        return float(np.dot(position, np.cross(orientation[:3], orientation[3:])))
+    except ValueError:
+        return float(tags['instance_number'] or 0)
+
+
+def index_dicom_tree(dicom_root, num_workers=8):
+    """
+    index every DICOM series below dicom_root in a single pass over the files.
+
+    Parameters
+    ----------
+    dicom_root : string
+        absolute path of the export, any folder layout.
+    num_workers : int
+        number of threads reading the headers.
+
+    Returns
+    -------
+    series : dict
+        series instance uid -> patient_id, study_uid, study_date, series_description, modality
+        and files, the slice files sorted along the slice normal.
+
+    """
+    file_paths = [os.path.join(root, f) for root, _, files in os.walk(dicom_root) for f in sorted(files)]
+    with ThreadPoolExecutor(max_workers=max(num_workers, 1)) as pool:
+        headers = [h for h in pool.map(read_slice_header, file_paths) if h is not None and h['series_uid']]
+    slices = defaultdict(list)
+    for tags in headers:
+        slices[tags['series_uid']].append(tags)
+    series = {}
+    for series_uid, series_slices in slices.items():
+        series_slices.sort(key=_slice_position)
+        first = series_slices[0]
+        series[series_uid] = {key: first[key] for key in ('patient_id', 'study_uid', 'study_date',
+                                                          'series_description', 'modality')}
+        series[series_uid]['files'] = [s['file'] for s in series_slices]
+    return series
+
+
+def match_channel(series_description, rules=BRATS_SERIES_RULES):
+    """
+    return the channel of the first rule matching the series description, None if no rule matches.
+    rules is a sequence of (channel, regular expression) pairs or a dict in matching order.
+    """
+    rules = rules.items() if isinstance(rules, dict) else rules
+    for channel, pattern in rules:
+        if re.search(pattern, series_description, re.IGNORECASE):
+            return channel
+    return None
+
+
+def plan_cases(series, rules=BRATS_SERIES_RULES, channels=BRATS_CHANNELS):
+    """
+    assign the series of every study to the channels. when several series of a study match one channel
+    the one with most slices is used.
+
+    Returns
+    -------
+    cases : dict
+        case identifier (PATIENT-NNN, studies of a patient numbered by date) -> {channel: series uid}.
+    incomplete : dict
+        case identifier -> list of missing channels.
+    skipped : list
+        series uids that were not used (no matching rule or duplicate of a channel).
+
+    """
+    studies = defaultdict(dict)
+    skipped = []
+    for series_uid, info in series.items():
+        channel = match_channel(info['series_description'], rules)
+        study = studies[(info['patient_id'], info['study_date'], info['study_uid'])]
+        if channel not in channels:
+            skipped.append(series_uid)
+        elif channel not in study or len(info['files']) > len(series[study[channel]]['files']):
+            if channel in study:
+                skipped.append(study[channel])
+            study[channel] = series_uid
+        else:
+            skipped.append(series_uid)
+
+    cases, incomplete = {}, {}
+    study_counter = defaultdict(int)
+    for patient_id, study_date, study_uid in sorted(studies):
+        study_counter[patient_id] += 1
+        case_identifier = '{}-{:03d}'.format(re.sub(r'[^A-Za-z0-9]', '', patient_id) or 'anonymous',
+                                             study_counter[patient_id])
+        assigned = studies[(patient_id, study_date, study_uid)]
+        missing = [c for c in channels if c not in assigned]
+        if missing:
+            incomplete[case_identifier] = missing
+        else:
+            cases[case_identifier] = assigned
+    return cases, incomplete, skipped
+
+
+def decode_series(file_names, absolute_name, compression_level=-1):
+    """
+    decode one sorted series and write it to absolute_name + '.nii.gz'. only the pixel data is read,
+    the per-slice metadata dictionaries and private tags are not loaded.
+    """
+    with stage('dicom_ingest.series', case=os.path.basename(absolute_name)):
+        reader = itk.ImageSeriesReader()
+        reader.SetFileNames(file_names)
+        reader.MetaDataDictionaryArrayUpdateOff()
+        reader.LoadPrivateTagsOff()
+        img_itk = reader.Execute()
+        # written under a temporary name first so that an interrupted run never leaves a truncated file
+        part_name = write_itk_image(img_itk, absolute_name + '.part', compression_level=compression_level)
+        file_name = absolute_name + '.nii.gz'
+        os.replace(part_name, file_name)
+    return file_name
+
+
+@profiled('ingest_dicom')
+def ingest_dicom(dicom_root, output_folder, rules=BRATS_SERIES_RULES, channels=BRATS_CHANNELS, num_workers=4,
+                 use_processes=True, num_index_workers=8, compression_level=-1, overwrite=False):
+    """
+    convert all complete studies of a DICOM export into Decathlon-named nifti files.
+
+    Parameters
+    ----------
+    dicom_root : string
+        absolute path of the DICOM export.
+    output_folder : string
+        absolute path where CASE_XXXX.nii.gz files are written (e.g. imagesTs of an nnU-Net raw dataset).
+    rules : sequence or dict
+        (channel, regular expression) rules mapping series descriptions to channels, see BRATS_SERIES_RULES.
+    channels : tuple
+        channel names in dataset.json order, the index gives the _XXXX suffix.
+    num_workers : int
+        number of series decoded concurrently.
+    use_processes : bool
+        decode in worker processes instead of threads.
+    num_index_workers : int
+        number of threads reading headers while indexing.
+    compression_level : int
+        gzip level of the written files, see tools.writer.write_itk_image.
+    overwrite : bool
+        convert again the series whose output file already exists.
+
+    Returns
+    -------
+    report : dict
+        cases (case -> channel -> series description and uid), incomplete studies and skipped series.
+        it is also written to output_folder/dicom_ingest.json.
+
+    """
+    create_path(output_folder)
+    series = index_dicom_tree(dicom_root, num_index_workers)
+    cases, incomplete, skipped = plan_cases(series, rules, channels)
+    print('{} series indexed: {} complete cases, {} incomplete studies, {} series not used'.format(
+        len(series), len(cases), len(incomplete), len(skipped)))
+
+    jobs = []
+    for case_identifier, assigned in cases.items():
+        for channel, series_uid in assigned.items():
+            absolute_name = os.path.join(output_folder, '{}_{:04d}'.format(case_identifier, channels.index(channel)))
+            if overwrite or not os.path.isfile(absolute_name + '.nii.gz'):
+                jobs.append((series[series_uid]['files'], absolute_name))
+    if jobs:
+        pool_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        with pool_class(max_workers=max(num_workers, 1)) as pool:
+            futures = [pool.submit(decode_series, files, name, compression_level) for files, name in jobs]
+            for future in futures:
+                future.result()
+
+    report = {'cases': {case_identifier: {channel: {'series_uid': series_uid,
+                                                    'series_description': series[series_uid]['series_description']}
+                                          for channel, series_uid in assigned.items()}
+                        for case_identifier, assigned in cases.items()},
+              'incomplete': incomplete,
+              'skipped': {series_uid: series[series_uid]['series_description'] for series_uid in skipped}}
+    write_json(os.path.join(output_folder, REPORT_NAME), report)
+    return report
@@ -0,0 +1,233 @@
+import os
+import csv
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from scipy import ndimage
+from tools.sitk_stuff import read_nifti
+from tools.json_pickle_stuff import read_json
+from tools.paths_dirs_stuff import path_contents_pattern
+from tools.postprocess import check_labels
+from tools.profiling import stage, profiled
+
+METRIC_COLUMNS = ('case', 'region', 'dice', 'hd95', 'volume_pred_ml', 'volume_ref_ml', 'volume_error_ml')
+
+
+def dice_score(pred, ref, labels):
+    """
+    mean Dice over the given labels, labels absent from both masks are skipped
+    """
+    scores = []
+    for label in labels:
+        pred_mask = pred == label
+        ref_mask = ref == label
+        denominator = pred_mask.sum() + ref_mask.sum()
+        if denominator == 0:
+            continue
+        scores.append(2 * np.logical_and(pred_mask, ref_mask).sum() / denominator)
+    return float(np.mean(scores)) if scores else 1.0
+
+
+def label_agreement(pred, ref):
+    """
+    mean Dice over the nonzero labels present in either mask
+    """
+    labels = [label for label in np.union1d(np.unique(ref), np.unique(pred)) if label != 0]
+    return dice_score(pred, ref, labels)
+
+
+def regions_from_dataset_json(dataset_json):
+    """
+    evaluated regions from the 'labels' of a dataset.json, e.g. the BraTS
+    {'whole': [1, 2, 3], 'tumor core': [1, 3], 'enhancing': [3]}.
+
+    Returns
+    -------
+    regions : dict
+        region name -> tuple of the label values belonging to it, background excluded.
+    """
+    regions = {}
+    for name, labels in dataset_json['labels'].items():
+        labels = tuple(labels) if isinstance(labels, (list, tuple)) else (labels,)
+        if name != 'background' and any(label != 0 for label in labels):
+            regions[name] = labels
+    return regions
+
+
+def _region_luts(regions, max_label=255):
+    # one boolean lookup table per region, the region mask is then a single indexing pass
+    luts = {}
+    for name, labels in regions.items():
+        lut = np.zeros(max_label + 1, dtype=bool)
+        lut[list(labels)] = True
+        luts[name] = lut
+    return luts
+
+
+def bounding_box(mask):
+    """
+    slices of the smallest box holding all True voxels, None for an empty mask.
+    """
+    bbox = []
+    for axis in range(mask.ndim):
+        nonzero = np.flatnonzero(mask.any(axis=tuple(a for a in range(mask.ndim) if a != axis)))
+        if len(nonzero) == 0:
+            return None
+        bbox.append(slice(int(nonzero[0]), int(nonzero[-1]) + 1))
+    return tuple(bbox)
+
+
+def _surface_distances(from_surface, to_surface, spacing):
+    if not to_surface.any():
+        return np.zeros(0)
+    return ndimage.distance_transform_edt(~to_surface, sampling=spacing)[from_surface]
+
+
+def hd95(pred_mask, ref_mask, spacing):
+    """
+    95th percentile of the symmetric surface distances in mm, computed with
+    euclidean distance transforms on the bounding box of both masks.
+    0 when both masks are empty, nan when only one is.
+    """
+    bbox = bounding_box(pred_mask | ref_mask)
+    if bbox is None:
+        return 0.0
+    pred_mask, ref_mask = pred_mask[bbox], ref_mask[bbox]
+    if not pred_mask.any() or not ref_mask.any():
+        return float('nan')
+    pred_surface = pred_mask & ~ndimage.binary_erosion(pred_mask)
+    ref_surface = ref_mask & ~ndimage.binary_erosion(ref_mask)
+    distances = np.concatenate([_surface_distances(pred_surface, ref_surface, spacing),
+                                _surface_distances(ref_surface, pred_surface, spacing)])
+    return float(np.percentile(distances, 95))
+
+
+def evaluate_case(pred_path, ref_path, regions):
+    """
+    Dice, HD95 and volumes of every region for one prediction/reference pair.
+    both volumes are cropped once to the bounding box of their foreground.
+
+    Returns
+    -------
+    rows : list
+        one dict per region with the METRIC_COLUMNS.
+    """
+    case = os.path.basename(ref_path)
+    with stage('evaluate_case', case=case):
+        ref, ref_itk = read_nifti(ref_path, as_view=True)[:2]
+        pred, pred_itk = read_nifti(pred_path, as_view=True)[:2]
+        if pred.shape != ref.shape:
+            raise ValueError('{}: prediction shape {} differs from reference shape {}'.format(case, pred.shape, ref.shape))
+        spacing = ref_itk.GetSpacing()[::-1]
+        voxel_ml = float(np.prod(spacing)) / 1000.0
+        bbox = bounding_box((pred != 0) | (ref != 0))
+        if bbox is not None:
+            # float masks become integers, negative or non-integer labels raise instead of indexing the tables
+            pred, ref = check_labels(pred[bbox]), check_labels(ref[bbox])
+        max_label = 255 if bbox is None else max(int(pred.max()), int(ref.max()), 255)
+        rows = []
+        for name, lut in _region_luts(regions, max_label).items():
+            if bbox is None:
+                pred_mask = ref_mask = np.zeros((1, 1, 1), dtype=bool)
+            else:
+                pred_mask, ref_mask = lut[pred], lut[ref]
+            pred_volume, ref_volume = int(pred_mask.sum()), int(ref_mask.sum())
+            denominator = pred_volume + ref_volume
+            rows.append({'case': case, 'region': name,
+                         'dice': 2 * int(np.logical_and(pred_mask, ref_mask).sum()) / denominator if denominator else 1.0,
+                         'hd95': hd95(pred_mask, ref_mask, spacing),
+                         'volume_pred_ml': pred_volume * voxel_ml,
+                         'volume_ref_ml': ref_volume * voxel_ml,
+                         'volume_error_ml': (pred_volume - ref_volume) * voxel_ml})
+    return rows
+
+
+def summarize_metrics(rows):
+    """
+    mean and median of every metric per region, nan values (one mask empty) are left out.
+    """
+    summary = {}
+    for region in dict.fromkeys(row['region'] for row in rows):
+        region_rows = [row for row in rows if row['region'] == region]
+        summary[region] = {'n_cases': len(region_rows)}
+        for metric in METRIC_COLUMNS[2:]:
+            values = np.array([row[metric] for row in region_rows], dtype=float)
+            values = values[~np.isnan(values)]
+            summary[region][metric + '_mean'] = float(values.mean()) if len(values) else None
+            summary[region][metric + '_median'] = float(np.median(values)) if len(values) else None
+        summary[region]['hd95_undefined'] = int(sum(np.isnan(row['hd95']) for row in region_rows))
+    return summary
+
+
+def write_metrics(rows, output_file):
+    """
+    write the metric rows as a table. '.parquet' and '.feather' files are written
+    with pyarrow (optional dependency), any other name as CSV.
+    """
+    if output_file.endswith(('.parquet', '.feather')):
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError('writing {} needs pyarrow, use a .csv file name otherwise'.format(output_file))
+        table = pyarrow.table({column: [row[column] for row in rows] for column in METRIC_COLUMNS})
+        if output_file.endswith('.parquet'):
+            import pyarrow.parquet
+            pyarrow.parquet.write_table(table, output_file)
+        else:
+            import pyarrow.feather
+            pyarrow.feather.write_feather(table, output_file)
+        return output_file
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=METRIC_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    return output_file
+
+
+@profiled('evaluate_folders')
+def evaluate_folders(pred_folder, ref_folder, dataset_json_path, output_file=None, num_workers=4, pattern='.nii.gz'):
+    """
+    evaluate every reference mask that has a prediction with the same file name.
+
+    Parameters
+    ----------
+    pred_folder : string
+        absolute path of the predicted masks.
+    ref_folder : string
+        absolute path of the reference masks (e.g. labelsTr).
+    dataset_json_path : string
+        dataset.json whose 'labels' define the evaluated regions.
+    output_file : string
+        write one row per case and region (METRIC_COLUMNS) to this file, see write_metrics.
+    num_workers : int
+        number of cases evaluated in parallel processes.
+    pattern : string
+        file name pattern of the masks.
+
+    Returns
+    -------
+    rows : list
+        one dict per case and region.
+    summary : dict
+        per region mean and median of every metric.
+
+    """
+    regions = regions_from_dataset_json(read_json(dataset_json_path))
+    predicted = set(path_contents_pattern(pred_folder, pattern))
+    cases = [f for f in path_contents_pattern(ref_folder, pattern) if f in predicted]
+    missing = len(path_contents_pattern(ref_folder, pattern)) - len(cases)
+    print('evaluating {} cases ({} references without prediction)'.format(len(cases), missing))
+    pred_paths = [os.path.join(pred_folder, f) for f in cases]
+    ref_paths = [os.path.join(ref_folder, f) for f in cases]
+    if num_workers <= 1:
+        per_case = [evaluate_case(p, r, regions) for p, r in zip(pred_paths, ref_paths)]
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as pool:
+            per_case = list(pool.map(evaluate_case, pred_paths, ref_paths, [regions] * len(cases),
+                                     chunksize=max(1, len(cases) // (num_workers * 8))))
+    rows = [row for case_rows in per_case for row in case_rows]
+    if output_file is not None:
+        write_metrics(rows, output_file)
+    summary = summarize_metrics(rows)
+    for region, metrics in summary.items():
+        print('{:15s} Dice {}  HD95 {}'.format(region, metrics['dice_mean'], metrics['hd95_mean']))
+    return rows, summary
@@ -0,0 +1,200 @@
+import os
+import json
+import hashlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from tools.sitk_stuff import read_nifti, read_nifti_header
+from tools.case_index import parse_channel_file
+
+INDEX_NAME = 'geometry_index.json'
+INDEX_VERSION = 1
+
+
+def file_checksum(file_path, chunk_size=1 << 20):
+    """
+    blake2b checksum of the (compressed) file bytes, no decompression involved.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def describe_image(image_path, with_statistics=True):
+    """
+    collect the geometry, checksum and (optionally) intensity statistics of
+    one image file.
+
+    Parameters
+    ----------
+    image_path : string
+        absolute path to the image file.
+    with_statistics : bool
+        decompress the volume to compute min, max, mean, std and the bounding
+        box of the nonzero voxels. otherwise only the header is read.
+
+    Returns
+    -------
+    entry : dict
+        index entry of the file.
+
+    """
+    img_size, img_spacing, img_origin, img_direction, img_pixel_type = read_nifti_header(image_path)
+    entry = {'size': list(img_size),
+             'spacing': list(img_spacing),
+             'origin': list(img_origin),
+             'direction': list(img_direction),
+             'pixel_type': img_pixel_type,
+             'checksum': file_checksum(image_path)}
+    if with_statistics:
+        img_array, img_itk = read_nifti(image_path, as_view=True)[:2]
+        nonzero = [np.flatnonzero(np.any(img_array != 0, axis=tuple(a for a in range(img_array.ndim) if a != axis)))
+                   for axis in range(img_array.ndim)]
+        entry['min'] = float(img_array.min())
+        entry['max'] = float(img_array.max())
+        entry['mean'] = float(img_array.mean(dtype=np.float64))
+        entry['std'] = float(img_array.std(dtype=np.float64))
+        # [start, stop) per array axis (z, y, x), None for an empty volume
+        entry['nonzero_bbox'] = None if any(len(n) == 0 for n in nonzero) else \
+            [[int(n[0]), int(n[-1]) + 1] for n in nonzero]
+        del img_array, img_itk
+    return entry
+
+
+def load_geometry_index(dataset_folder):
+    """
+    read the index stored in a raw dataset folder, an empty index if there is none.
+    """
+    index_path = os.path.join(dataset_folder, INDEX_NAME)
+    if os.path.exists(index_path):
+        with open(index_path, 'r') as handle:
+            index = json.load(handle)
+        if index.get('version') == INDEX_VERSION:
+            return index
+    return {'version': INDEX_VERSION, 'files': {}}
+
+
+def build_geometry_index(dataset_folder, subfolders=('imagesTr', 'labelsTr'), num_workers=4, with_statistics=True,
+                         file_ending='.nii.gz'):
+    """
+    create or update the geometry index of a raw (Decathlon format) dataset.
+    only files that are new or whose mtime or size changed since the last
+    build are read again, entries of deleted files are dropped.
+
+    Parameters
+    ----------
+    dataset_folder : string
+        absolute path of the raw dataset, e.g. <nnUNet_raw>/Dataset666_finetune.
+    subfolders : tuple
+        folders of the dataset to index.
+    num_workers : int
+        number of files described concurrently.
+    with_statistics : bool
+        see describe_image.
+    file_ending : string
+        file extension of the dataset.
+
+    Returns
+    -------
+    index : dict
+        {'version': ..., 'files': {relative path: entry}}, also written to
+        <dataset_folder>/geometry_index.json.
+
+    """
+    index = load_geometry_index(dataset_folder)
+    old_files = index['files']
+    new_files = {}
+    todo = []
+    for subfolder in subfolders:
+        folder = os.path.join(dataset_folder, subfolder)
+        if not os.path.isdir(folder):
+            continue
+        with os.scandir(folder) as entries:
+            for file_entry in entries:
+                if not file_entry.name.endswith(file_ending) or not file_entry.is_file():
+                    continue
+                rel_path = subfolder + '/' + file_entry.name
+                stat = file_entry.stat()
+                old = old_files.get(rel_path)
+                if old is not None and old['mtime_ns'] == stat.st_mtime_ns and old['file_size'] == stat.st_size \
+                        and ('mean' in old or not with_statistics):
+                    new_files[rel_path] = old
+                else:
+                    todo.append((rel_path, file_entry.path, stat))
+
+    def _describe(item):
+        rel_path, file_path, stat = item
+        entry = describe_image(file_path, with_statistics)
+        entry['mtime_ns'] = stat.st_mtime_ns
+        entry['file_size'] = stat.st_size
+        return rel_path, entry
+
+    if todo:
+        print("geometry index: describing {} new or changed files ...".format(len(todo)))
+        with ThreadPoolExecutor(max_workers=max(1, num_workers)) as pool:
+            for rel_path, entry in pool.map(_describe, todo):
+                new_files[rel_path] = entry
+
+    index['files'] = dict(sorted(new_files.items()))
+    if todo or len(new_files) != len(old_files):
+        index_path = os.path.join(dataset_folder, INDEX_NAME)
+        with open(index_path + '.tmp', 'w') as handle:
+            json.dump(index, handle, separators=(',', ':'))
+        os.replace(index_path + '.tmp', index_path)
+    return index
+
+
+def index_digest(index):
+    """
+    a single checksum over all indexed files, it changes when any file is
+    added, removed or modified.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for rel_path, entry in sorted(index['files'].items()):
+        digest.update(rel_path.encode())
+        digest.update(entry['checksum'].encode())
+    return digest.hexdigest()
+
+
+def group_index_by_case(index, file_ending='.nii.gz'):
+    """
+    case identifier -> {channel: entry}, the label of a case is stored under the key 'label'.
+    """
+    cases = {}
+    for rel_path, entry in index['files'].items():
+        subfolder, file_name = rel_path.split('/', 1)
+        if subfolder.startswith('labels'):
+            cases.setdefault(file_name[:-len(file_ending)], {})['label'] = entry
+            continue
+        parsed = parse_channel_file(file_name, file_ending)
+        if parsed is not None:
+            cases.setdefault(parsed[0], {})[parsed[1]] = entry
+    return cases
+
+
+def find_geometry_mismatches(index, tolerance=1e-4, file_ending='.nii.gz'):
+    """
+    compare the geometry of all channels and the label of every case.
+
+    Returns
+    -------
+    mismatches : dict
+        case identifier -> list of the geometric properties that differ
+        between its files, only for inconsistent cases.
+
+    """
+    mismatches = {}
+    for case_identifier, entries in group_index_by_case(index, file_ending).items():
+        entries = list(entries.values())
+        reference = entries[0]
+        problems = set()
+        for entry in entries[1:]:
+            if entry['size'] != reference['size']:
+                problems.add('size')
+            for key in ('spacing', 'origin', 'direction'):
+                if not np.allclose(entry[key], reference[key], atol=tolerance):
+                    problems.add(key)
+        if problems:
+            mismatches[case_identifier] = sorted(problems)
+    return mismatches
@@ -1,5 +1,6 @@
 import os
 import re
+import shutil
 
 ch_order = re.compile('([0-9]+)')
 
@@ -86,3 +87,76 @@ def create_path(absolute_path):
     else:
         pass
     return None
+
+
+def _reflink(src_path, dst_path):
+    """
+    clone a file through the FICLONE ioctl (btrfs, xfs, ...), so the
+    destination shares the data blocks of the source until one is modified.
+    raises OSError if the filesystem does not support it.
+    """
+    import fcntl
+    ficlone = 0x40049409
+    # O_EXCL: never open an existing file for writing, it may be a hardlink of the source
+    dst_fd = os.open(dst_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    with open(src_path, 'rb') as src_file, os.fdopen(dst_fd, 'wb') as dst_file:
+        try:
+            fcntl.ioctl(dst_file.fileno(), ficlone, src_file.fileno())
+        except OSError:
+            dst_file.close()
+            os.remove(dst_path)
+            raise
+    return None
+
+
+def place_file(src_path, dst_path, mode='auto'):
+    """
+    put a file at the destination with the cheapest available method.
+
+    Parameters
+    ----------
+    src_path : string
+        absolute path of the source file.
+    dst_path : string
+        absolute path of the destination file.
+    mode : string
+        'hardlink', 'reflink', 'copy' or 'auto'. 'auto' tries a hardlink, then
+        a reflink, when source and destination are on the same filesystem and
+        falls back to a plain copy otherwise.
+
+    Returns
+    -------
+    method : string
+        the method that was actually used.
+
+    Raises
+    ------
+    FileExistsError
+        if the destination exists, whatever the mode, so that a destination
+        hardlinked to the source is never written to.
+
+    """
+    if os.path.lexists(dst_path):
+        raise FileExistsError("{} already exists".format(dst_path))
+    if mode == 'copy':
+        shutil.copy(src_path, dst_path)
+        return 'copy'
+    same_device = os.stat(src_path).st_dev == os.stat(os.path.dirname(dst_path)).st_dev
+    if mode in ('auto', 'hardlink') and same_device:
+        try:
+            os.link(src_path, dst_path)
+            return 'hardlink'
+        except OSError:
+            if mode == 'hardlink':
+                raise
+    if mode in ('auto', 'reflink') and same_device:
+        try:
+            _reflink(src_path, dst_path)
+            return 'reflink'
+        except (OSError, ImportError):
+            if mode == 'reflink':
+                raise
+    if mode in ('hardlink', 'reflink'):
+        raise OSError("cannot {} {} to {}: different filesystems".format(mode, src_path, dst_path))
+    shutil.copy(src_path, dst_path)
+    return 'copy'
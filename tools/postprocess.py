@@ -0,0 +1,130 @@
+import os
+import numpy as np
+import SimpleITK as itk
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from tools.paths_dirs_stuff import path_contents_pattern, create_path
+from tools.profiling import stage
+
+
+def check_labels(mask_array):
+    """
+    return a label mask as an integer array, the input itself when it already is one.
+
+    float masks (common for reference segmentations) are accepted when every
+    value is a whole number. negative, non-integer or non-finite labels
+    raise a ValueError instead of indexing a lookup table from its end.
+    """
+    if mask_array.dtype.kind == 'b':
+        return mask_array.astype(np.uint8)
+    if mask_array.dtype.kind == 'f':
+        if not np.all(np.isfinite(mask_array)) or not np.array_equal(np.rint(mask_array), mask_array):
+            raise ValueError("mask holds non-integer labels")
+        mask_array = mask_array.astype(np.int64)
+    elif mask_array.dtype.kind not in 'iu':
+        raise ValueError("unsupported mask dtype {}".format(mask_array.dtype))
+    if mask_array.dtype.kind == 'i' and mask_array.size and mask_array.min() < 0:
+        raise ValueError("mask holds negative labels")
+    return mask_array
+
+
+def build_label_lut(label_map, max_label=255, dtype=None):
+    """
+    build a lookup table that remaps all labels in a single indexing pass.
+
+    Parameters
+    ----------
+    label_map : dict
+        old label -> new label, e.g. {4: 0} removes label 4 and
+        {2: 1, 3: 1} merges labels 2 and 3 into 1. Unlisted labels are kept.
+    max_label : int
+        largest label value expected in the masks. remap_labels extends the
+        table for masks with larger labels.
+    dtype : numpy dtype
+        dtype of the table, by default the smallest one that holds every new label.
+
+    Returns
+    -------
+    lut : numpy array
+        lut[old_label] = new_label.
+
+    """
+    labels = list(label_map) + list(label_map.values())
+    if any(int(label) != label or label < 0 for label in labels):
+        raise ValueError("labels must be non-negative integers, got {}".format(label_map))
+    max_label = max([max_label] + list(label_map))
+    lut = np.arange(max_label + 1)
+    for old_label, new_label in label_map.items():
+        lut[old_label] = new_label
+    return lut.astype(np.min_scalar_type(int(lut.max())) if dtype is None else dtype)
+
+
+def remap_labels(mask_array, lut):
+    """
+    apply a label lookup table to a mask array (or a view of one).
+
+    labels above the end of the table are kept. the result keeps the dtype
+    of the mask unless it cannot hold the largest new label, then the
+    smallest dtype that can is used.
+    """
+    mask = check_labels(mask_array)
+    max_label = int(mask.max()) if mask.size else 0
+    if max_label >= len(lut):
+        lut = np.concatenate([lut, np.arange(len(lut), max_label + 1)])
+    new_max = int(lut.max())
+    out_dtype = mask_array.dtype
+    if out_dtype.kind == 'b' or not np.can_cast(np.min_scalar_type(new_max), out_dtype):
+        out_dtype = np.min_scalar_type(new_max)
+    return lut.astype(out_dtype, copy=False)[mask]
+
+
+def remap_label_file(src_path, dst_path, lut):
+    """
+    remap the labels of one mask file and write it to dst_path (full file name).
+    the voxels are read through a view of the itk buffer, so the only array
+    allocated is the remapped output.
+    """
+    with stage('remap_label_file', case=os.path.basename(src_path)):
+        img_itk = itk.ReadImage(src_path)
+        remapped = remap_labels(itk.GetArrayViewFromImage(img_itk), lut)
+        new_itk = itk.GetImageFromArray(remapped)
+        new_itk.CopyInformation(img_itk)
+        itk.WriteImage(new_itk, dst_path)
+    return dst_path
+
+
+def remap_label_folder(src_folder, dst_folder, label_map, num_workers=1, use_processes=False, pattern='.nii.gz'):
+    """
+    remap the labels of every mask in a folder over a worker pool.
+
+    Parameters
+    ----------
+    src_folder : string
+        absolute path of the folder with the masks (e.g. nnU-Net predictions).
+    dst_folder : string
+        absolute path of the folder where the remapped masks are written
+        with the same file names.
+    label_map : dict
+        old label -> new label, see build_label_lut.
+    num_workers : int
+        number of files processed concurrently.
+    use_processes : bool
+        use a process pool instead of a thread pool.
+    pattern : string
+        file name pattern of the masks.
+
+    Returns
+    -------
+    written : list
+        absolute paths of the written masks.
+
+    """
+    create_path(dst_folder)
+    lut = build_label_lut(label_map)
+    mask_files = path_contents_pattern(src_folder, pattern)
+    srcs = [os.path.join(src_folder, f) for f in mask_files]
+    dsts = [os.path.join(dst_folder, f) for f in mask_files]
+    if num_workers <= 1:
+        return [remap_label_file(src, dst, lut) for src, dst in zip(srcs, dsts)]
+    pool_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with pool_class(max_workers=num_workers) as pool:
+        return list(pool.map(remap_label_file, srcs, dsts, [lut] * len(srcs)))
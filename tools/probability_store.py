@@ -0,0 +1,153 @@
+"""
+compact, memory-mappable storage of softmax/sigmoid probability maps.
+
+a (C, Z, Y, X) probability map is quantized to uint8 (1/255 steps) or float16 and cut into chunks.
+chunks holding a single value per channel (the background of brain MRI) are only recorded by that
+value, the others are stored uncompressed in CASE.prob.npy so that a region can be read through a
+memory map without loading or decompressing the whole volume. CASE.prob.json holds the layout.
+
+e.g.
+    write_probabilities(probabilities, '/mnt/preds/BraTS-GLI-00160-000')
+    prob = ProbabilityMap('/mnt/preds/BraTS-GLI-00160-000')
+    tumor_box = prob.read((slice(40, 90), slice(100, 160), slice(80, 150)))
+"""
+import os
+import time
+import itertools
+import numpy as np
+from tools.json_pickle_stuff import read_json, write_json
+
+PROBABILITY_DTYPES = ('uint8', 'float16')
+CHUNKS_SUFFIX = '.prob.npy'
+LAYOUT_SUFFIX = '.prob.json'
+
+
+def quantize(probabilities, dtype='uint8'):
+    if dtype == 'uint8':
+        return np.rint(np.clip(probabilities, 0, 1) * 255).astype(np.uint8)
+    if dtype == 'float16':
+        return probabilities.astype(np.float16)
+    raise ValueError("dtype must be one of {}, got {}".format(PROBABILITY_DTYPES, dtype))
+
+
+def dequantize(values, dtype):
+    values = values.astype(np.float32)
+    return values / 255 if dtype == 'uint8' else values
+
+
+def _chunk_slices(shape, chunk_shape):
+    # every chunk position of the grid as (Z, Y, X) slices, in C order of the grid
+    ranges = [range(0, s, c) for s, c in zip(shape, chunk_shape)]
+    return [tuple(slice(start, min(start + c, s)) for start, c, s in zip(starts, chunk_shape, shape))
+            for starts in itertools.product(*ranges)]
+
+
+def write_probabilities(probabilities, output_file_truncated, dtype='uint8', chunk_shape=(32, 64, 64)):
+    """
+    quantize and store a (C, Z, Y, X) probability map.
+
+    Parameters
+    ----------
+    probabilities : numpy array
+        float probabilities in [0, 1].
+    output_file_truncated : string
+        absolute path plus case name, CASE.prob.npy and CASE.prob.json are written.
+    dtype : string
+        'uint8' or 'float16'.
+    chunk_shape : tuple
+        (Z, Y, X) size of the chunks.
+
+    Returns
+    -------
+    n_bytes : int
+        size of the written files.
+
+    """
+    quantized = quantize(probabilities, dtype)
+    n_channels, shape = quantized.shape[0], quantized.shape[1:]
+    chunk_shape = tuple(min(c, s) for c, s in zip(chunk_shape, shape))
+    index, constants, stored = [], {}, []
+    for chunk_ix, chunk in enumerate(_chunk_slices(shape, chunk_shape)):
+        block = quantized[(slice(None),) + chunk].reshape(n_channels, -1)
+        minimum, maximum = block.min(1), block.max(1)
+        if np.array_equal(minimum, maximum):
+            index.append(-1)
+            constants[str(chunk_ix)] = minimum.tolist()
+        else:
+            index.append(len(stored))
+            stored.append(chunk)
+
+    chunks_file = output_file_truncated + CHUNKS_SUFFIX
+    part_file = chunks_file + '.part'
+    chunks = np.lib.format.open_memmap(part_file, mode='w+', dtype=quantized.dtype,
+                                       shape=(len(stored), n_channels) + chunk_shape)
+    for stored_ix, chunk in enumerate(stored):
+        block = quantized[(slice(None),) + chunk]
+        chunks[(stored_ix, slice(None)) + tuple(slice(0, s) for s in block.shape[1:])] = block
+    chunks.flush()
+    del chunks
+    os.replace(part_file, chunks_file)
+    write_json(output_file_truncated + LAYOUT_SUFFIX,
+               {'shape': [n_channels] + list(shape), 'dtype': dtype, 'chunk_shape': list(chunk_shape),
+                'index': index, 'constants': constants})
+    return os.path.getsize(chunks_file) + os.path.getsize(output_file_truncated + LAYOUT_SUFFIX)
+
+
+class ProbabilityMap:
+    """
+    read access to a map written by write_probabilities. only the chunks overlapping the
+    requested region are read from the memory-mapped file.
+    """
+
+    def __init__(self, output_file_truncated):
+        layout = read_json(output_file_truncated + LAYOUT_SUFFIX)
+        self.shape = tuple(layout['shape'])
+        self.dtype = layout['dtype']
+        self.chunk_shape = tuple(layout['chunk_shape'])
+        self._index = layout['index']
+        self._constants = layout['constants']
+        self._chunks = np.load(output_file_truncated + CHUNKS_SUFFIX, mmap_mode='r')
+        self._grid = tuple(-(-s // c) for s, c in zip(self.shape[1:], self.chunk_shape))
+
+    def read(self, region=None, channels=None):
+        """
+        float32 probabilities of a (Z, Y, X) region given as slices (step 1), all of the volume by default.
+        channels selects a list of channels, all by default.
+        """
+        region = tuple(slice(None) for _ in range(3)) if region is None else region
+        region = tuple(slice(*r.indices(s)[:2]) for r, s in zip(region, self.shape[1:]))
+        channels = list(range(self.shape[0])) if channels is None else list(channels)
+        out = np.empty((len(channels),) + tuple(r.stop - r.start for r in region), dtype=np.float32)
+        chunk_ranges = [range(r.start // c, -(-r.stop // c)) for r, c in zip(region, self.chunk_shape)]
+        for grid_position in itertools.product(*chunk_ranges):
+            chunk_ix = int(np.ravel_multi_index(grid_position, self._grid))
+            # overlap of the chunk and the region, in volume coordinates
+            starts = [max(g * c, r.start) for g, c, r in zip(grid_position, self.chunk_shape, region)]
+            stops = [min((g + 1) * c, r.stop) for g, c, r in zip(grid_position, self.chunk_shape, region)]
+            out_slices = (slice(None),) + tuple(slice(a - r.start, b - r.start) for a, b, r in zip(starts, stops, region))
+            if self._index[chunk_ix] < 0:
+                values = np.array(self._constants[str(chunk_ix)], dtype=np.float32)[channels]
+                out[out_slices] = dequantize(values, self.dtype)[:, None, None, None]
+            else:
+                in_slices = tuple(slice(a - g * c, b - g * c) for a, b, g, c in zip(starts, stops, grid_position, self.chunk_shape))
+                out[out_slices] = dequantize(self._chunks[(self._index[chunk_ix], channels) + in_slices], self.dtype)
+        return out
+
+    def __getitem__(self, region):
+        return self.read(region)
+
+
+def compare_with_npz(probabilities, output_file_truncated, dtype='uint8', chunk_shape=(32, 64, 64)):
+    """
+    write a probability map both as nnU-Net's float32 .npz and with write_probabilities,
+    and return the write time and disk size of each.
+    """
+    start = time.perf_counter()
+    np.savez_compressed(output_file_truncated + '.npz', probabilities=probabilities.astype(np.float32))
+    npz_seconds = time.perf_counter() - start
+    npz_bytes = os.path.getsize(output_file_truncated + '.npz')
+    start = time.perf_counter()
+    n_bytes = write_probabilities(probabilities, output_file_truncated, dtype, chunk_shape)
+    seconds = time.perf_counter() - start
+    return {'npz_seconds': npz_seconds, 'npz_bytes': npz_bytes, 'seconds': seconds, 'bytes': n_bytes,
+            'seconds_saved': npz_seconds - seconds, 'bytes_saved': npz_bytes - n_bytes}
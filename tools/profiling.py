@@ -0,0 +1,242 @@
+import os
+import sys
+import json
+import time
+import cProfile
+import threading
+import functools
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+# the settings live in the environment so that worker processes inherit them
+ENV_JSONL = 'GLI_PROFILE_JSONL'
+ENV_PROMETHEUS = 'GLI_PROFILE_PROMETHEUS'
+ENV_CPROFILE_STAGES = 'GLI_PROFILE_CPROFILE_STAGES'
+ENV_CPROFILE_DIR = 'GLI_PROFILE_CPROFILE_DIR'
+ENV_OWNER_PID = 'GLI_PROFILE_OWNER_PID'
+
+_lock = threading.Lock()
+_totals = {}
+# number of stages running in this process; the GPU peak is only reset and read by a stage that starts alone
+_active_stages = 0
+# True while a stage runs under cProfile; python 3.12+ allows a single active profiler per process
+_profiler_active = False
+
+
+def enable_profiling(jsonl_path=None, prometheus_path=None, cprofile_stages=(), cprofile_dir=None):
+    """
+    switch the instrumentation on for this process and the processes it starts.
+
+    Parameters
+    ----------
+    jsonl_path : string
+        file that gets one JSON line per finished stage.
+    prometheus_path : string
+        Prometheus text file with the totals per stage of this process, rewritten
+        after every stage. worker processes write their own totals next to it,
+        to the same name with their pid inserted before the extension.
+    cprofile_stages : tuple
+        stage names that are run under cProfile, '*' for all of them.
+    cprofile_dir : string
+        folder for the .prof dumps (readable with pstats or snakeviz).
+
+    """
+    settings = {ENV_JSONL: jsonl_path, ENV_PROMETHEUS: prometheus_path,
+                ENV_CPROFILE_STAGES: ','.join(cprofile_stages), ENV_CPROFILE_DIR: cprofile_dir,
+                ENV_OWNER_PID: str(os.getpid()) if prometheus_path else None}
+    for key, value in settings.items():
+        if value:
+            os.environ[key] = value
+        else:
+            os.environ.pop(key, None)
+    return None
+
+
+def disable_profiling():
+    enable_profiling()
+    return None
+
+
+def profiling_enabled():
+    return bool(os.environ.get(ENV_JSONL) or os.environ.get(ENV_PROMETHEUS) or os.environ.get(ENV_CPROFILE_STAGES))
+
+
+def _io_counters():
+    # bytes actually read from / written to storage by the calling thread (linux only)
+    try:
+        with open('/proc/thread-self/io', 'r') as handle:
+            counters = dict(line.split(':') for line in handle)
+        return int(counters['read_bytes']), int(counters['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _current_rss_bytes():
+    try:
+        with open('/proc/self/statm') as handle:
+            return int(handle.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _cuda():
+    # only look at the GPU if torch is already loaded, the tools never import it themselves
+    torch = sys.modules.get('torch')
+    if torch is not None and torch.cuda.is_available():
+        return torch.cuda
+    return None
+
+
+def _prometheus_path(path):
+    # each process only knows its own totals, so every worker gets its own file
+    if os.environ.get(ENV_OWNER_PID) == str(os.getpid()):
+        return path
+    root, extension = os.path.splitext(path)
+    return '{}.{}{}'.format(root, os.getpid(), extension)
+
+
+def _write_prometheus(path):
+    path = _prometheus_path(path)
+    pid = os.getpid()
+    lines = []
+    metrics = (('gli_stage_runs_total', 'count', 'counter'),
+               ('gli_stage_wall_seconds_total', 'wall_seconds', 'counter'),
+               ('gli_stage_cpu_seconds_total', 'cpu_seconds', 'counter'),
+               ('gli_stage_read_bytes_total', 'read_bytes', 'counter'),
+               ('gli_stage_written_bytes_total', 'written_bytes', 'counter'),
+               ('gli_process_peak_rss_bytes', 'process_peak_rss_bytes', 'gauge'),
+               ('gli_stage_peak_gpu_memory_bytes', 'peak_gpu_memory_bytes', 'gauge'))
+    for metric, key, metric_type in metrics:
+        lines.append('# TYPE {} {}'.format(metric, metric_type))
+        for stage_name, totals in sorted(_totals.items()):
+            if totals.get(key) is not None:
+                lines.append('{}{{stage="{}",pid="{}"}} {}'.format(metric, stage_name, pid, totals[key]))
+    with open(path + '.tmp', 'w') as handle:
+        handle.write('\n'.join(lines) + '\n')
+    os.replace(path + '.tmp', path)
+
+
+def _record(record):
+    jsonl_path = os.environ.get(ENV_JSONL)
+    prometheus_path = os.environ.get(ENV_PROMETHEUS)
+    with _lock:
+        totals = _totals.setdefault(record['stage'], {'count': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+        totals['count'] += 1
+        totals['wall_seconds'] += record['wall_seconds']
+        totals['cpu_seconds'] += record['cpu_seconds']
+        for key in ('read_bytes', 'written_bytes'):
+            if record[key] is not None:
+                totals[key] = totals.get(key, 0) + record[key]
+        for key in ('process_peak_rss_bytes', 'peak_gpu_memory_bytes'):
+            if record[key] is not None:
+                totals[key] = max(totals.get(key, 0), record[key])
+        if jsonl_path:
+            with open(jsonl_path, 'a') as handle:
+                handle.write(json.dumps(record) + '\n')
+        if prometheus_path:
+            _write_prometheus(prometheus_path)
+
+
+@contextmanager
+def stage(name, case=None, **labels):
+    """
+    measure a block of code. does nothing unless enable_profiling was called.
+
+    records wall time, CPU time and bytes read and written by the calling
+    thread, so that stages running concurrently in a thread pool are not
+    charged for each other. the memory values are process-level:
+    rss_delta_bytes is the change of the resident memory of the process over
+    the stage and process_peak_rss_bytes its peak since the process started.
+    peak GPU memory (when torch is loaded and a GPU is present) is only
+    recorded by stages that start while no other stage runs in the process,
+    since resetting the peak would wipe the one of an enclosing stage.
+    only one stage at a time runs under cProfile: stages nested in a profiled
+    stage are part of its profile, stages that start in other threads
+    meanwhile are not profiled.
+
+    e.g.
+        with stage('predict', case='BraTS-GLI-00160-000'):
+            ...
+    """
+    if not profiling_enabled():
+        yield
+        return
+    cprofile_stages = os.environ.get(ENV_CPROFILE_STAGES, '').split(',')
+    global _active_stages, _profiler_active
+    cuda = _cuda()
+    with _lock:
+        outermost = _active_stages == 0
+        _active_stages += 1
+        profiler = None
+        if (name in cprofile_stages or '*' in cprofile_stages) and not _profiler_active:
+            profiler = cProfile.Profile()
+            _profiler_active = True
+    if cuda is not None and outermost:
+        cuda.reset_peak_memory_stats()
+    read_start, write_start = _io_counters()
+    rss_start = _current_rss_bytes()
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    if profiler is not None:
+        try:
+            profiler.enable()
+        except ValueError:  # another profiling tool (debugger, coverage) is active
+            profiler = None
+            with _lock:
+                _profiler_active = False
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        read_end, write_end = _io_counters()
+        rss_end = _current_rss_bytes()
+        with _lock:
+            _active_stages -= 1
+            if profiler is not None:
+                _profiler_active = False
+        record = {'stage': name,
+                  'case': case,
+                  'pid': os.getpid(),
+                  'timestamp': time.time(),
+                  'wall_seconds': time.perf_counter() - wall_start,
+                  'cpu_seconds': time.thread_time() - cpu_start,
+                  'rss_delta_bytes': None if rss_start is None or rss_end is None else rss_end - rss_start,
+                  'process_peak_rss_bytes': _peak_rss_bytes(),
+                  'peak_gpu_memory_bytes': cuda.max_memory_allocated() if cuda is not None and outermost else None,
+                  'read_bytes': None if read_start is None else read_end - read_start,
+                  'written_bytes': None if write_start is None else write_end - write_start}
+        record.update(labels)
+        if profiler is not None:
+            profile_dir = os.environ.get(ENV_CPROFILE_DIR) or '.'
+            os.makedirs(profile_dir, exist_ok=True)
+            suffix = '' if case is None else '_' + str(case)
+            record['profile'] = os.path.join(profile_dir, '{}{}_{}_{}.prof'.format(name, suffix, os.getpid(),
+                                                                               int(record['timestamp'] * 1000)))
+            profiler.dump_stats(record['profile'])
+        _record(record)
+
+
+def profiled(name):
+    """
+    decorator version of stage, the case label is taken from a 'case' keyword argument if present.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name, case=kwargs.get('case')):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
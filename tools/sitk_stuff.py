@@ -1,8 +1,11 @@
+import numpy as np
 import SimpleITK as itk
+from tools.profiling import profiled
 
 
 
-def read_nifti(image_path):
+@profiled('read_nifti')
+def read_nifti(image_path, as_view=False):
     """
     loading the data array and some of the metadata of nifti a nifti file.
     note that itk loads volumes as channel first.
@@ -11,6 +14,9 @@ def read_nifti(image_path):
     ----------
     image_path : string
         absolute path to the image file.
+    as_view : bool
+        return a read-only view on the itk buffer instead of a copy. the
+        view is only valid while img_itk is alive.
         
     Returns
     -------
@@ -33,13 +39,87 @@ def read_nifti(image_path):
     img_spacing = img_itk.GetSpacing() 
     img_origin = img_itk.GetOrigin()
     img_direction = img_itk.GetDirection()
-    img_array = itk.GetArrayFromImage(img_itk)
+    if as_view:
+        img_array = itk.GetArrayViewFromImage(img_itk)
+    else:
+        img_array = itk.GetArrayFromImage(img_itk)
     
     return img_array, img_itk, img_size, img_spacing, img_origin, img_direction
 
 
+def read_nifti_header(image_path):
+    """
+    loading only the metadata of an image file, the voxel data is not
+    decompressed.
+
+    Parameters
+    ----------
+    image_path : string
+        absolute path to the image file.
+
+    Returns
+    -------
+    img_size : tuple
+        image data dimension.
+    img_spacing : tuple
+        voxel spacing.
+    img_origin : tuple
+        subject coordinates.
+    img_direction : tuple
+        orientation of the acquired image.
+    img_pixel_type : string
+        pixel type, e.g. '16-bit signed integer'.
+    """
+
+    reader = itk.ImageFileReader()
+    reader.SetFileName(image_path)
+    reader.ReadImageInformation()
+    img_pixel_type = itk.GetPixelIDValueAsString(reader.GetPixelID())
+
+    return reader.GetSize(), reader.GetSpacing(), reader.GetOrigin(), reader.GetDirection(), img_pixel_type
+
+
+class LazyImage:
+    """
+    image handle that reads the header on creation and decompresses the
+    voxel data only when it is accessed for the first time.
+
+    e.g.
+        img = LazyImage('/mnt/mri/data/SubjectName.nii.gz')
+        img.spacing        # header only
+        img.array_view     # decompresses now, no extra copy
+    """
+
+    def __init__(self, image_path):
+        self.image_path = image_path
+        self.size, self.spacing, self.origin, self.direction, self.pixel_type = read_nifti_header(image_path)
+        self._itk = None
+
+    @property
+    def is_loaded(self):
+        return self._itk is not None
+
+    @property
+    def itk(self):
+        if self._itk is None:
+            self._itk = itk.ReadImage(self.image_path)
+        return self._itk
+
+    @property
+    def array_view(self):
+        # read-only, valid as long as this handle is alive
+        return itk.GetArrayViewFromImage(self.itk)
+
+    @property
+    def array(self):
+        return itk.GetArrayFromImage(self.itk)
+
+    def release(self):
+        self._itk = None
+
+
 
-def get_dicom_series(dicom_series_path):
+def get_dicom_series(dicom_series_path, series_id=None):
     '''
     Get the absolute path and return dicom data+metadata
 
@@ -47,6 +127,9 @@ def get_dicom_series(dicom_series_path):
     ----------
     dicom_series_path : str
         absolute path to a dicom series folder.
+    series_id : str
+        series instance uid to load when the folder holds several series,
+        the first series found by default.
 
     Returns
     -------
@@ -66,30 +149,35 @@ def get_dicom_series(dicom_series_path):
     my_tags = {"patient_name": "0010|0010",
                "patient_id": "0010|0020",
                "patient_bday": "0010|0030",
-               "UID": "0020|000D",
+               "UID": "0020|000d",
                "study_id": "0020|0010", 
                "study_date": "0008|0020",
                "study_time": "0008|0030",
                "accession_number": "0008|0050",
                "modality":"0008|0060"}
     
-    series_IDs = itk.ImageSeriesReader.GetGDCMSeriesIDs(dicom_series_path)
-    series_file_names = itk.ImageSeriesReader.GetGDCMSeriesFileNames(dicom_series_path, series_IDs[0])
+    if series_id is None:
+        series_id = itk.ImageSeriesReader.GetGDCMSeriesIDs(dicom_series_path)[0]
+    series_file_names = itk.ImageSeriesReader.GetGDCMSeriesFileNames(dicom_series_path, series_id)
     series_reader = itk.ImageSeriesReader()
     series_reader.SetFileNames(series_file_names)
     
-    series_reader.MetaDataDictionaryArrayUpdateOn()
-    series_reader.LoadPrivateTagsOn()
+    # the tags are read from the header of the first slice only, not from every slice
+    series_reader.MetaDataDictionaryArrayUpdateOff()
+    series_reader.LoadPrivateTagsOff()
     img_itk = series_reader.Execute()
     
     img_spacing = img_itk.GetSpacing()
     img_origin = img_itk.GetOrigin()
     img_direction = img_itk.GetDirection()
     
+    header_reader = itk.ImageFileReader()
+    header_reader.SetFileName(series_file_names[0])
+    header_reader.ReadImageInformation()
     patient_tags = {}
     for keys, vals in my_tags.items():
-        if series_reader.HasMetaDataKey(0,vals):
-            patient_tags[keys] = series_reader.GetMetaData(0,vals)
+        if header_reader.HasMetaDataKey(vals):
+            patient_tags[keys] = header_reader.GetMetaData(vals)
             
             
     return img_itk, img_spacing, img_origin, img_direction, patient_tags
@@ -115,4 +203,117 @@ def reorient_itk(itk_img):
     reoriented_origin = reoriented.GetOrigin()
     reoriented_direction = reoriented.GetDirection()
     
-    return reorient_array, reoriented, reoriented_spacing, reoriented_origin, reoriented_direction
\ No newline at end of file
+    return reorient_array, reoriented, reoriented_spacing, reoriented_origin, reoriented_direction
+
+
+def orientation_transform(direction, orientation='LPS'):
+    '''
+    axis permutation and flips that bring an image with the given direction
+    cosines into an orientation code, the same axis assignment as
+    DICOMOrientImageFilter but as plain array operations.
+
+    Parameters
+    ----------
+    direction : tuple
+        flattened 3x3 direction matrix of the image.
+    orientation : str
+        target orientation code, e.g. 'LPS' or 'RAS'.
+
+    Returns
+    -------
+    permutation : tuple
+        new itk axis j is the old itk axis permutation[j].
+    flips : tuple
+        True where the new axis runs opposite to the old one.
+    '''
+
+    current = np.array(direction, dtype=float).reshape(3, 3)
+    target = np.array(itk.DICOMOrientImageFilter.GetDirectionCosinesFromOrientation(orientation)).reshape(3, 3)
+    # similarity[j, i] = cosine between target axis j and image axis i
+    similarity = target.T @ current
+    permutation = [None] * 3
+    remaining = np.abs(similarity)
+    for _ in range(3):
+        new_axis, old_axis = np.unravel_index(np.argmax(remaining), remaining.shape)
+        permutation[new_axis] = int(old_axis)
+        remaining[new_axis, :] = -1
+        remaining[:, old_axis] = -1
+    flips = tuple(bool(similarity[j, permutation[j]] < 0) for j in range(3))
+    
+    return tuple(permutation), flips
+
+
+def resample_to_reference(itk_images, reference_index=0, tolerance=1e-4, interpolator=itk.sitkLinear):
+    '''
+    bring all images onto the voxel grid of the reference image. images that
+    already share its grid are returned as they are.
+    '''
+
+    reference = itk_images[reference_index]
+    resampled = []
+    for itk_img in itk_images:
+        same_grid = (itk_img.GetSize() == reference.GetSize()
+                     and np.allclose(itk_img.GetSpacing(), reference.GetSpacing(), atol=tolerance)
+                     and np.allclose(itk_img.GetOrigin(), reference.GetOrigin(), atol=tolerance)
+                     and np.allclose(itk_img.GetDirection(), reference.GetDirection(), atol=tolerance))
+        if not same_grid:
+            itk_img = itk.Resample(itk_img, reference, itk.Transform(), interpolator, 0.0, itk.sitkFloat32)
+        resampled.append(itk_img)
+    
+    return resampled
+
+
+def reorient_channels(itk_images, orientation='LPS', tolerance=1e-4, dtype=np.float32):
+    '''
+    reorient the channels of one case together. the channels are put on the
+    grid of the first one, the reorientation is computed once from its
+    direction and applied as axis permutations and flips while each channel
+    is copied into the output array, so each channel is copied once instead
+    of running a filter per channel.
+
+    Parameters
+    ----------
+    itk_images : list
+        loaded itk images, one per channel.
+    orientation : str
+        target orientation code, None keeps the orientation of the first channel.
+    tolerance : float
+        geometry differences below this are treated as the same grid.
+    dtype : numpy dtype
+        dtype of the returned array.
+
+    Returns
+    -------
+    reoriented files : (C, Z, Y, X) array, spacing, origin, direction.
+    '''
+
+    itk_images = resample_to_reference(itk_images, tolerance=tolerance)
+    reference = itk_images[0]
+    size = reference.GetSize()
+    if orientation is None:
+        stacked = np.empty((len(itk_images),) + tuple(size[::-1]), dtype=dtype)
+        for channel, itk_img in enumerate(itk_images):
+            stacked[channel] = itk.GetArrayViewFromImage(itk_img)
+        return stacked, reference.GetSpacing(), reference.GetOrigin(), reference.GetDirection()
+
+    permutation, flips = orientation_transform(reference.GetDirection(), orientation)
+    # itk axis a is axis 2 - a of the (Z, Y, X) array of a channel
+    index = [slice(None)] * 3
+    corner = [0, 0, 0]
+    for old_axis, flip in zip(permutation, flips):
+        if flip:
+            index[2 - old_axis] = slice(None, None, -1)
+            corner[old_axis] = size[old_axis] - 1
+    axes = [2 - permutation[2 - k] for k in range(3)]
+    # every channel view is flipped and transposed straight into the output, its only copy
+    reorient_array = np.empty((len(itk_images),) + tuple(size[permutation[2 - k]] for k in range(3)), dtype=dtype)
+    for channel, itk_img in enumerate(itk_images):
+        reorient_array[channel] = itk.GetArrayViewFromImage(itk_img)[tuple(index)].transpose(axes)
+
+    current = np.array(reference.GetDirection(), dtype=float).reshape(3, 3)
+    signs = np.array([-1.0 if flip else 1.0 for flip in flips])
+    reoriented_direction = tuple((current[:, list(permutation)] * signs[None, :]).ravel())
+    reoriented_spacing = tuple(reference.GetSpacing()[p] for p in permutation)
+    reoriented_origin = reference.TransformIndexToPhysicalPoint(corner)
+    
+    return reorient_array, reoriented_spacing, reoriented_origin, reoriented_direction
@@ -1,8 +1,95 @@
 import os
+import gzip
+import threading
+from collections import deque
 import SimpleITK as itk
-from .paths_dirs_stuff import create_path
+from concurrent.futures import ThreadPoolExecutor
+from .profiling import profiled
 
-def write_nifti_from_vol(vol_array, itk_orig, itk_space, itk_dir, absolute_name):
+
+def _gzip_member(chunk, compression_level):
+    return gzip.compress(chunk, compresslevel=compression_level, mtime=0)
+
+
+def _parallel_gzip(src_path, dst_path, compression_level=6, num_threads=4, chunk_size=16 * 1024 * 1024):
+    '''
+    gzip a file with several threads. every chunk becomes its own gzip member;
+    a file of concatenated members is a valid gzip stream (RFC 1952) that zlib
+    based NIfTI readers decompress as a whole. the file is streamed in
+    chunk_size pieces, at most 2 * num_threads of them are held in memory.
+    '''
+    compression_level = 6 if compression_level < 0 else compression_level
+    max_pending = 2 * num_threads
+    n_members = 0
+    with open(src_path, 'rb', buffering=0) as src, open(dst_path, 'wb') as dst, \
+            ThreadPoolExecutor(max_workers=num_threads) as pool:
+        pending = deque()
+        while True:
+            buffer = bytearray(chunk_size)
+            n_bytes = src.readinto(buffer)
+            if not n_bytes:
+                break
+            pending.append(pool.submit(_gzip_member, memoryview(buffer)[:n_bytes], compression_level))
+            if len(pending) >= max_pending:
+                dst.write(pending.popleft().result())
+                n_members += 1
+        while pending:
+            dst.write(pending.popleft().result())
+            n_members += 1
+        if n_members == 0:
+            dst.write(_gzip_member(b'', compression_level))
+    return None
+
+
+@profiled('write_nifti')
+def write_itk_image(itk_img, absolute_name, compress=True, compression_level=-1, backend='itk', num_threads=4):
+    '''
+    Write an itk image to nifti with the requested compression.
+
+    Parameters
+    ----------
+    itk_img : itk image
+        image to be saved.
+    absolute_name : string
+        the absolute path plus the name of the file excluding the extension.
+    compress : bool
+        write '.nii.gz' if True, an uncompressed '.nii' otherwise.
+    compression_level : int
+        gzip level 1 (fastest) .. 9 (smallest), -1 for the library default.
+    backend : string
+        'itk' lets itk compress in a single thread, 'parallel' writes an
+        uncompressed file and gzips it with num_threads threads.
+    num_threads : int
+        number of compression threads of the 'parallel' backend.
+
+    Returns
+    -------
+    fileName : string
+        the name of the written file.
+    '''
+
+    if not compress:
+        fileName = absolute_name + '.nii'
+        itk.WriteImage(itk_img, fileName)
+    elif backend == 'parallel':
+        fileName = absolute_name + '.nii.gz'
+        tmp_name = absolute_name + '.tmp.nii'
+        try:
+            itk.WriteImage(itk_img, tmp_name)
+            _parallel_gzip(tmp_name, fileName, compression_level, num_threads)
+        finally:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+    elif backend == 'itk':
+        fileName = absolute_name + '.nii.gz'
+        itk.WriteImage(itk_img, fileName, True, compression_level)
+    else:
+        raise ValueError("unknown writer backend '{}', use 'itk' or 'parallel'".format(backend))
+
+    return fileName
+
+def write_nifti_from_vol(vol_array, itk_orig, itk_space, itk_dir, absolute_name, compress=True, compression_level=-1,
+                         backend='itk', num_threads=4):
     '''
     Write back an array into a compressed nifti format by maintaining the 
     essential meta-data for image geometrics.
@@ -22,6 +109,8 @@ def write_nifti_from_vol(vol_array, itk_orig, itk_space, itk_dir, absolute_name)
         the absolute path plus the name of the file excluding the extension
         file format. for example:
             '/mnt/mri/data/SubjectName'
+    compress, compression_level, backend, num_threads :
+        see write_itk_image. the defaults write '.nii.gz' with itk.
 
     Returns
     -------
@@ -34,12 +123,12 @@ def write_nifti_from_vol(vol_array, itk_orig, itk_space, itk_dir, absolute_name)
     new_itk.SetSpacing(itk_space)
     new_itk.SetOrigin(itk_orig)
     new_itk.SetDirection(itk_dir)  
-    fileName = absolute_name+'.nii.gz'     
-    itk.WriteImage(new_itk, fileName)
+    write_itk_image(new_itk, absolute_name, compress, compression_level, backend, num_threads)
     
     return None
 
-def write_nifti_from_itk(itk_img, itk_orig, itk_space, itk_dir, absolute_name):
+def write_nifti_from_itk(itk_img, itk_orig, itk_space, itk_dir, absolute_name, compress=True, compression_level=-1,
+                         backend='itk', num_threads=4):
     '''
     Write back itk image into a compressed nifti format by maintaining the 
     essential meta-data for image geometrics.
@@ -59,6 +148,8 @@ def write_nifti_from_itk(itk_img, itk_orig, itk_space, itk_dir, absolute_name):
         the absolute path plus the name of the file excluding the extension
         file format. for example:
             '/mnt/mri/data/SubjectName'
+    compress, compression_level, backend, num_threads :
+        see write_itk_image. the defaults write '.nii.gz' with itk.
 
     Returns
     -------
@@ -70,7 +161,59 @@ def write_nifti_from_itk(itk_img, itk_orig, itk_space, itk_dir, absolute_name):
     itk_img.SetSpacing(itk_space)
     itk_img.SetOrigin(itk_orig)
     itk_img.SetDirection(itk_dir)  
-    fileName = absolute_name+'.nii.gz'     
-    itk.WriteImage(itk_img, fileName)
+    write_itk_image(itk_img, absolute_name, compress, compression_level, backend, num_threads)
     
     return None
+
+
+class BatchWriter:
+    '''
+    Write many volumes in background threads so that encoding and disk I/O of
+    one volume overlap with the work on the next ones. At most max_pending
+    volumes are held in memory, submit blocks when this limit is reached.
+
+    e.g.
+        with BatchWriter(num_workers=4, compression_level=1) as writer:
+            for vol_array, name in volumes:
+                writer.submit_vol(vol_array, origin, spacing, direction, name)
+    '''
+
+    def __init__(self, num_workers=4, max_pending=8, **write_options):
+        self.write_options = write_options
+        self._pool = ThreadPoolExecutor(max_workers=num_workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._futures = []
+
+    def _submit(self, function, *args):
+        self._slots.acquire()
+        future = self._pool.submit(function, *args, **self.write_options)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+        return future
+
+    def submit_vol(self, vol_array, itk_orig, itk_space, itk_dir, absolute_name):
+        return self._submit(write_nifti_from_vol, vol_array, itk_orig, itk_space, itk_dir, absolute_name)
+
+    def submit_itk(self, itk_img, itk_orig, itk_space, itk_dir, absolute_name):
+        return self._submit(write_nifti_from_itk, itk_img, itk_orig, itk_space, itk_dir, absolute_name)
+
+    def close(self):
+        '''
+        wait for all pending writes, errors of failed writes are raised here
+        '''
+        self._pool.shutdown(wait=True)
+        for future in self._futures:
+            future.result()
+        self._futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # wait for the pending writes but let the exception of the block through instead of a write error
+            self._pool.shutdown(wait=True)
+            self._futures = []
+        return False